@@ -1,4 +1,5 @@
 from sqladmin import ModelView
+from wtforms import SelectField
 from models import Product, PriceHistory, Subscription, TaskLog, ApiKey, UserSubscription
 
 class ProductAdmin(ModelView, model=Product):
@@ -82,8 +83,16 @@ class ApiKeyAdmin(ModelView, model=ApiKey):
         ApiKey.key,
         ApiKey.name,
         ApiKey.is_active,
+        ApiKey.priority,
+        ApiKey.rate_limit_per_minute,
         ApiKey.created_at
     ]
+    # Редактируются только параметры лимитов, сам ключ не меняется
+    form_columns = [ApiKey.name, ApiKey.is_active, ApiKey.priority, ApiKey.rate_limit_per_minute]
+    form_overrides = {"priority": SelectField}
+    form_args = {
+        "priority": {"choices": [("internal", "internal"), ("interactive", "interactive"), ("bulk", "bulk")]}
+    }
     column_searchable_list = [ApiKey.name]
     column_sortable_list = [ApiKey.id, ApiKey.created_at]
     column_default_sort = ("created_at", True)
@@ -91,7 +100,7 @@ class ApiKeyAdmin(ModelView, model=ApiKey):
     name_plural = "API ключи"
     icon = "fa-key"
     can_create = False
-    can_edit = False
+    can_edit = True
     can_delete = False
 
 class UserSubscriptionAdmin(ModelView, model=UserSubscription):
@@ -3,8 +3,10 @@ from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from db import get_db
+from typing import Optional
+from db import get_db, AsyncSessionLocal
 from models import ApiKey
+from auth_cache import api_key_cache, ApiKeyInfo, MISSING
 
 security = HTTPBearer()
 
@@ -13,6 +15,30 @@ class ApiKeyResponse(BaseModel):
     key: str
     is_active: bool
 
+async def resolve_api_key(key: str, db: Optional[AsyncSession] = None) -> Optional[ApiKeyInfo]:
+    """
+    Возвращает данные активного API ключа или None, если ключ неверный.
+    Результат кэшируется (см. auth_cache.py), запрос к базе выполняется только при промахе
+    """
+    info = api_key_cache.get(key)
+    if info is not MISSING:
+        return info
+
+    generation = api_key_cache.generation
+    query = (
+        select(ApiKey.id, ApiKey.priority, ApiKey.rate_limit_per_minute)
+        .where(ApiKey.key == key)
+        .where(ApiKey.is_active == True)
+    )
+    if db is None:
+        async with AsyncSessionLocal() as session:
+            row = (await session.execute(query)).first()
+    else:
+        row = (await db.execute(query)).first()
+    info = ApiKeyInfo(*row) if row is not None else None
+    api_key_cache.set(key, info, generation)
+    return info
+
 async def get_api_key(
     credentials: HTTPAuthorizationCredentials = Security(security),
     db: AsyncSession = Depends(get_db)
@@ -22,14 +48,8 @@ async def get_api_key(
     Ожидает заголовок в формате: Bearer <api_key>
     Возвращает строку с API ключом если он валиден
     """
-    result = await db.execute(
-        select(ApiKey)
-        .where(ApiKey.key == credentials.credentials)
-        .where(ApiKey.is_active == True)
-    )
-    api_key = result.scalar_one_or_none()
-    
-    if not api_key:
+    key = credentials.credentials
+    if await resolve_api_key(key, db) is None:
         raise HTTPException(
             status_code=401,
             detail={
@@ -37,4 +57,4 @@ async def get_api_key(
                 "detail": "Неверный API ключ"
             }
         )
-    return api_key.key 
\ No newline at end of file
+    return key
\ No newline at end of file
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Tuple, Union
+
+from db import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+# Время жизни записи о валидном ключе (секунды)
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '60'))
+# Время жизни записи о неверном ключе (секунды)
+AUTH_CACHE_NEGATIVE_TTL = float(os.getenv('AUTH_CACHE_NEGATIVE_TTL', '10'))
+# Максимальное число ключей в кэше, при переполнении вытесняются давно не использованные
+AUTH_CACHE_MAX_SIZE = int(os.getenv('AUTH_CACHE_MAX_SIZE', '10000'))
+# Пауза перед повторным подключением к каналу уведомлений (секунды)
+AUTH_CACHE_RECONNECT_INTERVAL = float(os.getenv('AUTH_CACHE_RECONNECT_INTERVAL', '30'))
+# Канал, в который триггер на api_keys отправляет изменившиеся ключи
+API_KEYS_CHANNEL = "api_keys_changed"
+
+
+class ApiKeyInfo(NamedTuple):
+    """Данные активного API ключа, нужные для авторизации и лимитов запросов"""
+    id: int
+    priority: str
+    rate_limit_per_minute: Optional[int]
+
+
+# Возвращается get(), если ключа нет в кэше (None означает закэшированный неверный ключ)
+MISSING = object()
+
+
+class ApiKeyCache:
+    """
+    LRU кэш результатов проверки API ключей с ограниченным временем жизни.
+
+    Хранит как валидные, так и неверные ключи (negative caching), чтобы перебор
+    ключей не превращался в запросы к базе. Любое изменение в api_keys приходит
+    через LISTEN/NOTIFY и сразу удаляет ключ из кэша; если канал недоступен,
+    устаревание записей ограничено TTL.
+    """
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, negative_ttl: float = AUTH_CACHE_NEGATIVE_TTL,
+                 max_size: int = AUTH_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[Optional[ApiKeyInfo], float]]" = OrderedDict()
+        # Растет при каждой инвалидации: результат запроса, начатого до неё, не кэшируется
+        self.generation = 0
+        self._counters = {"hits": 0, "negative_hits": 0, "misses": 0, "invalidations": 0, "evictions": 0}
+        self._conn = None
+        self._driver_conn = None
+        self._listening = False
+        self._task: Optional[asyncio.Task] = None
+
+    def get(self, key: str) -> Union[ApiKeyInfo, None, object]:
+        """
+        ApiKeyInfo для валидного ключа, None для неверного,
+        MISSING если ключа нет в кэше или запись устарела
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self._counters["misses"] += 1
+            return MISSING
+        self._entries.move_to_end(key)
+        self._counters["hits" if entry[0] is not None else "negative_hits"] += 1
+        return entry[0]
+
+    def set(self, key: str, info: Optional[ApiKeyInfo], generation: Optional[int] = None):
+        if generation is not None and generation != self.generation:
+            return
+        ttl = self.ttl if info is not None else self.negative_ttl
+        self._entries[key] = (info, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def invalidate(self, key: Optional[str] = None):
+        """Удаляет ключ из кэша, без аргумента очищает кэш целиком"""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+        self.generation += 1
+        self._counters["invalidations"] += 1
+
+    async def start(self):
+        await self._listen()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self._close_connection()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(AUTH_CACHE_RECONNECT_INTERVAL)
+            if not self._listening:
+                await self._close_connection()
+                await self._listen()
+
+    async def _listen(self):
+        try:
+            self._conn = await AsyncEngine.connect()
+            raw = await self._conn.get_raw_connection()
+            self._driver_conn = raw.driver_connection
+            await self._driver_conn.add_listener(API_KEYS_CHANNEL, self._on_notify)
+            self._driver_conn.add_termination_listener(self._on_terminated)
+            # Пока канал не слушался, уведомления могли быть пропущены
+            self.invalidate()
+            self._listening = True
+            logger.info(f"Listening for API key changes on channel {API_KEYS_CHANNEL}")
+        except Exception as e:
+            logger.error(f"Failed to listen for API key changes, relying on TTL: {e}")
+            await self._close_connection()
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.invalidate(payload or None)
+
+    def _on_terminated(self, connection):
+        logger.warning("API key notification channel closed, relying on TTL until reconnect")
+        self._listening = False
+
+    async def _close_connection(self):
+        self._listening = False
+        if self._conn is not None:
+            try:
+                # Соединение возвращается в общий пул, подписку на канал с него нужно снять
+                if self._driver_conn is not None and not self._driver_conn.is_closed():
+                    self._driver_conn.remove_termination_listener(self._on_terminated)
+                    await self._driver_conn.remove_listener(API_KEYS_CHANNEL, self._on_notify)
+                await self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+            self._driver_conn = None
+
+    def stats(self) -> Dict[str, object]:
+        lookups = self._counters["hits"] + self._counters["negative_hits"] + self._counters["misses"]
+        hits = self._counters["hits"] + self._counters["negative_hits"]
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "negative_ttl": self.negative_ttl,
+            "listening": self._listening,
+            **self._counters,
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0
+        }
+
+
+api_key_cache = ApiKeyCache()
@@ -0,0 +1,74 @@
+"""
+Микробенчмарк накладных расходов rate_limit_middleware на один запрос.
+
+Запуск из каталога src/api:
+    python benchmarks/rate_limit_benchmark.py --requests 100000 --clients 1000
+    python benchmarks/rate_limit_benchmark.py --backend postgres --requests 5000
+
+Сравнивает вызов middleware с пустым обработчиком и вызов обработчика напрямую.
+Для бэкенда postgres нужна доступная база из настроек db.py.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import middleware  # noqa: E402
+from middleware import RateLimiter, create_backend, rate_limit_middleware  # noqa: E402
+
+
+def make_request(client_ip: str) -> Request:
+    return Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/api/v1/products",
+        "headers": [],
+        "query_string": b"",
+        "client": (client_ip, 40000),
+        "server": ("127.0.0.1", 8000),
+    })
+
+
+async def call_next(request: Request) -> Response:
+    return Response(status_code=200)
+
+
+async def measure(handler, requests, total: int) -> float:
+    started = time.perf_counter()
+    for i in range(total):
+        await handler(requests[i % len(requests)])
+    return (time.perf_counter() - started) / total * 1e6
+
+
+async def run(backend: str, total: int, clients: int):
+    if backend == 'postgres':
+        from db import connect_with_retries
+        await connect_with_retries()
+
+    # Лимит выставлен так, чтобы все запросы проходили: измеряется путь разрешенного запроса
+    middleware.RATE_LIMIT_PER_MINUTE = 10 ** 9
+    middleware.rate_limiter = RateLimiter(backend=create_backend(backend))
+    requests = [make_request(f"10.0.{i // 256}.{i % 256}") for i in range(clients)]
+
+    baseline = await measure(call_next, requests, total)
+    limited = await measure(lambda request: rate_limit_middleware(request, call_next), requests, total)
+
+    print(f"backend={backend} requests={total} clients={clients}")
+    print(f"{'handler only, us':>20} {'with limiter, us':>18} {'overhead, us':>14}")
+    print(f"{baseline:>20.2f} {limited:>18.2f} {limited - baseline:>14.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["memory", "postgres"], default="memory")
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--clients", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(run(args.backend, args.requests, args.clients))
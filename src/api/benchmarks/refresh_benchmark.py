@@ -0,0 +1,78 @@
+"""
+Бенчмарк параллельного обновления подписок против локального фейкового сервера Wildberries.
+
+Запуск из каталога src/api:
+    python benchmarks/refresh_benchmark.py --sizes 1000 10000 --latency 0.2
+
+Измеряет только сетевую часть тика (пачки запросов к cards/v1/detail), без записи в БД.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from aiohttp import web
+
+HOST = "127.0.0.1"
+PORT = 18089
+
+os.environ.setdefault("WB_DETAIL_URL", f"http://{HOST}:{PORT}/cards/v1/detail")
+
+# Добавляем родительскую директорию в PYTHONPATH
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scheduler import run_batches  # noqa: E402
+from tasks import fetch_products_batch, chunked  # noqa: E402
+
+
+def make_fake_wb_app(latency: float) -> web.Application:
+    """Фейковый cards/v1/detail: отвечает карточкой на каждый nm с задержкой latency секунд"""
+    async def detail(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+        products = [
+            {"id": int(nm), "name": f"Товар {nm}", "salePriceU": 100000, "reviewRating": 4.8, "totalQuantity": 10}
+            for nm in request.query["nm"].split(";")
+        ]
+        return web.json_response({"data": {"products": products}})
+
+    app = web.Application()
+    app.router.add_get("/cards/v1/detail", detail)
+    return app
+
+
+async def fetch_only(batch):
+    results = await fetch_products_batch(batch, batch_size=len(batch))
+    return sum(1 for result in results.values() if result["status"] == "success")
+
+
+async def run(sizes, batch_size, concurrencies, latency):
+    runner = web.AppRunner(make_fake_wb_app(latency))
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+    try:
+        print(f"latency={latency}s batch_size={batch_size}")
+        print(f"{'subscriptions':>13} {'concurrency':>11} {'requests':>8} {'elapsed, s':>10} {'artikuls/s':>10}")
+        for size in sizes:
+            artikuls = [str(100000 + i) for i in range(size)]
+            batches = list(chunked(artikuls, batch_size))
+            for concurrency in concurrencies:
+                started = time.monotonic()
+                stats = await run_batches(batches, fetch_only, concurrency=concurrency, deadline=600)
+                elapsed = time.monotonic() - started
+                print(
+                    f"{size:>13} {concurrency:>11} {len(batches):>8} "
+                    f"{elapsed:>10.2f} {stats['updated'] / elapsed:>10.0f}"
+                )
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--latency", type=float, default=0.2, help="Задержка ответа фейкового сервера, с")
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.batch_size, args.concurrency, args.latency))
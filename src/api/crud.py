@@ -1,41 +1,125 @@
-from sqlalchemy import select
+import base64
+import json
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import select, tuple_, func, or_
+from sqlalchemy.dialects.postgresql import array_agg, aggregate_order_by
 from sqlalchemy.ext.asyncio import AsyncSession
-from models import Product, Subscription, TaskLog, ApiKey
-from schemas import ProductCreate
-from tasks import fetch_product_data
+from pydantic import ValidationError
+from models import Product, PriceHistory, Subscription, TaskLog, ApiKey, UserSubscription
+from schemas import ProductCreate, ProductResponse
+from tasks import fetch_product_data, fetch_products_batch
+from pipeline import RefreshWriter
 import secrets
 
+logger = logging.getLogger(__name__)
+
+
+async def get_fresh_product(session: AsyncSession, artikul: str, max_age: float) -> Optional[Product]:
+    """Возвращает товар из базы, если он обновлялся не раньше max_age секунд назад"""
+    if max_age <= 0:
+        return None
+    result = await session.execute(
+        select(Product)
+        .where(Product.artikul == artikul)
+        .where(Product.updated_at >= datetime.utcnow() - timedelta(seconds=max_age))
+    )
+    return result.scalars().first()
+
+async def get_products_batch(session: AsyncSession, artikuls: List[str], max_age: float) -> List[dict]:
+    """
+    Возвращает товары по списку артикулов, результат по каждому артикулу отдельно.
+    Свежие товары (не старше max_age секунд) берутся из базы, остальные запрашиваются
+    у Wildberries пачками и сохраняются одной транзакцией
+    """
+    artikuls = list(dict.fromkeys(artikuls))
+    items: Dict[str, dict] = {}
+    valid = []
+    for artikul in artikuls:
+        if artikul.isdigit() and len(artikul) <= 15:
+            valid.append(artikul)
+        else:
+            items[artikul] = {"artikul": artikul, "status": "invalid", "error": "Артикул должен содержать только цифры"}
+
+    stored = {}
+    if valid:
+        result = await session.execute(select(Product).where(Product.artikul.in_(valid)))
+        stored = {product.artikul: product for product in result.scalars()}
+
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+    stale = []
+    for artikul in valid:
+        product = stored.get(artikul)
+        if max_age > 0 and product is not None and product.updated_at and product.updated_at >= cutoff:
+            items[artikul] = {"artikul": artikul, "status": "ok", "source": "cache", "product": product}
+        else:
+            stale.append(artikul)
+
+    if stale:
+        writer = RefreshWriter()
+        fetched = await fetch_products_batch(stale)
+        for artikul in stale:
+            product_data = fetched.get(artikul, {"status": "error", "message": "No result"})
+            if product_data["status"] == "success":
+                old_product = stored.get(artikul)
+                writer.add_product(product_data, old_product.price if old_product else None)
+                items[artikul] = {"artikul": artikul, "status": "ok", "source": "wildberries", "product": product_data}
+            elif product_data.get("message") == "Product not found":
+                items[artikul] = {"artikul": artikul, "status": "not_found", "error": "Товар не найден на Wildberries"}
+            else:
+                items[artikul] = {"artikul": artikul, "status": "error", "error": product_data.get("message")}
+        if len(writer):
+            await writer.flush(session)
+            # Перечитываем записанные товары вместе со статистикой цен
+            refreshed = [artikul for artikul in stale if items[artikul]["status"] == "ok"]
+            if refreshed:
+                result = await session.execute(
+                    select(Product)
+                    .where(Product.artikul.in_(refreshed))
+                    .execution_options(populate_existing=True)
+                )
+                for product in result.scalars():
+                    items[product.artikul]["product"] = product
+
+    # Товар проверяется схемой ответа здесь, по одному: товар с некорректными данными
+    # (пустое название, рейтинг или цена вне допустимых границ) становится ошибкой
+    # только своего артикула, а не всего ответа
+    for item in items.values():
+        if item["status"] != "ok":
+            continue
+        try:
+            item["product"] = ProductResponse.model_validate(item["product"])
+        except ValidationError as e:
+            logger.warning(f"Product {item['artikul']} does not match the response schema: {e.error_count()} errors")
+            items[item["artikul"]] = {
+                "artikul": item["artikul"], "status": "error", "error": "Некорректные данные товара"
+            }
+
+    return [items[artikul] for artikul in artikuls]
 
 async def create_product(session: AsyncSession, product: ProductCreate):
+    """
+    Запрашивает товар у Wildberries и сохраняет его через RefreshWriter:
+    upsert товара, запись в историю цен при изменении цены и пересчет статистики одной транзакцией
+    """
     product_data = await fetch_product_data(product.artikul)
     if product_data.get("status") == "error":
         return {"status": "Product not found"}
-    
-    existing_product = await session.execute(
-        select(Product).where(Product.artikul == product.artikul)
+
+    old_price = await session.execute(
+        select(Product.price).where(Product.artikul == product.artikul)
     )
-    existing_product = existing_product.scalars().first()
-    
-    if existing_product:
-        existing_product.name = product_data['name']
-        existing_product.price = product_data['price']
-        existing_product.rating = product_data['rating']
-        existing_product.total_quantity = product_data['total_quantity']
-        await session.commit()
-        await session.refresh(existing_product)
-        return existing_product
-    else:
-        db_product = Product(
-            artikul=product.artikul,
-            name=product_data['name'],
-            price=product_data['price'],
-            rating=product_data['rating'],
-            total_quantity=product_data['total_quantity']
-        )
-        session.add(db_product)
-        await session.commit()
-        await session.refresh(db_product)
-        return db_product
+    writer = RefreshWriter()
+    writer.add_product(product_data, old_price=old_price.scalar())
+    await writer.flush(session)
+
+    result = await session.execute(
+        select(Product)
+        .where(Product.artikul == product.artikul)
+        .execution_options(populate_existing=True)
+    )
+    return result.scalars().first()
 
 async def create_or_update_subscription(session: AsyncSession, artikul: str) -> Subscription:
     existing_sub = await session.execute(
@@ -64,6 +148,7 @@ async def update_subscription_frequency(session: AsyncSession, artikul: str, fre
         raise Exception("Subscription not found")
     
     subscription.frequency_minutes = frequency_minutes
+    subscription.schedule_next_check()
     await session.commit()
     await session.refresh(subscription)
     return subscription
@@ -74,14 +159,219 @@ async def get_active_subscriptions(session: AsyncSession):
     )
     return result.scalars().all()
 
-async def get_all_products(session: AsyncSession):
-    result = await session.execute(select(Product))
-    return result.scalars().all()
+# Поля сортировки списка товаров; при равных значениях порядок задает id
+PRODUCT_SORT_COLUMNS = {
+    "id": Product.id,
+    "price": Product.price,
+    "rating": Product.rating,
+    "updated_at": Product.updated_at,
+}
 
-async def get_all_subscriptions(session: AsyncSession):
-    result = await session.execute(select(Subscription))
+def encode_cursor(sort: str, value, last_id: int) -> str:
+    """Курсор keyset пагинации: поле сортировки, его значение и id последней записи страницы"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps([sort, value, last_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str, sort: str) -> Tuple[object, int]:
+    """Возвращает (значение поля сортировки, id); ValueError, если курсор поврежден или от другой сортировки"""
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        cursor_sort, value, last_id = json.loads(payload)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if cursor_sort != sort or not isinstance(last_id, int):
+        raise ValueError("Cursor does not match sort order")
+    if sort.lstrip("-") == "updated_at" and value is not None:
+        value = datetime.fromisoformat(value)
+    return value, last_id
+
+def keyset_page(query, model, column, sort: str, limit: int, cursor: Optional[str], skip: int = 0):
+    """
+    Добавляет к запросу сортировку (column, id) и условие "после курсора".
+    Выбирается limit + 1 строк, чтобы узнать, есть ли следующая страница
+    """
+    descending = sort.startswith("-")
+    if cursor:
+        value, last_id = decode_cursor(cursor, sort)
+        after_id = model.id < last_id if descending else model.id > last_id
+        if column is model.id:
+            query = query.where(after_id)
+        elif value is None:
+            # Строки с пустым значением идут в конце в порядке id
+            query = query.where(column.is_(None), after_id)
+        else:
+            position = tuple_(column, model.id)
+            query = query.where(or_(
+                position < tuple_(value, last_id) if descending else position > tuple_(value, last_id),
+                column.is_(None)
+            ))
+    elif skip:
+        query = query.offset(skip)
+
+    if column is model.id:
+        order = [model.id.desc() if descending else model.id]
+    else:
+        # Сравнение кортежей с NULL дает NULL, поэтому пустые значения всегда сортируются последними
+        order = [column.desc().nulls_last(), model.id.desc()] if descending else [column.asc().nulls_last(), model.id]
+    return query.order_by(*order).limit(limit + 1)
+
+def next_cursor(rows: list, column_name: str, sort: str, limit: int) -> Optional[str]:
+    if len(rows) <= limit:
+        return None
+    last = rows[limit - 1]
+    return encode_cursor(sort, getattr(last, column_name), last.id)
+
+async def list_products(
+    session: AsyncSession,
+    limit: int,
+    cursor: Optional[str] = None,
+    sort: str = "id",
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    min_rating: Optional[float] = None,
+    max_rating: Optional[float] = None,
+    skip: int = 0
+) -> Tuple[List[Product], Optional[str]]:
+    """
+    Страница списка товаров с фильтрами по цене и рейтингу (индекс idx_price_rating).
+    Возвращает (товары, курсор следующей страницы или None)
+    """
+    column_name = sort.lstrip("-")
+    column = PRODUCT_SORT_COLUMNS[column_name]
+    query = select(Product)
+    if min_price is not None:
+        query = query.where(Product.price >= min_price)
+    if max_price is not None:
+        query = query.where(Product.price <= max_price)
+    if min_rating is not None:
+        query = query.where(Product.rating >= min_rating)
+    if max_rating is not None:
+        query = query.where(Product.rating <= max_rating)
+
+    result = await session.execute(keyset_page(query, Product, column, sort, limit, cursor, skip))
+    rows = result.scalars().all()
+    return rows[:limit], next_cursor(rows, column_name, sort, limit)
+
+async def list_subscriptions(
+    session: AsyncSession,
+    limit: int,
+    cursor: Optional[str] = None,
+    active_only: bool = False,
+    skip: int = 0
+) -> Tuple[List[Subscription], Optional[str]]:
+    """Страница списка подписок в порядке id. Возвращает (подписки, курсор следующей страницы или None)"""
+    query = select(Subscription)
+    if active_only:
+        query = query.where(Subscription.is_active == True)
+    result = await session.execute(keyset_page(query, Subscription, Subscription.id, "id", limit, cursor, skip))
+    rows = result.scalars().all()
+    return rows[:limit], next_cursor(rows, "id", "id", limit)
+
+def encode_subscribers_cursor(artikul: str, chat_id: str) -> str:
+    """Курсор страницы подписчиков: последняя пара (артикул, chat_id) страницы"""
+    payload = json.dumps([artikul, chat_id], separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_subscribers_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        artikul, chat_id = json.loads(payload)
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(artikul, str) or not isinstance(chat_id, str):
+        raise ValueError("Invalid cursor")
+    return artikul, chat_id
+
+async def get_subscribers_page(
+    session: AsyncSession,
+    artikuls: List[str],
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None
+) -> Tuple[Dict[str, List[str]], Optional[str]]:
+    """
+    chat_id подписчиков для списка артикулов одним запросом: ({артикул: [chat_id]}, курсор или None).
+    Строки идут в порядке (artikul, chat_id) и читаются только из индекса idx_user_subscriptions_artikul.
+    С limit возвращается не более limit подписчиков и курсор следующей страницы
+    """
+    query = (
+        select(UserSubscription.artikul, UserSubscription.chat_id)
+        .where(UserSubscription.artikul.in_(list(dict.fromkeys(artikuls))))
+    )
+    if cursor:
+        query = query.where(
+            tuple_(UserSubscription.artikul, UserSubscription.chat_id) > tuple_(*decode_subscribers_cursor(cursor))
+        )
+    query = query.order_by(UserSubscription.artikul, UserSubscription.chat_id)
+    if limit is not None:
+        query = query.limit(limit + 1)
+
+    rows = (await session.execute(query)).all()
+    next_page = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_page = encode_subscribers_cursor(*rows[-1])
+
+    subscribers: Dict[str, List[str]] = {}
+    for artikul, chat_id in rows:
+        subscribers.setdefault(artikul, []).append(chat_id)
+    return subscribers, next_page
+
+async def get_subscribers_by_artikuls(session: AsyncSession, artikuls: List[str]) -> Dict[str, List[str]]:
+    """Все chat_id подписчиков для списка артикулов одним запросом: {артикул: [chat_id]}"""
+    subscribers, _ = await get_subscribers_page(session, artikuls)
+    return subscribers
+
+def price_history_range(query, product_id: int, date_from: Optional[datetime], date_to: Optional[datetime]):
+    """Условия по товару и времени записи, покрываемые индексом idx_price_history_product"""
+    query = query.where(PriceHistory.product_id == product_id)
+    if date_from is not None:
+        query = query.where(PriceHistory.created_at >= date_from)
+    if date_to is not None:
+        query = query.where(PriceHistory.created_at < date_to)
+    return query
+
+async def get_price_history(
+    session: AsyncSession,
+    product_id: int,
+    limit: int,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None
+) -> List[PriceHistory]:
+    """Последние limit записей истории цен за период, от новых к старым"""
+    query = price_history_range(select(PriceHistory), product_id, date_from, date_to)
+    result = await session.execute(query.order_by(PriceHistory.created_at.desc()).limit(limit))
     return result.scalars().all()
 
+async def get_price_history_ohlc(
+    session: AsyncSession,
+    product_id: int,
+    interval: str,
+    limit: int,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None
+) -> List[dict]:
+    """
+    История цен, агрегированная в SQL по интервалам date_trunc(interval):
+    первая, максимальная, минимальная и последняя цена интервала. Последние limit интервалов, от новых к старым
+    """
+    bucket = func.date_trunc(interval, PriceHistory.created_at).label("bucket")
+    query = price_history_range(
+        select(
+            bucket,
+            array_agg(aggregate_order_by(PriceHistory.price, PriceHistory.created_at.asc()))[1].label("open"),
+            func.max(PriceHistory.price).label("high"),
+            func.min(PriceHistory.price).label("low"),
+            array_agg(aggregate_order_by(PriceHistory.price, PriceHistory.created_at.desc()))[1].label("close"),
+            array_agg(aggregate_order_by(PriceHistory.total_quantity, PriceHistory.created_at.desc()))[1].label("total_quantity"),
+            func.count().label("records")
+        ),
+        product_id, date_from, date_to
+    )
+    result = await session.execute(query.group_by(bucket).order_by(bucket.desc()).limit(limit))
+    return [dict(row) for row in result.mappings()]
+
 async def log_task(session: AsyncSession, artikul: str, status: str, message: str = None):
     log_entry = TaskLog(
         artikul=artikul,
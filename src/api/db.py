@@ -6,6 +6,8 @@ from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sess
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.exc import OperationalError
 
+from partitions import ensure_partitions
+
 SYNC_PROTOCOL = "postgresql"
 ASYNC_PROTOCOL = "postgresql+asyncpg"
 
@@ -43,6 +45,7 @@ async def connect_with_retries(max_retries: int = 5, delay: int = 2):
         try:
             async with AsyncEngine.begin() as conn:
                 await conn.run_sync(Base.metadata.create_all)
+                await ensure_partitions(conn)
             return  # Успешное подключение, выходим из функции
         except OperationalError as e:
             print(f"Ошибка подключения к базе данных: {e}. Попытка {attempt + 1} из {max_retries}.")
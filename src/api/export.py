@@ -0,0 +1,96 @@
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import datetime
+from typing import AsyncIterator, List, Optional
+
+from sqlalchemy import select
+
+from db import AsyncSessionLocal
+from models import Product, PriceHistory
+
+# Сколько строк читается с серверного курсора и отправляется клиенту за раз
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '1000'))
+
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+PRODUCT_EXPORT_COLUMNS = [
+    Product.artikul, Product.name, Product.price, Product.rating,
+    Product.total_quantity, Product.created_at, Product.updated_at
+]
+PRICE_HISTORY_EXPORT_COLUMNS = [
+    Product.artikul, PriceHistory.price, PriceHistory.total_quantity, PriceHistory.created_at
+]
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_rows(rows: List[dict], fmt: str, header: Optional[List[str]] = None) -> bytes:
+    """Кодирует пачку строк в NDJSON или CSV; для CSV header добавляет строку заголовков"""
+    if fmt == "ndjson":
+        return "".join(
+            json.dumps(row, ensure_ascii=False, default=_json_default) + "\n" for row in rows
+        ).encode()
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(header)
+    for row in rows:
+        writer.writerow(
+            value.isoformat() if isinstance(value, datetime) else value for value in row.values()
+        )
+    return buffer.getvalue().encode()
+
+
+async def stream_query(query, fmt: str, gzip: bool = False) -> AsyncIterator[bytes]:
+    """
+    Выполняет запрос через серверный курсор (yield_per) и отдает результат пачками
+    по EXPORT_CHUNK_SIZE строк. Память не зависит от размера таблицы.
+    Сессия открывается внутри генератора и живет, пока клиент читает ответ
+    """
+    compressor = zlib.compressobj(wbits=31) if gzip else None
+    header = [column.key for column in query.selected_columns] if fmt == "csv" else None
+
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(query.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+        async for partition in result.mappings().partitions():
+            chunk = encode_rows([dict(row) for row in partition], fmt, header)
+            header = None
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+
+    if header is not None:
+        # Пустая выборка: для CSV все равно отдаем строку заголовков
+        chunk = encode_rows([], fmt, header)
+        yield compressor.compress(chunk) if compressor is not None else chunk
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def products_export_query():
+    return select(*PRODUCT_EXPORT_COLUMNS).order_by(Product.id)
+
+
+def price_history_export_query(artikul: Optional[str] = None, since: Optional[datetime] = None):
+    query = (
+        select(*PRICE_HISTORY_EXPORT_COLUMNS)
+        .join(Product, Product.id == PriceHistory.product_id)
+        .order_by(PriceHistory.product_id, PriceHistory.created_at)
+    )
+    if artikul is not None:
+        query = query.where(Product.artikul == artikul)
+    if since is not None:
+        query = query.where(PriceHistory.created_at >= since)
+    return query
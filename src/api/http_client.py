@@ -0,0 +1,117 @@
+import logging
+import os
+from typing import Dict, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+BOT_API_URL = os.getenv('BOT_API_URL', 'http://bot:8889')
+WB_HTTP_MAX_CONNECTIONS = int(os.getenv('WB_HTTP_MAX_CONNECTIONS', '50'))
+BOT_HTTP_MAX_CONNECTIONS = int(os.getenv('BOT_HTTP_MAX_CONNECTIONS', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '30'))
+
+
+class HttpClientPool:
+    """Долгоживущий httpx.AsyncClient с keep-alive и счетчиками переиспользования соединений"""
+
+    def __init__(self, name: str, max_connections: int, timeout: httpx.Timeout, http2: bool = False):
+        self.name = name
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.requests = 0
+        self.connections_opened = 0
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Возвращает общий клиент, создавая его при первом обращении"""
+        if self._client is None or self._client.is_closed:
+            self.start()
+        return self._client
+
+    def start(self):
+        limits = httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_connections,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=limits,
+            http2=self.http2,
+            event_hooks={"request": [self._on_request]}
+        )
+        logger.info(f"HTTP pool '{self.name}' started (max_connections={self.max_connections}, http2={self.http2})")
+
+    async def close(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info(f"HTTP pool '{self.name}' closed")
+        self._client = None
+
+    async def _on_request(self, request: httpx.Request):
+        self.requests += 1
+        request.extensions["trace"] = self._trace
+
+    async def _trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            self.connections_opened += 1
+
+    def stats(self) -> Dict[str, object]:
+        """Статистика пула: открытые/простаивающие соединения и доля переиспользованных"""
+        connections = []
+        if self._client is not None and not self._client.is_closed:
+            pool = getattr(self._client._transport, "_pool", None)
+            connections = list(getattr(pool, "connections", []))
+        open_connections = [conn for conn in connections if not conn.is_closed()]
+        reused = max(self.requests - self.connections_opened, 0)
+        return {
+            "name": self.name,
+            "http2": self.http2,
+            "max_connections": self.max_connections,
+            "open_connections": len(open_connections),
+            "idle_connections": sum(1 for conn in open_connections if conn.is_idle()),
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            "reuse_ratio": round(reused / self.requests, 3) if self.requests else 0.0
+        }
+
+
+wb_pool = HttpClientPool(
+    "wildberries",
+    max_connections=WB_HTTP_MAX_CONNECTIONS,
+    timeout=httpx.Timeout(10.0, connect=5.0),
+    http2=True
+)
+bot_pool = HttpClientPool(
+    "bot",
+    max_connections=BOT_HTTP_MAX_CONNECTIONS,
+    timeout=httpx.Timeout(300.0, connect=5.0)
+)
+
+
+def start_http_clients():
+    """Создает общие HTTP клиенты (вызывается при старте приложения)"""
+    wb_pool.start()
+    bot_pool.start()
+
+
+async def close_http_clients():
+    """Закрывает общие HTTP клиенты (вызывается при остановке приложения)"""
+    await wb_pool.close()
+    await bot_pool.close()
+
+
+def get_http_pool_stats():
+    return [wb_pool.stats(), bot_pool.stats()]
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime
+from typing import Callable, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from db import AsyncEngine
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock, которым владеет лидер
+LEADER_LOCK_ID = int(os.getenv('LEADER_LOCK_ID', '7301001'))
+# Как часто лидер проверяет соединение с блокировкой, а остальные пытаются её захватить (секунды)
+LEADER_HEARTBEAT_INTERVAL = float(os.getenv('LEADER_HEARTBEAT_INTERVAL', '10'))
+INSTANCE_ID = os.getenv('INSTANCE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+
+
+class LeaderElector:
+    """
+    Выбор лидера через pg_try_advisory_lock.
+
+    Блокировка уровня сессии держится на отдельном соединении, пока оно живо.
+    Лидер периодически проверяет это соединение (heartbeat), остальные экземпляры
+    периодически пытаются захватить блокировку. Если процесс лидера падает, PostgreSQL
+    снимает блокировку вместе с сессией и её захватывает следующий экземпляр.
+    """
+
+    def __init__(self, lock_id: int = LEADER_LOCK_ID, instance_id: str = INSTANCE_ID,
+                 interval: float = LEADER_HEARTBEAT_INTERVAL):
+        self.lock_id = lock_id
+        self.instance_id = instance_id
+        self.interval = interval
+        self.is_leader = False
+        self.elected_at: Optional[datetime] = None
+        self.last_heartbeat: Optional[datetime] = None
+        self._conn: Optional[AsyncConnection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._on_elected: Optional[Callable[[], None]] = None
+        self._on_demoted: Optional[Callable[[], None]] = None
+
+    async def start(self, on_elected: Callable[[], None], on_demoted: Callable[[], None]):
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        await self._tick()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader and self._conn is not None:
+            try:
+                await self._conn.execute(text("SELECT pg_advisory_unlock(:lock_id)"), {"lock_id": self.lock_id})
+            except Exception as e:
+                logger.error(f"Failed to release leader lock: {e}")
+        self._demote()
+        await self._close_connection()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self._tick()
+
+    async def _tick(self):
+        try:
+            if self.is_leader:
+                await self._conn.execute(text("SELECT 1"))
+            else:
+                await self._try_acquire()
+            self.last_heartbeat = datetime.utcnow()
+        except Exception as e:
+            logger.error(f"Leader election error: {e}")
+            self._demote()
+            await self._close_connection()
+
+    async def _try_acquire(self):
+        if self._conn is None:
+            self._conn = await AsyncEngine.connect()
+            # Сессия с блокировкой не должна висеть в открытой транзакции
+            await self._conn.execution_options(isolation_level="AUTOCOMMIT")
+            await self._conn.execute(
+                text("SELECT set_config('application_name', :name, false)"),
+                {"name": f"wbparser-leader:{self.instance_id}"}
+            )
+        result = await self._conn.execute(text("SELECT pg_try_advisory_lock(:lock_id)"), {"lock_id": self.lock_id})
+        if result.scalar():
+            self.is_leader = True
+            self.elected_at = datetime.utcnow()
+            logger.info(f"Instance {self.instance_id} became the leader")
+            if self._on_elected:
+                self._on_elected()
+
+    def _demote(self):
+        if not self.is_leader:
+            return
+        self.is_leader = False
+        self.elected_at = None
+        logger.warning(f"Instance {self.instance_id} lost leadership")
+        if self._on_demoted:
+            self._on_demoted()
+
+    async def _close_connection(self):
+        if self._conn is not None:
+            try:
+                await self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    async def status(self, session) -> dict:
+        """Состояние текущего экземпляра и сведения о лидере из pg_locks"""
+        result = await session.execute(
+            text(
+                """
+                SELECT a.application_name, a.client_addr, a.backend_start
+                FROM pg_locks l
+                JOIN pg_stat_activity a ON a.pid = l.pid
+                WHERE l.locktype = 'advisory' AND l.granted
+                  AND l.classid = 0 AND l.objid = :lock_id AND l.objsubid = 1
+                """
+            ),
+            {"lock_id": self.lock_id}
+        )
+        row = result.first()
+        leader = None
+        if row is not None:
+            leader = {
+                "instance_id": row.application_name.removeprefix("wbparser-leader:"),
+                "client_addr": str(row.client_addr) if row.client_addr else None,
+                "connected_at": row.backend_start
+            }
+        return {
+            "instance_id": self.instance_id,
+            "is_leader": self.is_leader,
+            "elected_at": self.elected_at,
+            "last_heartbeat": self.last_heartbeat,
+            "leader": leader
+        }
+
+
+leader_elector = LeaderElector()
@@ -16,9 +16,12 @@ from admin import (
     UserSubscriptionAdmin
 )
 from db import connect_with_retries, SyncEngine, AsyncEngine, AsyncSessionLocal
-from router import router_product
+from router import router_product, router_system
 from middleware import rate_limit_middleware
 from scheduler import start_scheduler
+from leader import leader_elector
+from auth_cache import api_key_cache
+from http_client import start_http_clients, close_http_clients
 from exception import WildberriesAPIError, ProductNotFoundError, WildberriesTimeoutError, WildberriesResponseError
 from models import ApiKey
 
@@ -33,19 +36,40 @@ logger = logging.getLogger(__name__)
 # Глобальная переменная для хранения планировщика
 scheduler = None
 
+def on_leader_elected():
+    """Экземпляр стал лидером: запускаем плановые задачи"""
+    global scheduler
+    logger.info("Starting scheduler...")
+    scheduler = start_scheduler()
+
+def on_leader_demoted():
+    """Экземпляр потерял лидерство: останавливаем плановые задачи"""
+    global scheduler
+    if scheduler:
+        logger.info("Stopping scheduler...")
+        scheduler.shutdown(wait=False)
+        scheduler = None
+        logger.info("Scheduler stopped")
+
 async def ensure_api_key_exists():
-    """Проверяет наличие активного API ключа и создает его при необходимости"""
+    """
+    Проверяет наличие активного internal API ключа (им пользуется бот) и создает его при необходимости.
+    Запросы с internal ключом не ограничиваются лимитом
+    """
     async with AsyncSessionLocal() as session:
-        # Проверяем наличие активного ключа
+        # Проверяем наличие активного internal ключа, остальные ключи выдаются через админку
         result = await session.execute(
-            select(ApiKey).where(ApiKey.is_active == True)
+            select(ApiKey)
+            .where(ApiKey.is_active == True, ApiKey.priority == 'internal')
+            .order_by(ApiKey.id)
+            .limit(1)
         )
-        api_key = result.scalar_one_or_none()
+        api_key = result.scalars().first()
         
         if not api_key:
             # Создаем новый ключ
             new_key = secrets.token_urlsafe(32)
-            api_key = ApiKey(key=new_key, is_active=True)
+            api_key = ApiKey(key=new_key, is_active=True, priority='internal')
             session.add(api_key)
             await session.commit()
             
@@ -64,8 +88,6 @@ async def ensure_api_key_exists():
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
-    global scheduler
-    
     # Startup
     try:
         logger.info("=== Starting application ===")
@@ -77,19 +99,27 @@ async def lifespan(app: FastAPI):
         # Проверяем/создаем API ключ
         await ensure_api_key_exists()
         
-        # Запускаем планировщик задач
-        logger.info("Starting scheduler...")
-        scheduler = start_scheduler()
+        # Подписываемся на изменения API ключей для инвалидации кэша
+        await api_key_cache.start()
+        
+        # Создаем общие HTTP клиенты для Wildberries и API бота
+        start_http_clients()
+        
+        # Плановые задачи запускает только экземпляр, захвативший advisory lock лидера
+        await leader_elector.start(on_leader_elected, on_leader_demoted)
+        if not leader_elector.is_leader:
+            logger.info("Running as follower, scheduled jobs are handled by the leader")
         logger.info("=== Application startup completed successfully ===")
         
         yield
         
         # Shutdown
         logger.info("=== Shutting down application ===")
-        if scheduler:
-            logger.info("Stopping scheduler...")
-            scheduler.shutdown()
-            logger.info("Scheduler stopped")
+        await leader_elector.stop()
+        await api_key_cache.stop()
+        
+        logger.info("Closing HTTP clients...")
+        await close_http_clients()
         
         logger.info("Closing database connections...")
         await AsyncEngine.dispose()
@@ -146,6 +176,7 @@ app.add_middleware(
 )
 
 app.include_router(router_product)
+app.include_router(router_system)
 
 admin = Admin(app, engine=SyncEngine)
 admin.add_view(ProductAdmin)
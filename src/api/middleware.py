@@ -1,40 +1,266 @@
-from fastapi import HTTPException, Request
-from typing import Dict, Tuple
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from typing import Dict, NamedTuple, Optional, Tuple
+import logging
+import math
+import os
 import time
-from collections import defaultdict
+
+from sqlalchemy import text
+
+from db import AsyncEngine
+from auth import resolve_api_key
+
+logger = logging.getLogger(__name__)
+
+# Лимит запросов в минуту по умолчанию: для ключей класса interactive и для запросов без ключа (по IP)
+RATE_LIMIT_PER_MINUTE = int(os.getenv('RATE_LIMIT_PER_MINUTE', '30'))
+# Лимит по умолчанию для одного ключа класса bulk
+RATE_LIMIT_BULK_PER_MINUTE = int(os.getenv('RATE_LIMIT_BULK_PER_MINUTE', '60'))
+# Общий лимит всех ключей класса bulk, чтобы массовые клиенты не вытесняли интерактивных (0 - без ограничения)
+RATE_LIMIT_BULK_TOTAL_PER_MINUTE = int(os.getenv('RATE_LIMIT_BULK_TOTAL_PER_MINUTE', '300'))
+# Хранилище состояния лимитов: memory (в процессе) или postgres (общее для всех воркеров и узлов)
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory')
+# Как часто удаляются ключи, лимит которых полностью восстановился (секунды)
+RATE_LIMIT_EVICT_INTERVAL = float(os.getenv('RATE_LIMIT_EVICT_INTERVAL', '60'))
+
+
+class RateLimitResult(NamedTuple):
+    limited: bool
+    # Через сколько секунд можно повторить запрос (0, если запрос разрешен)
+    retry_after: float
+    # Сколько запросов ещё можно выполнить без ожидания
+    remaining: int
+    # Через сколько секунд лимит восстановится полностью
+    reset_after: float
+
+
+def gcra(tat: Optional[float], now: float, limit: int, period: float):
+    """
+    Generic Cell Rate Algorithm: вместо списка временных меток хранится одно число на ключ -
+    теоретическое время прихода следующего запроса (TAT). Допускает всплеск до limit запросов,
+    затем пропускает по одному запросу каждые period / limit секунд.
+
+    Возвращает (результат, новое значение TAT или None, если запрос отклонен)
+    """
+    interval = period / limit
+    new_tat = max(tat or now, now) + interval
+    allow_at = new_tat - period
+    if now < allow_at:
+        return RateLimitResult(True, allow_at - now, 0, max(tat or now, now) - now), None
+    return RateLimitResult(False, 0.0, remaining_requests(new_tat - now, period, interval), new_tat - now), new_tat
+
+
+def remaining_requests(reset_after: float, period: float, interval: float) -> int:
+    # Округление убирает погрешность float: (1.0 - 0.2) / 0.2 = 3.9999...
+    return int(math.floor(round((period - reset_after) / interval, 6)))
+
+
+class MemoryRateLimitBackend:
+    """Состояние лимитов в памяти процесса: одно значение TAT на ключ"""
+
+    def __init__(self, evict_interval: float = RATE_LIMIT_EVICT_INTERVAL):
+        self.evict_interval = evict_interval
+        self._tats: Dict[str, float] = {}
+        self._next_eviction = time.monotonic() + evict_interval
+
+    async def hit(self, key: str, limit: int, period: float) -> RateLimitResult:
+        now = time.monotonic()
+        if now >= self._next_eviction:
+            self.evict_idle(now)
+        result, new_tat = gcra(self._tats.get(key), now, limit, period)
+        if new_tat is not None:
+            self._tats[key] = new_tat
+        return result
+
+    async def refund(self, key: str, limit: int, period: float):
+        """Возвращает разрешение, выданное hit, если запрос все же не будет выполнен"""
+        if key in self._tats:
+            self._tats[key] -= period / limit
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """Удаляет ключи, чей TAT уже в прошлом: их состояние не отличается от отсутствующего"""
+        now = now if now is not None else time.monotonic()
+        idle = [key for key, tat in self._tats.items() if tat <= now]
+        for key in idle:
+            del self._tats[key]
+        self._next_eviction = now + self.evict_interval
+        return len(idle)
+
+    def __len__(self):
+        return len(self._tats)
+
+
+class PostgresRateLimitBackend:
+    """
+    Общее состояние лимитов в UNLOGGED таблице rate_limits.
+
+    Проверка и обновление TAT выполняются одним INSERT ... ON CONFLICT DO UPDATE,
+    время берется из часов сервера БД, поэтому лимит одинаков для всех воркеров и узлов.
+    При недоступности базы используется локальный лимитер процесса.
+    """
+
+    HIT_SQL = text(
+        """
+        WITH clock AS (SELECT extract(epoch FROM clock_timestamp())::float8 AS now)
+        INSERT INTO rate_limits AS r (key, tat)
+        SELECT :key, clock.now + :interval FROM clock
+        ON CONFLICT (key) DO UPDATE
+            SET tat = GREATEST(r.tat, EXCLUDED.tat - :interval) + :interval
+            WHERE GREATEST(r.tat, EXCLUDED.tat - :interval) + :interval - :period <= EXCLUDED.tat - :interval
+        RETURNING r.tat, (SELECT now FROM clock)
+        """
+    )
+    STATE_SQL = text(
+        "SELECT tat, extract(epoch FROM clock_timestamp())::float8 FROM rate_limits WHERE key = :key"
+    )
+    EVICT_SQL = text("DELETE FROM rate_limits WHERE tat <= extract(epoch FROM clock_timestamp())")
+    REFUND_SQL = text("UPDATE rate_limits SET tat = tat - :interval WHERE key = :key")
+
+    def __init__(self, evict_interval: float = RATE_LIMIT_EVICT_INTERVAL):
+        self.evict_interval = evict_interval
+        self.fallback = MemoryRateLimitBackend(evict_interval)
+        self._next_eviction = time.monotonic() + evict_interval
+
+    async def hit(self, key: str, limit: int, period: float) -> RateLimitResult:
+        interval = period / limit
+        try:
+            async with AsyncEngine.begin() as conn:
+                row = (await conn.execute(
+                    self.HIT_SQL, {"key": key, "interval": interval, "period": period}
+                )).first()
+                if row is None:
+                    row = (await conn.execute(self.STATE_SQL, {"key": key})).first()
+                    result, _ = gcra(row[0], row[1], limit, period)
+                    return result
+                tat, now = row
+                return RateLimitResult(False, 0.0, remaining_requests(tat - now, period, interval), tat - now)
+        except Exception as e:
+            logger.error(f"Shared rate limiter unavailable, using local limits: {e}")
+            return await self.fallback.hit(key, limit, period)
+        finally:
+            if time.monotonic() >= self._next_eviction:
+                await self.evict_idle()
+
+    async def refund(self, key: str, limit: int, period: float):
+        try:
+            async with AsyncEngine.begin() as conn:
+                await conn.execute(self.REFUND_SQL, {"key": key, "interval": period / limit})
+        except Exception as e:
+            logger.error(f"Shared rate limiter unavailable, refunding locally: {e}")
+            await self.fallback.refund(key, limit, period)
+
+    async def evict_idle(self) -> int:
+        self._next_eviction = time.monotonic() + self.evict_interval
+        try:
+            async with AsyncEngine.begin() as conn:
+                result = await conn.execute(self.EVICT_SQL)
+                return result.rowcount
+        except Exception as e:
+            logger.error(f"Failed to evict idle rate limit keys: {e}")
+            return 0
+
+
+# Классы приоритета API ключей (ApiKey.priority)
+PRIORITY_INTERNAL = 'internal'
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BULK = 'bulk'
+
 
 class RateLimiter:
-    def __init__(self, requests_per_minute: int = 30):
+    def __init__(self, requests_per_minute: int = RATE_LIMIT_PER_MINUTE, backend=None):
         self.requests_per_minute = requests_per_minute
-        self.requests: Dict[str, list] = defaultdict(list)
+        self.backend = backend or MemoryRateLimitBackend()
 
-    def is_rate_limited(self, key: str) -> Tuple[bool, float]:
-        now = time.time()
-        minute_ago = now - 60
+    async def check(self, key: str, requests_per_minute: Optional[int] = None) -> RateLimitResult:
+        return await self.backend.hit(key, requests_per_minute or self.requests_per_minute, 60.0)
 
-        self.requests[key] = [req_time for req_time in self.requests[key] if req_time > minute_ago]
+    async def refund(self, key: str, requests_per_minute: Optional[int] = None):
+        await self.backend.refund(key, requests_per_minute or self.requests_per_minute, 60.0)
 
-        if len(self.requests[key]) >= self.requests_per_minute:
-            wait_time = 60 - (now - self.requests[key][0])
-            return True, wait_time
 
-        self.requests[key].append(now)
-        return False, 0
+def create_backend(name: str = RATE_LIMIT_BACKEND):
+    if name == 'postgres':
+        return PostgresRateLimitBackend()
+    if name != 'memory':
+        logger.warning(f"Unknown rate limit backend {name!r}, using memory")
+    return MemoryRateLimitBackend()
 
-rate_limiter = RateLimiter()
 
-async def rate_limit_middleware(request: Request, call_next):
-    client_ip = request.client.host
-    is_limited, wait_time = rate_limiter.is_rate_limited(client_ip)
+rate_limiter = RateLimiter(backend=create_backend())
+
 
-    if is_limited:
-        raise HTTPException(
-            status_code=429,
-            detail={
+async def client_policy(request: Request) -> Tuple[Optional[str], int, str]:
+    """
+    Определяет, по какому ключу ограничивать запрос: (ключ лимитера, лимит в минуту, класс приоритета).
+    Запросы с валидным API ключом ограничиваются по ключу, остальные - по IP клиента.
+    Для ключей класса internal ключ лимитера None - такие запросы не ограничиваются.
+    """
+    scheme, _, token = request.headers.get('authorization', '').partition(' ')
+    if scheme.lower() == 'bearer' and token:
+        try:
+            info = await resolve_api_key(token)
+        except Exception as e:
+            logger.error(f"Failed to resolve API key for rate limiting: {e}")
+            info = None
+        if info is not None:
+            if info.priority == PRIORITY_INTERNAL:
+                return None, 0, PRIORITY_INTERNAL
+            default = RATE_LIMIT_BULK_PER_MINUTE if info.priority == PRIORITY_BULK else RATE_LIMIT_PER_MINUTE
+            return f"key:{info.id}", info.rate_limit_per_minute or default, info.priority
+    return f"ip:{request.client.host}", RATE_LIMIT_PER_MINUTE, PRIORITY_INTERACTIVE
+
+
+def rate_limit_headers(result: RateLimitResult, limit: int) -> Dict[str, str]:
+    """Заголовки RateLimit-* (draft-ietf-httpapi-ratelimit-headers)"""
+    return {
+        "RateLimit-Limit": str(limit),
+        "RateLimit-Remaining": str(result.remaining),
+        "RateLimit-Reset": str(math.ceil(result.reset_after)),
+        "RateLimit-Policy": f"{limit};w=60"
+    }
+
+
+def rate_limited_response(result: RateLimitResult, headers: Dict[str, str]) -> JSONResponse:
+    wait_seconds = round(result.retry_after, 1)
+    return JSONResponse(
+        status_code=429,
+        content={
+            "detail": {
                 "error": "Too Many Requests",
-                "wait_seconds": round(wait_time, 1)
-            }
-        )
+                "wait_seconds": wait_seconds
+            },
+            "wait_seconds": wait_seconds
+        },
+        headers={"Retry-After": str(math.ceil(result.retry_after)), **headers}
+    )
+
+
+async def rate_limit_middleware(request: Request, call_next):
+    key, limit, priority = await client_policy(request)
+    if key is None:
+        return await call_next(request)
+
+    # Сначала проверяется общий лимит класса bulk: запрос, отклоненный по лимиту класса,
+    # не должен расходовать лимит самого ключа
+    class_key = None
+    if priority == PRIORITY_BULK and RATE_LIMIT_BULK_TOTAL_PER_MINUTE > 0:
+        class_key = f"class:{PRIORITY_BULK}"
+        class_result = await rate_limiter.check(class_key, RATE_LIMIT_BULK_TOTAL_PER_MINUTE)
+        if class_result.limited:
+            return rate_limited_response(
+                class_result, rate_limit_headers(class_result, RATE_LIMIT_BULK_TOTAL_PER_MINUTE)
+            )
+
+    result = await rate_limiter.check(key, limit)
+    headers = rate_limit_headers(result, limit)
+    if result.limited:
+        # Запрос не выполняется: разрешение класса возвращается другим ключам класса
+        if class_key is not None:
+            await rate_limiter.refund(class_key, RATE_LIMIT_BULK_TOTAL_PER_MINUTE)
+        return rate_limited_response(result, headers)
 
     response = await call_next(request)
-    return response 
\ No newline at end of file
+    response.headers.update(headers)
+    return response
+
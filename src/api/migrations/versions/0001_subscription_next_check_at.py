@@ -0,0 +1,41 @@
+"""Добавляет subscriptions.next_check_at и индекс для выборки подписок к обновлению
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Таблицы могли быть созданы через Base.metadata.create_all уже с новой колонкой
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('subscriptions')}
+    if 'next_check_at' not in columns:
+        op.add_column('subscriptions', sa.Column('next_check_at', sa.DateTime(), nullable=True))
+
+    op.execute(
+        """
+        UPDATE subscriptions
+        SET next_check_at = COALESCE(last_checked_at, now() AT TIME ZONE 'utc')
+            + make_interval(mins => COALESCE(frequency_minutes, 30))
+        WHERE next_check_at IS NULL
+        """
+    )
+    op.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_subscriptions_next_check
+        ON subscriptions (next_check_at, id)
+        WHERE is_active = true
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('idx_subscriptions_next_check', table_name='subscriptions')
+    op.drop_column('subscriptions', 'next_check_at')
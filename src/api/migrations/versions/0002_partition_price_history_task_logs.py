@@ -0,0 +1,117 @@
+"""Переводит price_history и task_logs на секционирование по created_at
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+from partitions import partition_ddl, ahead_until
+
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+TABLES = {
+    'price_history': {
+        'columns': """
+            id SERIAL,
+            product_id INTEGER REFERENCES products (id) ON DELETE CASCADE,
+            price DOUBLE PRECISION NOT NULL,
+            total_quantity INTEGER,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id, created_at)
+        """,
+        'column_names': 'id, product_id, price, total_quantity, created_at',
+        'indexes': {
+            'idx_price_history_date': '(created_at)',
+            'idx_price_history_product': '(product_id, created_at)',
+        },
+    },
+    'task_logs': {
+        'columns': """
+            id SERIAL,
+            artikul VARCHAR,
+            status VARCHAR,
+            message VARCHAR,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (id, created_at)
+        """,
+        'column_names': 'id, artikul, status, message, created_at',
+        'indexes': {
+            'idx_task_logs_date_status': '(created_at, status)',
+            'ix_task_logs_artikul': '(artikul)',
+        },
+    },
+}
+
+
+def is_partitioned(bind, table: str) -> bool:
+    return bind.execute(
+        sa.text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"),
+        {"table": table}
+    ).scalar() is not None
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    for table, spec in TABLES.items():
+        if is_partitioned(bind, table):
+            continue
+
+        old = f"{table}_old"
+        # Индексы и последовательность старой таблицы переименовываются, чтобы освободить имена
+        op.execute(f"ALTER TABLE {table} RENAME TO {old}")
+        op.execute(f"ALTER INDEX IF EXISTS {table}_pkey RENAME TO {old}_pkey")
+        for index in spec['indexes']:
+            op.execute(f"ALTER INDEX IF EXISTS {index} RENAME TO {index}_old")
+        op.execute(f"ALTER SEQUENCE IF EXISTS {table}_id_seq RENAME TO {old}_id_seq")
+
+        op.execute(f"CREATE TABLE {table} ({spec['columns']}) PARTITION BY RANGE (created_at)")
+        for index, columns in spec['indexes'].items():
+            op.execute(f"CREATE INDEX {index} ON {table} {columns}")
+
+        since = bind.execute(sa.text(f"SELECT min(created_at) FROM {old}")).scalar() or datetime.utcnow()
+        for statement in partition_ddl(table, since, ahead_until()):
+            op.execute(statement)
+
+        op.execute(
+            f"INSERT INTO {table} ({spec['column_names']}) "
+            f"SELECT {spec['column_names']} FROM {old} WHERE created_at IS NOT NULL"
+        )
+        op.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE((SELECT max(id) FROM {table}), 0) + 1, false)"
+        )
+        op.execute(f"DROP TABLE {old}")
+
+
+def downgrade() -> None:
+    bind = op.get_bind()
+    for table, spec in TABLES.items():
+        if not is_partitioned(bind, table):
+            continue
+
+        old = f"{table}_partitioned"
+        op.execute(f"ALTER TABLE {table} RENAME TO {old}")
+        for index in spec['indexes']:
+            op.execute(f"ALTER INDEX IF EXISTS {index} RENAME TO {index}_partitioned")
+        op.execute(f"ALTER SEQUENCE IF EXISTS {table}_id_seq RENAME TO {old}_id_seq")
+
+        columns = spec['columns'].replace('PRIMARY KEY (id, created_at)', 'PRIMARY KEY (id)')
+        op.execute(f"CREATE TABLE {table} ({columns})")
+        for index, index_columns in spec['indexes'].items():
+            op.execute(f"CREATE INDEX {index} ON {table} {index_columns}")
+
+        op.execute(
+            f"INSERT INTO {table} ({spec['column_names']}) SELECT {spec['column_names']} FROM {old}"
+        )
+        op.execute(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"COALESCE((SELECT max(id) FROM {table}), 0) + 1, false)"
+        )
+        op.execute(f"DROP TABLE {old} CASCADE")
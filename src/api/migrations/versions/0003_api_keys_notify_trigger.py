@@ -0,0 +1,24 @@
+"""Триггер уведомлений об изменении api_keys для инвалидации кэша ключей
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+from models import API_KEYS_NOTIFY_FUNCTION, API_KEYS_NOTIFY_TRIGGER
+
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(API_KEYS_NOTIFY_FUNCTION.statement)
+    op.execute(API_KEYS_NOTIFY_TRIGGER.statement)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS api_keys_changed ON api_keys")
+    op.execute("DROP FUNCTION IF EXISTS notify_api_keys_changed()")
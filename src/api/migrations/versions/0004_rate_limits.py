@@ -0,0 +1,27 @@
+"""Таблица rate_limits для общего лимитера запросов
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17
+"""
+from alembic import op
+
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        """
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits (
+            key VARCHAR PRIMARY KEY,
+            tat DOUBLE PRECISION NOT NULL
+        )
+        """
+    )
+
+
+def downgrade() -> None:
+    op.execute("DROP TABLE IF EXISTS rate_limits")
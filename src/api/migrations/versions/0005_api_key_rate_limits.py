@@ -0,0 +1,35 @@
+"""Класс приоритета и лимит запросов для API ключей
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0005'
+down_revision = '0004'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('api_keys')}
+    if 'priority' not in columns:
+        op.add_column(
+            'api_keys',
+            sa.Column('priority', sa.String(), nullable=False, server_default='interactive')
+        )
+        # До этой миграции единственным ключом был созданный при старте ключ бота:
+        # он становится internal, чтобы запросы бота не ограничивались лимитом
+        op.execute(
+            "UPDATE api_keys SET priority = 'internal' "
+            "WHERE id = (SELECT min(id) FROM api_keys WHERE is_active)"
+        )
+    if 'rate_limit_per_minute' not in columns:
+        op.add_column('api_keys', sa.Column('rate_limit_per_minute', sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('api_keys', 'rate_limit_per_minute')
+    op.drop_column('api_keys', 'priority')
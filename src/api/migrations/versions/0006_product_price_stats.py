@@ -0,0 +1,67 @@
+"""Таблица product_price_stats со статистикой цен товаров
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+WINDOWS = (7, 30, 90)
+
+
+def upgrade() -> None:
+    if not sa.inspect(op.get_bind()).has_table('product_price_stats'):
+        op.create_table(
+            'product_price_stats',
+            sa.Column('product_id', sa.Integer(), sa.ForeignKey('products.id', ondelete='CASCADE'), primary_key=True),
+            sa.Column('lowest_price', sa.Float()),
+            sa.Column('lowest_price_at', sa.DateTime()),
+            sa.Column('highest_price', sa.Float()),
+            *[
+                sa.Column(f'{name}_price_{days}d', sa.Float())
+                for days in WINDOWS
+                for name in ('min', 'max', 'avg')
+            ],
+            sa.Column('updated_at', sa.DateTime()),
+        )
+
+    # Начальное заполнение по всей сохраненной истории и текущим ценам
+    window_columns = ", ".join(f"{name}_price_{days}d" for days in WINDOWS for name in ('min', 'max', 'avg'))
+    window_aggregates = ", ".join(
+        f"{name}(price) FILTER (WHERE created_at >= now.ts - interval '{days} days')"
+        for days in WINDOWS
+        for name in ('min', 'max', 'avg')
+    )
+    op.execute(
+        f"""
+        WITH now AS (SELECT (now() AT TIME ZONE 'UTC')::timestamp AS ts),
+        points AS (
+            SELECT product_id, price, created_at FROM price_history
+            UNION ALL
+            SELECT id, price, (SELECT ts FROM now) FROM products WHERE price IS NOT NULL
+        )
+        INSERT INTO product_price_stats (
+            product_id, lowest_price, lowest_price_at, highest_price, {window_columns}, updated_at
+        )
+        SELECT
+            product_id,
+            min(price),
+            (array_agg(created_at ORDER BY price, created_at))[1],
+            max(price),
+            {window_aggregates},
+            now.ts
+        FROM points CROSS JOIN now
+        GROUP BY product_id, now.ts
+        ON CONFLICT (product_id) DO NOTHING
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('product_price_stats')
@@ -0,0 +1,40 @@
+"""Таблица notification_outbox для доставки уведомлений в бот
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-17
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision = '0007'
+down_revision = '0006'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if sa.inspect(op.get_bind()).has_table('notification_outbox'):
+        return
+    op.create_table(
+        'notification_outbox',
+        sa.Column('id', sa.Integer(), primary_key=True),
+        sa.Column('event_type', sa.String(), nullable=False),
+        sa.Column('artikul', sa.String(), nullable=False),
+        sa.Column('payload', postgresql.JSONB(), nullable=False),
+        sa.Column('idempotency_key', sa.String(), nullable=False, unique=True),
+        sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+        sa.Column('delivered_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+    )
+    op.create_index(
+        'idx_outbox_pending', 'notification_outbox', ['next_attempt_at', 'id'],
+        postgresql_where=sa.text('delivered_at IS NULL')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('notification_outbox')
@@ -0,0 +1,29 @@
+"""Индекс user_subscriptions (artikul, chat_id) для выборки подписчиков по артикулу
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+"""
+from alembic import op
+
+revision = '0008'
+down_revision = '0007'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Индекс строится без блокировки записи в таблицу подписок
+    with op.get_context().autocommit_block():
+        op.create_index(
+            'idx_user_subscriptions_artikul', 'user_subscriptions', ['artikul', 'chat_id'],
+            postgresql_concurrently=True, if_not_exists=True
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index(
+            'idx_user_subscriptions_artikul', table_name='user_subscriptions',
+            postgresql_concurrently=True, if_exists=True
+        )
@@ -0,0 +1,31 @@
+"""Таблица bot_fsm_states для состояний диалогов Telegram бота
+
+Revision ID: 0009
+Revises: 0008
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision = '0009'
+down_revision = '0008'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if sa.inspect(op.get_bind()).has_table('bot_fsm_states'):
+        return
+    op.create_table(
+        'bot_fsm_states',
+        sa.Column('key', sa.String(), primary_key=True),
+        sa.Column('state', sa.String(), nullable=True),
+        sa.Column('data', postgresql.JSONB(), nullable=False, server_default='{}'),
+        sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+    )
+    op.create_index('idx_bot_fsm_states_expires_at', 'bot_fsm_states', ['expires_at'])
+
+
+def downgrade() -> None:
+    op.drop_table('bot_fsm_states')
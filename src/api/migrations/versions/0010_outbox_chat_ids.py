@@ -0,0 +1,24 @@
+"""Сохраненные получатели уведомлений в notification_outbox
+
+Revision ID: 0010
+Revises: 0009
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+revision = '0010'
+down_revision = '0009'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    columns = {column['name'] for column in sa.inspect(op.get_bind()).get_columns('notification_outbox')}
+    if 'chat_ids' not in columns:
+        op.add_column('notification_outbox', sa.Column('chat_ids', postgresql.JSONB(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('notification_outbox', 'chat_ids')
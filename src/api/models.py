@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Index, ForeignKey, inspect, event
+from sqlalchemy import DDL, Column, Integer, String, Float, Boolean, DateTime, Index, ForeignKey, event
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import relationship
-from datetime import datetime
+from datetime import datetime, timedelta
 from db import Base
 import secrets
 
@@ -17,6 +18,8 @@ class Product(Base):
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     price_history = relationship("PriceHistory", back_populates="product", cascade="all, delete-orphan")
+    # Статистика читается вместе с товаром (LEFT JOIN по первичному ключу)
+    price_stats = relationship("ProductPriceStats", uselist=False, lazy="joined", viewonly=True)
 
     __table_args__ = (
         Index('idx_price_rating', 'price', 'rating'),
@@ -25,19 +28,47 @@ class Product(Base):
 class PriceHistory(Base):
     __tablename__ = "price_history"
 
-    id = Column(Integer, primary_key=True)
+    # Таблица секционирована по created_at (см. partitions.py), поэтому created_at входит в первичный ключ
+    id = Column(Integer, primary_key=True, autoincrement=True)
     product_id = Column(Integer, ForeignKey('products.id', ondelete='CASCADE'))
     price = Column(Float, nullable=False)
     total_quantity = Column(Integer)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, primary_key=True, default=datetime.utcnow)
 
     product = relationship("Product", back_populates="price_history")
 
     __table_args__ = (
         Index('idx_price_history_date', 'created_at'),
         Index('idx_price_history_product', 'product_id', 'created_at'),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
     )
 
+class ProductPriceStats(Base):
+    """Статистика цен товара, обновляется при записи результатов обновления (см. price_stats.py)"""
+    __tablename__ = "product_price_stats"
+
+    product_id = Column(Integer, ForeignKey('products.id', ondelete='CASCADE'), primary_key=True)
+    # Минимальная и максимальная цена за все время наблюдения, не зависят от срока хранения истории
+    lowest_price = Column(Float)
+    lowest_price_at = Column(DateTime)
+    highest_price = Column(Float)
+    min_price_7d = Column(Float)
+    max_price_7d = Column(Float)
+    avg_price_7d = Column(Float)
+    min_price_30d = Column(Float)
+    max_price_30d = Column(Float)
+    avg_price_30d = Column(Float)
+    min_price_90d = Column(Float)
+    max_price_90d = Column(Float)
+    avg_price_90d = Column(Float)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+def default_next_check_at(context):
+    """Следующая проверка по умолчанию: last_checked_at + frequency_minutes"""
+    params = context.get_current_parameters()
+    last_checked_at = params.get('last_checked_at') or datetime.utcnow()
+    return last_checked_at + timedelta(minutes=params.get('frequency_minutes') or 30)
+
 class Subscription(Base):
     __tablename__ = "subscriptions"
 
@@ -46,23 +77,32 @@ class Subscription(Base):
     is_active = Column(Boolean, default=True)
     frequency_minutes = Column(Integer, default=30)
     last_checked_at = Column(DateTime, default=datetime.utcnow)
+    # Время следующей проверки, всегда равно last_checked_at + frequency_minutes
+    next_check_at = Column(DateTime, default=default_next_check_at)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     __table_args__ = (
         Index('idx_active_subscriptions', 'is_active', 'last_checked_at'),
+        Index('idx_subscriptions_next_check', 'next_check_at', 'id', postgresql_where=is_active == True),
     )
 
+    def schedule_next_check(self):
+        """Пересчитывает next_check_at после изменения last_checked_at или frequency_minutes"""
+        self.next_check_at = (self.last_checked_at or datetime.utcnow()) + timedelta(minutes=self.frequency_minutes or 30)
+
 class TaskLog(Base):
     __tablename__ = "task_logs"
 
-    id = Column(Integer, primary_key=True)
+    # Таблица секционирована по created_at (см. partitions.py), поэтому created_at входит в первичный ключ
+    id = Column(Integer, primary_key=True, autoincrement=True)
     artikul = Column(String, index=True)
     status = Column(String)  # success/error
     message = Column(String, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    created_at = Column(DateTime, primary_key=True, default=datetime.utcnow)
 
     __table_args__ = (
         Index('idx_task_logs_date_status', 'created_at', 'status'),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
     )
 
 class ApiKey(Base):
@@ -72,6 +112,10 @@ class ApiKey(Base):
     key = Column(String, unique=True, index=True, nullable=False)
     name = Column(String, nullable=True)
     is_active = Column(Boolean, default=True)
+    # Класс приоритета для лимитов запросов: internal (без лимита), interactive, bulk
+    priority = Column(String, nullable=False, default='interactive', server_default='interactive')
+    # Лимит запросов в минуту, NULL - лимит по умолчанию для класса приоритета
+    rate_limit_per_minute = Column(Integer, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     __table_args__ = (
@@ -88,6 +132,58 @@ class UserSubscription(Base):
 
     __table_args__ = (
         Index('idx_user_subscriptions', 'chat_id', 'artikul', unique=True),
+        # Выборка подписчиков по артикулу только из индекса (уникальный индекс начинается с chat_id)
+        Index('idx_user_subscriptions_artikul', 'artikul', 'chat_id'),
+    )
+
+class RateLimitState(Base):
+    """Состояние общего лимитера запросов (middleware.PostgresRateLimitBackend)"""
+    __tablename__ = "rate_limits"
+
+    key = Column(String, primary_key=True)
+    # Теоретическое время следующего запроса (GCRA), секунды от эпохи по часам сервера БД
+    tat = Column(Float, nullable=False)
+
+    # Состояние лимитов не нужно переживать падение сервера, WAL для него не пишется
+    __table_args__ = {'prefixes': ['UNLOGGED']}
+
+class OutboxEvent(Base):
+    """Уведомление об изменении товара, ожидающее доставки в бот (см. outbox.py)"""
+    __tablename__ = "notification_outbox"
+
+    id = Column(Integer, primary_key=True)
+    event_type = Column(String, nullable=False)  # price_change/quantity_change
+    artikul = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False)
+    # chat_id подписчиков, сохраненные при первой попытке доставки: повторы отправляются
+    # тем же получателям теми же страницами, даже если подписки за это время изменились
+    chat_ids = Column(JSONB, nullable=True)
+    # Передается боту в поле idempotency_key каждого события в JSON теле запроса: повторная доставка
+    # не дублирует сообщения. Если получатели разбиты на несколько страниц, ключ страницы - <ключ>:<номер>
+    idempotency_key = Column(String, nullable=False, unique=True)
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    # Время следующей попытки доставки, NULL - попытки исчерпаны
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    delivered_at = Column(DateTime, nullable=True)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('idx_outbox_pending', 'next_attempt_at', 'id', postgresql_where=delivered_at.is_(None)),
+    )
+
+class BotFsmState(Base):
+    """Состояние диалога Telegram бота (хранилище FSM бота, см. bot/fsm_storage.py)"""
+    __tablename__ = "bot_fsm_states"
+
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(JSONB, nullable=False, server_default='{}')
+    # Состояние без активности дольше FSM_STATE_TTL бота считается сброшенным
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+    __table_args__ = (
+        Index('idx_bot_fsm_states_expires_at', 'expires_at'),
     )
 
 @event.listens_for(ApiKey, 'before_insert')
@@ -95,20 +191,28 @@ def generate_api_key(mapper, connection, target):
     if not target.key:
         target.key = secrets.token_urlsafe(32)
 
-@event.listens_for(Product, 'after_update')
-def track_price_changes(mapper, connection, target):
-    """Отслеживает изменения цены товара и создает запись в истории"""
-    state = inspect(target)
-    
-    if state.attrs.price.history.has_changes():
-        old_price = state.attrs.price.history.deleted[0] if state.attrs.price.history.deleted else None
-        new_price = target.price
-        
-        if old_price is not None and old_price != new_price:
-            connection.execute(
-                PriceHistory.__table__.insert().values(
-                    product_id=target.id,
-                    price=new_price,
-                    total_quantity=target.total_quantity
-                )
-            )
+# Уведомляет кэш API ключей (auth_cache.py) об изменении или удалении ключа
+API_KEYS_NOTIFY_FUNCTION = DDL(
+    """
+    CREATE OR REPLACE FUNCTION notify_api_keys_changed() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            PERFORM pg_notify('api_keys_changed', OLD.key);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            PERFORM pg_notify('api_keys_changed', NEW.key);
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """
+)
+API_KEYS_NOTIFY_TRIGGER = DDL(
+    """
+    CREATE OR REPLACE TRIGGER api_keys_changed
+    AFTER INSERT OR UPDATE OR DELETE ON api_keys
+    FOR EACH ROW EXECUTE FUNCTION notify_api_keys_changed()
+    """
+)
+event.listen(ApiKey.__table__, 'after_create', API_KEYS_NOTIFY_FUNCTION)
+event.listen(ApiKey.__table__, 'after_create', API_KEYS_NOTIFY_TRIGGER)
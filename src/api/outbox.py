@@ -0,0 +1,236 @@
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, update, func
+
+from db import AsyncSessionLocal
+from http_client import bot_pool, BOT_API_URL
+from models import OutboxEvent
+from crud import get_subscribers_by_artikuls
+
+logger = logging.getLogger(__name__)
+
+# Сколько уведомлений забирается из outbox за раз
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+# Как часто запускается доставка (секунды)
+OUTBOX_DISPATCH_INTERVAL = float(os.getenv('OUTBOX_DISPATCH_INTERVAL', '5'))
+# Сколько раз пытаться доставить уведомление, прежде чем отложить его как недоставленное
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))
+# Пауза перед повторной попыткой удваивается с каждой попыткой от OUTBOX_RETRY_BASE до OUTBOX_RETRY_MAX (секунды)
+OUTBOX_RETRY_BASE = float(os.getenv('OUTBOX_RETRY_BASE', '5'))
+OUTBOX_RETRY_MAX = float(os.getenv('OUTBOX_RETRY_MAX', '600'))
+# На сколько секунд забранное уведомление скрывается от других диспетчеров
+OUTBOX_CLAIM_LEASE = int(os.getenv('OUTBOX_CLAIM_LEASE', '60'))
+
+# Сколько chat_id подписчиков передается боту в одном запросе: аудитория уведомления
+# больше этого числа делится на страницы, которые отправляются отдельными запросами
+OUTBOX_CHAT_IDS_PER_REQUEST = int(os.getenv('OUTBOX_CHAT_IDS_PER_REQUEST', '10000'))
+
+# Эндпоинт бота, принимающий пачку уведомлений
+BOT_NOTIFY_BATCH_URL = f"{BOT_API_URL}/api/v1/notify/batch"
+
+
+def retry_delay(attempts: int) -> float:
+    return min(OUTBOX_RETRY_BASE * 2 ** max(attempts - 1, 0), OUTBOX_RETRY_MAX)
+
+
+async def claim_events(session, now: datetime, limit: int = OUTBOX_BATCH_SIZE) -> List[OutboxEvent]:
+    """
+    Забирает пачку недоставленных уведомлений, у которых наступило время попытки.
+    Как и в claim_due_subscriptions, строки выбираются через FOR UPDATE SKIP LOCKED,
+    а next_attempt_at сдвигается на время аренды: если диспетчер упадет, уведомление
+    снова станет доступным после её окончания
+    """
+    due = (
+        select(OutboxEvent.id)
+        .where(OutboxEvent.delivered_at.is_(None), OutboxEvent.next_attempt_at <= now)
+        .order_by(OutboxEvent.next_attempt_at, OutboxEvent.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    result = await session.execute(
+        update(OutboxEvent)
+        .where(OutboxEvent.id.in_(due))
+        .values(
+            next_attempt_at=now + timedelta(seconds=OUTBOX_CLAIM_LEASE),
+            attempts=OutboxEvent.attempts + 1
+        )
+        .returning(OutboxEvent)
+        .execution_options(synchronize_session=False)
+    )
+    events = sorted(result.scalars().all(), key=lambda event: event.id)
+    await session.commit()
+    return events
+
+
+async def snapshot_recipients(session, events: List[OutboxEvent]):
+    """
+    Сохраняет в уведомлениях chat_id подписчиков при первой попытке доставки.
+    Подписчики всех товаров выбираются одним запросом. Повторные попытки используют сохраненный
+    список, поэтому страницы и их ключи (<ключ>:<номер>) не сдвигаются, если между попытками
+    кто-то подписался или отписался
+    """
+    pending = [event for event in events if event.chat_ids is None]
+    if not pending:
+        return
+    subscribers = await get_subscribers_by_artikuls(session, [event.artikul for event in pending])
+    for event in pending:
+        event.chat_ids = subscribers.get(event.artikul, [])
+    await session.commit()
+
+
+def build_requests(events: List[OutboxEvent], page_size: int = OUTBOX_CHAT_IDS_PER_REQUEST) -> List[List[dict]]:
+    """
+    Раскладывает уведомления с сохраненными списками подписчиков по запросам к боту, не более
+    page_size chat_id в запросе. Уведомление с большей аудиторией делится на страницы, у каждой
+    свой idempotency_key. Уведомления без подписчиков не отправляются
+    """
+    requests, current, size = [], [], 0
+    for event in events:
+        chat_ids = event.chat_ids or []
+        pages = [chat_ids[start:start + page_size] for start in range(0, len(chat_ids), page_size)]
+        for number, page in enumerate(pages):
+            if current and size + len(page) > page_size:
+                requests.append(current)
+                current, size = [], 0
+            current.append({
+                "event_type": event.event_type,
+                "idempotency_key": event.idempotency_key if len(pages) == 1 else f"{event.idempotency_key}:{number}",
+                "payload": event.payload,
+                "chat_ids": page
+            })
+            size += len(page)
+    if current:
+        requests.append(current)
+    return requests
+
+
+def rejected_events(events: List[OutboxEvent], results: List[dict]) -> Dict[int, str]:
+    """
+    Уведомления, которые бот отклонил как некорректные: {id уведомления: причина}.
+    Ключ страницы (<ключ>:<номер>) относится к уведомлению с ключом <ключ>
+    """
+    by_key = {event.idempotency_key: event.id for event in events}
+    rejected: Dict[int, str] = {}
+    for result in results:
+        if result.get("status") != "rejected":
+            continue
+        key = result.get("idempotency_key") or ""
+        event_id = by_key.get(key, by_key.get(key.rsplit(":", 1)[0]))
+        if event_id is not None:
+            rejected[event_id] = f"Rejected by bot: {result.get('error')}"
+    return rejected
+
+
+async def deliver(session, events: List[OutboxEvent]) -> Tuple[Optional[str], Dict[int, str]]:
+    """
+    Отправляет пачку уведомлений в бот. Подписчики передаются вместе с уведомлениями
+    (см. snapshot_recipients), поэтому боту не нужно обращаться к API.
+    Бот объединяет уведомления для одного чата и пропускает уже обработанные по idempotency_key.
+    Возвращает (текст ошибки или None при успехе, отклоненные ботом уведомления)
+    """
+    await snapshot_recipients(session, events)
+    rejected: Dict[int, str] = {}
+    try:
+        for request in build_requests(events):
+            response = await bot_pool.client.post(BOT_NOTIFY_BATCH_URL, json={"events": request})
+            if response.status_code >= 300:
+                return f"HTTP {response.status_code}", rejected
+            rejected.update(rejected_events(events, response.json().get("results", [])))
+        return None, rejected
+    except Exception as e:
+        return f"{type(e).__name__}: {e}", rejected
+
+
+async def record_results(session, events: List[OutboxEvent], error: Optional[str], now: datetime,
+                         rejected: Optional[Dict[int, str]] = None):
+    """
+    Отмечает пачку доставленной или назначает уведомлениям пачки следующую попытку.
+    Отклоненные ботом уведомления (rejected) не повторяются: они сразу откладываются
+    как недоставленные, на остальные уведомления пачки это не влияет
+    """
+    rejected = rejected or {}
+    for event_id, reason in rejected.items():
+        logger.error(f"Notification {event_id} rejected, not retrying: {reason}")
+        await session.execute(
+            update(OutboxEvent)
+            .where(OutboxEvent.id == event_id)
+            .values(next_attempt_at=None, last_error=reason[:1000])
+            .execution_options(synchronize_session=False)
+        )
+    events = [event for event in events if event.id not in rejected]
+    if error is None:
+        await session.execute(
+            update(OutboxEvent)
+            .where(OutboxEvent.id.in_([event.id for event in events]))
+            .values(delivered_at=now, last_error=None)
+            .execution_options(synchronize_session=False)
+        )
+    else:
+        by_attempt: Dict[Optional[datetime], List[int]] = {}
+        for event in events:
+            if event.attempts >= OUTBOX_MAX_ATTEMPTS:
+                logger.error(f"Giving up on {event.event_type} event {event.id} for {event.artikul}: {error}")
+                next_attempt_at = None
+            else:
+                next_attempt_at = now + timedelta(seconds=retry_delay(event.attempts))
+            by_attempt.setdefault(next_attempt_at, []).append(event.id)
+        for next_attempt_at, ids in by_attempt.items():
+            await session.execute(
+                update(OutboxEvent)
+                .where(OutboxEvent.id.in_(ids))
+                .values(next_attempt_at=next_attempt_at, last_error=error[:1000])
+                .execution_options(synchronize_session=False)
+            )
+    await session.commit()
+
+
+async def dispatch_outbox(deadline: float = OUTBOX_DISPATCH_INTERVAL * 10) -> Dict[str, int]:
+    """
+    Доставляет накопленные уведомления пачками по OUTBOX_BATCH_SIZE,
+    пока они не закончатся или не выйдет время. Если бот не принял пачку, доставка
+    прерывается до следующего запуска: уведомления остаются в outbox
+    """
+    started = time.monotonic()
+    stats = {"delivered": 0, "failed": 0, "rejected": 0}
+    while time.monotonic() - started < deadline:
+        async with AsyncSessionLocal() as session:
+            events = await claim_events(session, datetime.utcnow())
+            if not events:
+                break
+            error, rejected = await deliver(session, events)
+            await record_results(session, events, error, datetime.utcnow(), rejected)
+
+        stats["rejected"] += len(rejected)
+        if error is not None:
+            stats["failed"] += len(events) - len(rejected)
+            logger.warning(f"Bot did not accept {len(events)} notifications, will retry later: {error}")
+            break
+        stats["delivered"] += len(events) - len(rejected)
+        if len(events) < OUTBOX_BATCH_SIZE:
+            break
+
+    if stats["delivered"] or stats["failed"] or stats["rejected"]:
+        logger.info(f"Outbox dispatch: {stats}")
+    return stats
+
+
+async def outbox_stats(session) -> Dict[str, object]:
+    """Размер очереди уведомлений и возраст самого старого недоставленного"""
+    result = await session.execute(
+        select(
+            func.count().filter(OutboxEvent.next_attempt_at.is_not(None)),
+            func.count().filter(OutboxEvent.next_attempt_at.is_(None)),
+            func.min(OutboxEvent.created_at)
+        ).where(OutboxEvent.delivered_at.is_(None))
+    )
+    pending, failed, oldest = result.one()
+    return {
+        "pending": pending,
+        "failed": failed,
+        "oldest_pending_age": round((datetime.utcnow() - oldest).total_seconds(), 1) if oldest else 0.0
+    }
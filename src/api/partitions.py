@@ -0,0 +1,158 @@
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Таблицы, секционированные по created_at
+PARTITIONED_TABLES = ("price_history", "task_logs")
+# Размер секции: month или day
+PARTITION_INTERVAL = os.getenv('PARTITION_INTERVAL', 'month')
+# На сколько периодов вперед создаются секции
+PARTITIONS_AHEAD = int(os.getenv('PARTITIONS_AHEAD', '3'))
+PARTITION_LOCK_ID = 7301002
+
+_UPPER_BOUND_RE = re.compile(r"TO \('([^']+)'\)")
+
+
+def period_start(moment: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    """Начало периода секции, в который попадает moment"""
+    if interval == 'day':
+        return datetime(moment.year, moment.month, moment.day)
+    return datetime(moment.year, moment.month, 1)
+
+
+def next_period(start: datetime, interval: str = PARTITION_INTERVAL) -> datetime:
+    if interval == 'day':
+        return start + timedelta(days=1)
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def partition_name(table: str, start: datetime, interval: str = PARTITION_INTERVAL) -> str:
+    suffix = start.strftime('%Y%m%d') if interval == 'day' else start.strftime('%Y%m')
+    return f"{table}_p{suffix}"
+
+
+def partition_ranges(since: datetime, until: datetime,
+                     interval: str = PARTITION_INTERVAL) -> List[Tuple[datetime, datetime]]:
+    """Диапазоны [start, end) секций, покрывающие промежуток от since до until"""
+    ranges = []
+    start = period_start(since, interval)
+    while start <= until:
+        end = next_period(start, interval)
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+def range_partition_ddl(table: str, start: datetime, end: datetime, interval: str = PARTITION_INTERVAL) -> str:
+    return (
+        f"CREATE TABLE IF NOT EXISTS {partition_name(table, start, interval)} PARTITION OF {table} "
+        f"FOR VALUES FROM ('{start.isoformat(sep=' ')}') TO ('{end.isoformat(sep=' ')}')"
+    )
+
+
+def partition_ddl(table: str, since: datetime, until: datetime,
+                  interval: str = PARTITION_INTERVAL) -> List[str]:
+    """CREATE TABLE ... PARTITION OF для всех секций промежутка и секция по умолчанию"""
+    statements = [f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"]
+    for start, end in partition_ranges(since, until, interval):
+        statements.append(range_partition_ddl(table, start, end, interval))
+    return statements
+
+
+def ahead_until(now: Optional[datetime] = None) -> datetime:
+    """Граница, до которой секции должны существовать заранее"""
+    until = period_start(now or datetime.utcnow())
+    for _ in range(PARTITIONS_AHEAD):
+        until = next_period(until)
+    return until
+
+
+async def is_partitioned(conn, table: str) -> bool:
+    result = await conn.execute(
+        text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(:table)"),
+        {"table": table}
+    )
+    return result.scalar() is not None
+
+
+async def move_default_rows(conn, table: str, start: datetime, end: datetime,
+                            interval: str = PARTITION_INTERVAL) -> int:
+    """
+    Создает секцию [start, end), если за этот период уже есть строки в секции по умолчанию
+    (секции не создавались вовремя). Postgres не позволяет создать такую секцию, пока строки
+    лежат в секции по умолчанию, поэтому она отсоединяется, строки периода переносятся
+    через родительскую таблицу в новую секцию и секция по умолчанию присоединяется обратно.
+    Возвращает число перенесенных строк
+    """
+    default = f"{table}_default"
+    if (await conn.execute(text("SELECT to_regclass(:name)"), {"name": default})).scalar() is None:
+        return 0
+    if (await conn.execute(
+        text("SELECT to_regclass(:name)"), {"name": partition_name(table, start, interval)}
+    )).scalar() is not None:
+        return 0
+    bounds = {"start": start, "end": end}
+    in_period = "created_at >= :start AND created_at < :end"
+    if (await conn.execute(text(f"SELECT 1 FROM {default} WHERE {in_period} LIMIT 1"), bounds)).scalar() is None:
+        return 0
+
+    await conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {default}"))
+    await conn.execute(text(range_partition_ddl(table, start, end, interval)))
+    result = await conn.execute(
+        text(f"WITH moved AS (DELETE FROM {default} WHERE {in_period} RETURNING *) INSERT INTO {table} SELECT * FROM moved"),
+        bounds
+    )
+    await conn.execute(text(f"ALTER TABLE {table} ATTACH PARTITION {default} DEFAULT"))
+    logger.warning(
+        f"Moved {result.rowcount} rows of {table} from the default partition "
+        f"to {partition_name(table, start, interval)}"
+    )
+    return result.rowcount
+
+
+async def ensure_partitions(conn, now: Optional[datetime] = None):
+    """Создает секции от текущего периода на PARTITIONS_AHEAD периодов вперед"""
+    now = now or datetime.utcnow()
+    # Несколько процессов могут стартовать одновременно, DDL выполняет один из них
+    await conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": PARTITION_LOCK_ID})
+    for table in PARTITIONED_TABLES:
+        if not await is_partitioned(conn, table):
+            logger.warning(f"Table {table} is not partitioned, run migrations to convert it")
+            continue
+        for start, end in partition_ranges(now, ahead_until(now)):
+            await move_default_rows(conn, table, start, end)
+        for statement in partition_ddl(table, now, ahead_until(now)):
+            await conn.execute(text(statement))
+
+
+async def drop_expired_partitions(conn, table: str, older_than: datetime) -> List[str]:
+    """Удаляет секции таблицы, все строки которых старше older_than. Возвращает имена удаленных секций"""
+    result = await conn.execute(
+        text(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(:table)
+            """
+        ),
+        {"table": table}
+    )
+    dropped = []
+    for name, bound in result.all():
+        match = _UPPER_BOUND_RE.search(bound or "")
+        if match is None:  # секция по умолчанию
+            continue
+        if datetime.fromisoformat(match.group(1)) <= older_than:
+            await conn.execute(text(f'ALTER TABLE {table} DETACH PARTITION "{name}"'))
+            await conn.execute(text(f'DROP TABLE "{name}"'))
+            dropped.append(name)
+    if dropped:
+        logger.info(f"Dropped expired partitions of {table}: {', '.join(dropped)}")
+    return dropped
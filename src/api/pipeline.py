@@ -0,0 +1,166 @@
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import update, func, literal, DateTime
+from sqlalchemy.dialects.postgresql import insert
+
+from models import Product, PriceHistory, Subscription, TaskLog, OutboxEvent
+from tasks import chunked
+from price_stats import refresh_price_stats
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк передается в одном многострочном INSERT (asyncpg ограничивает число параметров запроса)
+WRITE_CHUNK_SIZE = int(os.getenv('WRITE_CHUNK_SIZE', '1000'))
+
+
+class RefreshWriter:
+    """
+    Накапливает результаты тика обновления и записывает их одной транзакцией:
+    upsert товаров, многострочные INSERT в price_history и task_logs,
+    пересчет статистики цен записанных товаров и уведомления для бота в notification_outbox
+    и один UPDATE времени проверки успешных подписок.
+    """
+
+    def __init__(self):
+        self.products: Dict[str, dict] = {}
+        self.price_changes: Dict[str, dict] = {}
+        self.task_logs: List[dict] = []
+        self.checked: Dict[str, datetime] = {}
+        self.events: List[dict] = []
+
+    def add_product(self, product_data: dict, old_price: Optional[float] = None):
+        """Добавляет свежие данные товара; при изменении цены добавляет запись в историю цен"""
+        artikul = product_data["artikul"]
+        now = datetime.utcnow()
+        self.products[artikul] = {
+            "artikul": artikul,
+            "name": product_data["name"],
+            "price": product_data["price"],
+            "rating": product_data["rating"],
+            "total_quantity": product_data["total_quantity"],
+            "created_at": now,
+            "updated_at": now
+        }
+        if old_price is not None and old_price != product_data["price"]:
+            self.price_changes[artikul] = {
+                "price": product_data["price"],
+                "total_quantity": product_data["total_quantity"],
+                "created_at": now
+            }
+
+    def add_log(self, artikul: str, status: str, message: str):
+        self.task_logs.append({
+            "artikul": artikul,
+            "status": status,
+            "message": message,
+            "created_at": datetime.utcnow()
+        })
+
+    def add_event(self, event_type: str, artikul: str, payload: dict):
+        """Добавляет уведомление для бота: оно попадет в outbox в той же транзакции, что и товар"""
+        now = datetime.utcnow()
+        self.events.append({
+            "event_type": event_type,
+            "artikul": artikul,
+            "payload": payload,
+            "idempotency_key": uuid.uuid4().hex,
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now
+        })
+
+    def mark_checked(self, artikul: str, checked_at: datetime):
+        self.checked[artikul] = checked_at
+
+    def __len__(self):
+        return len(self.products) + len(self.task_logs) + len(self.checked) + len(self.events)
+
+    async def flush(self, session) -> Dict[str, int]:
+        """Записывает накопленные данные одной транзакцией и очищает буферы"""
+        counts = {"products": 0, "price_history": 0, "price_stats": 0, "task_logs": 0, "subscriptions": 0, "events": 0}
+        try:
+            product_ids = await self._upsert_products(session)
+            counts["products"] = len(product_ids)
+
+            history_rows = [
+                {"product_id": product_ids[artikul], **row}
+                for artikul, row in self.price_changes.items()
+                if artikul in product_ids
+            ]
+            for rows in chunked(history_rows, WRITE_CHUNK_SIZE):
+                await session.execute(insert(PriceHistory).values(rows))
+            counts["price_history"] = len(history_rows)
+
+            counts["price_stats"] = await refresh_price_stats(session, product_ids.values())
+
+            for rows in chunked(self.task_logs, WRITE_CHUNK_SIZE):
+                await session.execute(insert(TaskLog).values(rows))
+            counts["task_logs"] = len(self.task_logs)
+
+            counts["subscriptions"] = await self._mark_subscriptions_checked(session)
+
+            for rows in chunked(self.events, WRITE_CHUNK_SIZE):
+                await session.execute(insert(OutboxEvent).values(rows))
+            counts["events"] = len(self.events)
+
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+
+        self.products.clear()
+        self.price_changes.clear()
+        self.task_logs.clear()
+        self.checked.clear()
+        self.events.clear()
+        logger.info(f"Refresh results written: {counts}")
+        return counts
+
+    async def _upsert_products(self, session) -> Dict[str, int]:
+        """INSERT ... ON CONFLICT (artikul) DO UPDATE, возвращает {artikul: product_id}"""
+        product_ids = {}
+        for rows in chunked(list(self.products.values()), WRITE_CHUNK_SIZE):
+            stmt = insert(Product).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Product.artikul],
+                set_={
+                    "name": stmt.excluded.name,
+                    "price": stmt.excluded.price,
+                    "rating": stmt.excluded.rating,
+                    "total_quantity": stmt.excluded.total_quantity,
+                    "updated_at": stmt.excluded.updated_at
+                }
+            ).returning(Product.id, Product.artikul)
+            result = await session.execute(stmt)
+            product_ids.update({artikul: product_id for product_id, artikul in result.all()})
+        return product_ids
+
+    async def _mark_subscriptions_checked(self, session) -> int:
+        """Обновляет last_checked_at и next_check_at успешно обновленных подписок"""
+        by_time: Dict[datetime, List[str]] = {}
+        for artikul, checked_at in self.checked.items():
+            by_time.setdefault(checked_at, []).append(artikul)
+
+        updated = 0
+        for checked_at, artikuls in by_time.items():
+            for chunk in chunked(artikuls, WRITE_CHUNK_SIZE):
+                updated += await self._update_checked(session, chunk, checked_at)
+        return updated
+
+    async def _update_checked(self, session, artikuls: List[str], checked_at: datetime) -> int:
+        result = await session.execute(
+            update(Subscription)
+            .where(Subscription.artikul.in_(artikuls))
+            .values(
+                last_checked_at=checked_at,
+                next_check_at=literal(checked_at, DateTime) + func.make_interval(
+                    0, 0, 0, 0, 0, Subscription.frequency_minutes
+                )
+            )
+            .execution_options(synchronize_session=False)
+        )
+        return result.rowcount
@@ -0,0 +1,112 @@
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy import select, text
+
+from db import AsyncSessionLocal
+from models import ProductPriceStats
+
+logger = logging.getLogger(__name__)
+
+# Окна статистики в днях, для каждого в product_price_stats есть колонки min/max/avg_price_<N>d
+PRICE_STATS_WINDOWS = (7, 30, 90)
+# Статистика товаров, которые не обновлялись дольше этого времени, пересчитывается ночной задачей (часы)
+PRICE_STATS_STALE_HOURS = int(os.getenv('PRICE_STATS_STALE_HOURS', '24'))
+# Сколько товаров пересчитывается одним запросом
+PRICE_STATS_CHUNK_SIZE = int(os.getenv('PRICE_STATS_CHUNK_SIZE', '1000'))
+
+
+def _window_columns() -> List[str]:
+    return [
+        f"{name}_price_{days}d"
+        for days in PRICE_STATS_WINDOWS
+        for name in ("min", "max", "avg")
+    ]
+
+
+def _window_aggregates() -> List[str]:
+    return [
+        f"{name}(price) FILTER (WHERE created_at >= CAST(:now AS timestamp) - interval '{days} days')"
+        for days in PRICE_STATS_WINDOWS
+        for name in ("min", "max", "avg")
+    ]
+
+
+# Точки статистики: записи истории цен за самое длинное окно и текущая цена товара.
+# Минимальная и максимальная цена за все время копятся в строке статистики (LEAST/GREATEST),
+# поэтому переживают удаление старой истории; оконные значения пересчитываются целиком
+REFRESH_SQL = text(
+    f"""
+    WITH points AS (
+        SELECT product_id, price, created_at FROM price_history
+        WHERE product_id = ANY(:ids)
+          AND created_at >= CAST(:now AS timestamp) - interval '{max(PRICE_STATS_WINDOWS)} days'
+        UNION ALL
+        SELECT id, price, CAST(:now AS timestamp) FROM products
+        WHERE id = ANY(:ids) AND price IS NOT NULL
+    )
+    INSERT INTO product_price_stats AS s (
+        product_id, lowest_price, lowest_price_at, highest_price, {", ".join(_window_columns())}, updated_at
+    )
+    SELECT
+        product_id,
+        min(price),
+        (array_agg(created_at ORDER BY price, created_at))[1],
+        max(price),
+        {", ".join(_window_aggregates())},
+        CAST(:now AS timestamp)
+    FROM points
+    GROUP BY product_id
+    ON CONFLICT (product_id) DO UPDATE SET
+        lowest_price = LEAST(s.lowest_price, EXCLUDED.lowest_price),
+        lowest_price_at = CASE
+            WHEN s.lowest_price IS NULL OR EXCLUDED.lowest_price < s.lowest_price THEN EXCLUDED.lowest_price_at
+            ELSE s.lowest_price_at
+        END,
+        highest_price = GREATEST(s.highest_price, EXCLUDED.highest_price),
+        {", ".join(f"{column} = EXCLUDED.{column}" for column in _window_columns())},
+        updated_at = EXCLUDED.updated_at
+    """
+)
+
+
+async def refresh_price_stats(session, product_ids: List[int], now: datetime = None) -> int:
+    """
+    Пересчитывает статистику цен товаров в текущей транзакции (без commit).
+    Вызывается в пути записи обновлений, после записи товаров и истории цен
+    """
+    now = now or datetime.utcnow()
+    product_ids = list(product_ids)
+    for start in range(0, len(product_ids), PRICE_STATS_CHUNK_SIZE):
+        await session.execute(REFRESH_SQL, {"ids": product_ids[start:start + PRICE_STATS_CHUNK_SIZE], "now": now})
+    return len(product_ids)
+
+
+async def refresh_stale_price_stats() -> int:
+    """
+    Пересчитывает статистику товаров, которые давно не обновлялись:
+    окна 7/30/90 дней сдвигаются, даже если новых цен нет
+    """
+    now = datetime.utcnow()
+    cutoff = now - timedelta(hours=PRICE_STATS_STALE_HOURS)
+    refreshed = 0
+    last_id = 0
+    async with AsyncSessionLocal() as session:
+        while True:
+            result = await session.execute(
+                select(ProductPriceStats.product_id)
+                .where(ProductPriceStats.updated_at < cutoff)
+                .where(ProductPriceStats.product_id > last_id)
+                .order_by(ProductPriceStats.product_id)
+                .limit(PRICE_STATS_CHUNK_SIZE)
+            )
+            product_ids = result.scalars().all()
+            if not product_ids:
+                break
+            refreshed += await refresh_price_stats(session, product_ids, now)
+            await session.commit()
+            last_id = product_ids[-1]
+    logger.info(f"Refreshed price stats of {refreshed} stale products")
+    return refreshed
@@ -1,11 +1,14 @@
-from fastapi import APIRouter, Depends, HTTPException, Path, Query
+import os
+import re
+from fastapi import APIRouter, Depends, HTTPException, Path, Query, Header, Request, Response
 from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Union, List, Optional
 from sqlalchemy import select, and_, delete
-from datetime import datetime
+from datetime import datetime, timezone
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
-from crud import create_product, create_or_update_subscription, update_subscription_frequency, get_all_products, get_all_subscriptions
+from crud import create_product, get_price_history as fetch_price_history, get_price_history_ohlc, get_fresh_product, get_products_batch, create_or_update_subscription, update_subscription_frequency, list_products, list_subscriptions, get_subscribers_page, PRODUCT_SORT_COLUMNS
 from db import get_db
 from schemas import (
     ProductCreate, 
@@ -16,14 +19,63 @@ from schemas import (
     UpdateFrequencyRequest,
     ErrorResponse,
     RateLimitResponse,
-    ProductPriceHistory
+    ProductPriceHistory,
+    ProductBatchRequest,
+    ProductBatchResponse,
+    SubscribersBatchRequest,
+    SubscribersBatchResponse,
+    PRODUCT_BATCH_MAX_SIZE
 )
 from auth import get_api_key
-from models import Product, PriceHistory, Subscription, TaskLog, UserSubscription
+from auth_cache import api_key_cache
+from http_client import get_http_pool_stats
+from leader import leader_elector
+from export import EXPORT_FORMATS, stream_query, products_export_query, price_history_export_query
+from singleflight import wb_flight
+from outbox import outbox_stats
+from models import Product, Subscription, TaskLog, UserSubscription
 
 router_product = APIRouter(tags=["Products"])
+router_system = APIRouter(tags=["System"])
 
+# Сколько секунд данные товара в базе считаются свежими для POST /api/v1/products (0 - всегда запрашивать WB)
+PRODUCT_CACHE_MAX_AGE = int(os.getenv('PRODUCT_CACHE_MAX_AGE', '300'))
 
+_MAX_AGE_RE = re.compile(r"max-age=(\d+)")
+
+def parse_max_age(cache_control: Optional[str]) -> Optional[int]:
+    """max-age из заголовка Cache-Control; no-cache и no-store означают 0"""
+    if not cache_control:
+        return None
+    directives = cache_control.lower()
+    if "no-cache" in directives or "no-store" in directives:
+        return 0
+    match = _MAX_AGE_RE.search(directives)
+    return int(match.group(1)) if match else None
+
+def to_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Время в UTC без часового пояса, как в колонках created_at; время без пояса считается UTC"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+PRODUCT_SORT_PATTERN = "^-?(" + "|".join(PRODUCT_SORT_COLUMNS) + ")$"
+
+def set_next_cursor(request: Request, response: Response, cursor: Optional[str]):
+    """Передает курсор следующей страницы в заголовках X-Next-Cursor и Link"""
+    if cursor is None:
+        return
+    response.headers["X-Next-Cursor"] = cursor
+    next_url = request.url.remove_query_params("skip").include_query_params(cursor=cursor)
+    response.headers["Link"] = f'<{next_url}>; rel="next"'
+
+EXPORT_FORMAT_PATTERN = "^(" + "|".join(EXPORT_FORMATS) + ")$"
+
+def resolve_max_age(max_age: Optional[int], cache_control: Optional[str]) -> int:
+    """Допустимый возраст данных: параметр max_age, затем Cache-Control, затем PRODUCT_CACHE_MAX_AGE"""
+    if max_age is None:
+        max_age = parse_max_age(cache_control)
+    return PRODUCT_CACHE_MAX_AGE if max_age is None else max_age
 
 @router_product.post(
     "/api/v1/products", 
@@ -34,6 +86,10 @@ router_product = APIRouter(tags=["Products"])
     
     - Если товар уже существует, обновляет информацию
     - Если товар не найден на Wildberries, возвращает статус ошибки
+    - Если товар обновлялся не раньше max_age секунд назад, возвращается из базы без запроса к Wildberries.
+      max_age задается параметром `?max_age=` или заголовком `Cache-Control: max-age=N`
+      (`Cache-Control: no-cache` - всегда запрашивать Wildberries)
+    - Заголовок ответа `X-Cache`: HIT (данные из базы) или MISS, `Age` - возраст данных в секундах
     """,
     responses={
         200: {
@@ -60,9 +116,21 @@ router_product = APIRouter(tags=["Products"])
 )
 async def create_product_endpoint(
     product: ProductCreate, 
+    response: Response,
+    max_age: Optional[int] = Query(None, ge=0, description="Допустимый возраст данных в секундах"),
+    cache_control: Optional[str] = Header(None),
     db: AsyncSession = Depends(get_db),
     api_key: str = Depends(get_api_key)
 ):
+    max_age = resolve_max_age(max_age, cache_control)
+    cached_product = await get_fresh_product(db, product.artikul, max_age)
+    if cached_product is not None:
+        response.headers["X-Cache"] = "HIT"
+        response.headers["Age"] = str(int((datetime.utcnow() - cached_product.updated_at).total_seconds()))
+        return cached_product
+
+    response.headers["X-Cache"] = "MISS"
+    response.headers["Age"] = "0"
     create_product_data = await create_product(db, product)
     if isinstance(create_product_data, dict) and create_product_data.get("status") == "Product not found":
         raise HTTPException(
@@ -71,6 +139,44 @@ async def create_product_endpoint(
         )
     return create_product_data
 
+@router_product.post(
+    "/api/v1/products/batch",
+    response_model=ProductBatchResponse,
+    summary="Получить информацию о нескольких товарах",
+    description=f"""
+    Возвращает данные сразу по списку артикулов (не более {PRODUCT_BATCH_MAX_SIZE}).
+    
+    - Результат по каждому артикулу отдельно: ошибка одного артикула не влияет на остальные
+    - Свежие товары (не старше max_age секунд) берутся из базы, остальные запрашиваются
+      у Wildberries пачками и сохраняются
+    - max_age задается так же, как для `POST /api/v1/products`
+    """,
+    responses={
+        401: {
+            "description": "Неверный API ключ",
+            "model": ErrorResponse
+        },
+        429: {
+            "description": "Превышен лимит запросов",
+            "model": RateLimitResponse
+        }
+    }
+)
+async def get_products_batch_endpoint(
+    request: ProductBatchRequest,
+    max_age: Optional[int] = Query(None, ge=0, description="Допустимый возраст данных в секундах"),
+    cache_control: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_db),
+    api_key: str = Depends(get_api_key)
+):
+    items = await get_products_batch(db, request.artikuls, resolve_max_age(max_age, cache_control))
+    return {
+        "items": items,
+        "found": sum(1 for item in items if item["status"] == "ok"),
+        "from_cache": sum(1 for item in items if item.get("source") == "cache"),
+        "failed": sum(1 for item in items if item["status"] != "ok")
+    }
+
 @router_product.get(
     "/api/v1/subscribe/{artikul}", 
     response_model=SubscriptionResponse,
@@ -130,7 +236,14 @@ async def subscribe_to_product(
     "/api/v1/products", 
     response_model=List[ProductResponse],
     summary="Получить список всех товаров",
-    description="Возвращает список всех товаров, сохраненных в базе данных",
+    description="""
+    Возвращает список товаров, сохраненных в базе данных.
+    
+    - Постраничная выдача по курсору: курсор следующей страницы возвращается
+      в заголовке `X-Next-Cursor` (и в `Link` с rel="next"), его нужно передать в параметр `cursor`
+    - Фильтры по цене и рейтингу, сортировка `sort`: id, price, rating, updated_at (с `-` - по убыванию)
+    - Параметр `skip` оставлен для совместимости и используется только без `cursor`
+    """,
     responses={
         200: {
             "description": "Список товаров",
@@ -147,19 +260,105 @@ async def subscribe_to_product(
     }
 )
 async def get_all_products_endpoint(
-    skip: int = Query(0, ge=0, description="Количество пропускаемых записей"),
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0, description="Количество пропускаемых записей (без cursor)"),
     limit: int = Query(100, ge=1, le=1000, description="Максимальное количество возвращаемых записей"),
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы из заголовка X-Next-Cursor"),
+    sort: str = Query("id", pattern=PRODUCT_SORT_PATTERN, description="Поле сортировки, `-` - по убыванию"),
+    min_price: Optional[float] = Query(None, ge=0, description="Минимальная цена"),
+    max_price: Optional[float] = Query(None, ge=0, description="Максимальная цена"),
+    min_rating: Optional[float] = Query(None, ge=0, le=5, description="Минимальный рейтинг"),
+    max_rating: Optional[float] = Query(None, ge=0, le=5, description="Максимальный рейтинг"),
     db: AsyncSession = Depends(get_db),
     api_key: str = Depends(get_api_key)
 ):
     try:
-        products = await get_all_products(db)
-        return products[skip:skip + limit]
+        products, cursor = await list_products(
+            db, limit, cursor=cursor, sort=sort,
+            min_price=min_price, max_price=max_price,
+            min_rating=min_rating, max_rating=max_rating,
+            skip=skip
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail={"error_code": "INVALID_CURSOR", "detail": str(e)}
+        )
     except Exception as e:
         raise HTTPException(
             status_code=400,
             detail={"error_code": "DATABASE_ERROR", "detail": str(e)}
         )
+    set_next_cursor(request, response, cursor)
+    return products
+
+def export_response(query, name: str, fmt: str, gzip: bool) -> StreamingResponse:
+    headers = {"Content-Disposition": f'attachment; filename="{name}.{fmt}"'}
+    if gzip:
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(
+        stream_query(query, fmt, gzip),
+        media_type=EXPORT_FORMATS[fmt],
+        headers=headers
+    )
+
+@router_product.get(
+    "/api/v1/export/products",
+    summary="Выгрузка всех товаров",
+    description="""
+    Потоково выгружает все товары в формате NDJSON (по объекту JSON на строку) или CSV.
+    
+    - Данные читаются через серверный курсор и отправляются частями, объем таблицы не ограничен
+    - `gzip=true` - ответ сжимается (заголовок `Content-Encoding: gzip`)
+    """,
+    responses={
+        401: {
+            "description": "Неверный API ключ",
+            "model": ErrorResponse
+        },
+        429: {
+            "description": "Превышен лимит запросов",
+            "model": RateLimitResponse
+        }
+    }
+)
+async def export_products_endpoint(
+    format: str = Query("ndjson", pattern=EXPORT_FORMAT_PATTERN, description="ndjson или csv"),
+    gzip: bool = Query(False, description="Сжимать ответ gzip"),
+    api_key: str = Depends(get_api_key)
+):
+    return export_response(products_export_query(), "products", format, gzip)
+
+@router_product.get(
+    "/api/v1/export/price-history",
+    summary="Выгрузка истории цен",
+    description="""
+    Потоково выгружает историю цен (артикул, цена, количество, время записи) в формате NDJSON или CSV.
+    
+    - Можно ограничить одним артикулом и временем записи (`since`)
+    - Данные читаются через серверный курсор и отправляются частями
+    - `gzip=true` - ответ сжимается (заголовок `Content-Encoding: gzip`)
+    """,
+    responses={
+        401: {
+            "description": "Неверный API ключ",
+            "model": ErrorResponse
+        },
+        429: {
+            "description": "Превышен лимит запросов",
+            "model": RateLimitResponse
+        }
+    }
+)
+async def export_price_history_endpoint(
+    format: str = Query("ndjson", pattern=EXPORT_FORMAT_PATTERN, description="ndjson или csv"),
+    gzip: bool = Query(False, description="Сжимать ответ gzip"),
+    artikul: Optional[str] = Query(None, max_length=15, description="Только указанный артикул"),
+    since: Optional[datetime] = Query(None, description="Только записи не старше указанного времени (без часового пояса - UTC)"),
+    api_key: str = Depends(get_api_key)
+):
+    return export_response(price_history_export_query(artikul, to_naive_utc(since)), "price_history", format, gzip)
 
 @router_product.put(
     "/api/v1/subscription/{artikul}/frequency",
@@ -225,7 +424,13 @@ async def update_subscription_frequency_endpoint(
     "/api/v1/subscriptions",
     response_model=List[SubscriptionResponse],
     summary="Получить список всех подписок",
-    description="Возвращает список всех активных и неактивных подписок",
+    description="""
+    Возвращает список всех активных и неактивных подписок в порядке id.
+    
+    - Постраничная выдача по курсору: курсор следующей страницы возвращается
+      в заголовке `X-Next-Cursor` (и в `Link` с rel="next"), его нужно передать в параметр `cursor`
+    - Параметр `skip` оставлен для совместимости и используется только без `cursor`
+    """,
     responses={
         200: {
             "description": "Список подписок",
@@ -242,22 +447,31 @@ async def update_subscription_frequency_endpoint(
     }
 )
 async def get_all_subscriptions_endpoint(
-    skip: int = Query(0, ge=0, description="Количество пропускаемых записей"),
+    request: Request,
+    response: Response,
+    skip: int = Query(0, ge=0, description="Количество пропускаемых записей (без cursor)"),
     limit: int = Query(100, ge=1, le=1000, description="Максимальное количество возвращаемых записей"),
+    cursor: Optional[str] = Query(None, description="Курсор следующей страницы из заголовка X-Next-Cursor"),
     active_only: bool = Query(False, description="Показывать только активные подписки"),
     db: AsyncSession = Depends(get_db),
     api_key: str = Depends(get_api_key)
 ):
     try:
-        subscriptions = await get_all_subscriptions(db)
-        if active_only:
-            subscriptions = [s for s in subscriptions if s.is_active]
-        return subscriptions[skip:skip + limit]
+        subscriptions, cursor = await list_subscriptions(
+            db, limit, cursor=cursor, active_only=active_only, skip=skip
+        )
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail={"error_code": "INVALID_CURSOR", "detail": str(e)}
+        )
     except Exception as e:
         raise HTTPException(
             status_code=400,
             detail={"error_code": "DATABASE_ERROR", "detail": str(e)}
         )
+    set_next_cursor(request, response, cursor)
+    return subscriptions
 
 @router_product.get(
     "/api/v1/products/{artikul}/price-history",
@@ -266,9 +480,11 @@ async def get_all_subscriptions_endpoint(
     description="""
     Возвращает историю изменения цен товара.
     
-    - Возвращает последние 100 записей
+    - Возвращает последние `limit` записей (по умолчанию 100) за период `from` - `to`
     - Сортировка от новых к старым
     - Включает информацию о количестве товара на момент записи
+    - `interval=hour` или `interval=day` - вместо отдельных записей возвращаются `buckets`:
+      первая, максимальная, минимальная и последняя цена за каждый интервал (не более `limit` интервалов)
     """,
     responses={
         200: {
@@ -301,6 +517,10 @@ async def get_price_history(
         description="Артикул товара Wildberries",
         examples=["303265098"]
     ),
+    date_from: Optional[datetime] = Query(None, alias="from", description="Начало периода (включительно, без часового пояса - UTC)"),
+    date_to: Optional[datetime] = Query(None, alias="to", description="Конец периода (не включительно, без часового пояса - UTC)"),
+    limit: int = Query(100, ge=1, le=1000, description="Максимальное количество записей или интервалов"),
+    interval: Optional[str] = Query(None, pattern="^(hour|day)$", description="Агрегация по интервалам: hour или day"),
     db: AsyncSession = Depends(get_db),
     api_key: str = Depends(get_api_key)
 ):
@@ -322,13 +542,18 @@ async def get_price_history(
             detail={"error_code": "PRODUCT_NOT_FOUND", "detail": "Товар не найден"}
         )
 
+    date_from, date_to = to_naive_utc(date_from), to_naive_utc(date_to)
+    if interval is not None:
+        buckets = await get_price_history_ohlc(db, product.id, interval, limit, date_from, date_to)
+        return ProductPriceHistory(
+            artikul=product.artikul,
+            name=product.name,
+            interval=interval,
+            buckets=buckets
+        )
+
     # Получаем историю цен, отсортированную по дате
-    price_history = await db.execute(
-        select(PriceHistory)
-        .where(PriceHistory.product_id == product.id)
-        .order_by(PriceHistory.created_at.desc())
-    )
-    price_history = price_history.scalars().all()
+    price_history = await fetch_price_history(db, product.id, limit, date_from, date_to)
 
     return ProductPriceHistory(
         artikul=product.artikul,
@@ -410,6 +635,7 @@ async def create_user_subscription(
         session.add(sub)
     else:
         sub.frequency_minutes = subscription.frequency_minutes
+        sub.schedule_next_check()
         sub.is_active = True
 
     await session.commit()
@@ -451,6 +677,47 @@ async def get_subscription_users(
     subscriptions = result.scalars().all()
     return subscriptions
 
+@router_product.post(
+    "/api/v1/subscriptions/users:batch",
+    response_model=SubscribersBatchResponse,
+    summary="Получить подписчиков нескольких товаров",
+    description="""
+    Возвращает chat_id подписчиков для списка артикулов одним запросом.
+    
+    - Используется ботом для пакетной рассылки уведомлений
+    - Артикулы без подписчиков в ответ не включаются
+    - Для больших аудиторий - постраничная выдача: `limit` задает размер страницы, `next_cursor`
+      из ответа передается в `cursor` следующего запроса (порядок по артикулу и chat_id)
+    """,
+    responses={
+        400: {
+            "description": "Неверный курсор",
+            "model": ErrorResponse
+        },
+        401: {
+            "description": "Неверный API ключ",
+            "model": ErrorResponse
+        },
+        429: {
+            "description": "Превышен лимит запросов",
+            "model": RateLimitResponse
+        }
+    }
+)
+async def get_subscribers_batch(
+    request: SubscribersBatchRequest,
+    session: AsyncSession = Depends(get_db),
+    api_key: str = Depends(get_api_key)
+):
+    try:
+        subscribers, cursor = await get_subscribers_page(session, request.artikuls, request.limit, request.cursor)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=400,
+            detail={"error_code": "INVALID_CURSOR", "detail": str(e)}
+        )
+    return SubscribersBatchResponse(subscribers=subscribers, next_cursor=cursor)
+
 @router_product.delete(
     "/api/v1/subscriptions/{artikul}/users/{chat_id}",
     summary="Отменить подписку пользователя",
@@ -549,3 +816,108 @@ async def get_user_subscriptions(
         .order_by(UserSubscription.created_at.desc())
     )
     return result.scalars().all()
+
+@router_system.get(
+    "/api/v1/system/http-pools",
+    summary="Статистика HTTP пулов",
+    description="""
+    Возвращает состояние общих HTTP клиентов (Wildberries и API бота).
+    
+    - Количество открытых и простаивающих соединений
+    - Количество запросов и новых соединений
+    - Доля запросов, выполненных по уже открытому соединению
+    """,
+    responses={
+        401: {
+            "description": "Неверный API ключ",
+            "model": ErrorResponse
+        }
+    }
+)
+async def get_http_pools(api_key: str = Depends(get_api_key)):
+    return get_http_pool_stats()
+
+@router_system.get(
+    "/api/v1/system/leader",
+    summary="Статус выбора лидера",
+    description="""
+    Показывает, какой экземпляр API выполняет плановые задачи.
+    
+    - Лидер определяется через advisory lock в PostgreSQL
+    - Остальные экземпляры только обслуживают HTTP запросы
+    """,
+    responses={
+        401: {
+            "description": "Неверный API ключ",
+            "model": ErrorResponse
+        }
+    }
+)
+async def get_leader_status(
+    session: AsyncSession = Depends(get_db),
+    api_key: str = Depends(get_api_key)
+):
+    return await leader_elector.status(session)
+
+@router_system.get(
+    "/api/v1/system/auth-cache",
+    summary="Статистика кэша API ключей",
+    description="""
+    Показывает работу кэша проверки API ключей.
+    
+    - Попадания по валидным и неверным ключам, промахи (запросы к базе)
+    - Число инвалидаций по уведомлениям из PostgreSQL
+    - Подключен ли канал уведомлений об изменении ключей
+    """,
+    responses={
+        401: {
+            "description": "Неверный API ключ",
+            "model": ErrorResponse
+        }
+    }
+)
+async def get_auth_cache_stats(api_key: str = Depends(get_api_key)):
+    return api_key_cache.stats()
+
+@router_system.get(
+    "/api/v1/system/single-flight",
+    summary="Статистика объединения запросов к Wildberries",
+    description="""
+    Показывает, сколько запросов карточек товаров было объединено.
+    
+    - calls - сколько раз запрашивались артикулы (API и планировщик)
+    - executions - сколько артикулов реально запрошено у Wildberries
+    - coalesced - сколько вызывающих дождались уже выполняющегося запроса
+    """,
+    responses={
+        401: {
+            "description": "Неверный API ключ",
+            "model": ErrorResponse
+        }
+    }
+)
+async def get_single_flight_stats(api_key: str = Depends(get_api_key)):
+    return wb_flight.stats()
+
+@router_system.get(
+    "/api/v1/system/outbox",
+    summary="Очередь уведомлений для бота",
+    description="""
+    Показывает состояние outbox уведомлений об изменениях товаров.
+    
+    - pending - ожидают доставки (в том числе повторной)
+    - failed - попытки доставки исчерпаны
+    - oldest_pending_age - возраст самого старого недоставленного уведомления в секундах
+    """,
+    responses={
+        401: {
+            "description": "Неверный API ключ",
+            "model": ErrorResponse
+        }
+    }
+)
+async def get_outbox_stats(
+    session: AsyncSession = Depends(get_db),
+    api_key: str = Depends(get_api_key)
+):
+    return await outbox_stats(session)
@@ -1,11 +1,18 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
+from apscheduler.triggers.cron import CronTrigger
 from sqlalchemy import select, update
 from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+import asyncio
 import logging
-import aiohttp
-from models import Subscription, Product, TaskLog
+import time
+from models import Subscription, Product
 from db import AsyncSessionLocal
+from tasks import fetch_products_batch, cleanup_old_data, maintain_partitions, chunked, WB_BATCH_SIZE
+from pipeline import RefreshWriter
+from price_stats import refresh_stale_price_stats
+from outbox import dispatch_outbox, OUTBOX_DISPATCH_INTERVAL
 import os
 from dotenv import load_dotenv
 
@@ -19,259 +26,295 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-BOT_API_URL = os.getenv('BOT_API_URL', 'http://bot:8889')
+# Запускать ли обновление подписок внутри процесса API (false, если работают отдельные воркеры worker.py)
+RUN_SCHEDULER = os.getenv('RUN_SCHEDULER', 'true').lower() in ('1', 'true', 'yes')
+# Сколько пачек обновляется одновременно
+REFRESH_CONCURRENCY = int(os.getenv('REFRESH_CONCURRENCY', '8'))
+# Максимальная длительность одного тика обновления в секундах (тик запускается раз в минуту)
+REFRESH_TICK_DEADLINE = float(os.getenv('REFRESH_TICK_DEADLINE', '55'))
+# Сколько подписок выбирается из БД за один запрос
+SUBSCRIPTION_PAGE_SIZE = int(os.getenv('SUBSCRIPTION_PAGE_SIZE', '1000'))
+# На сколько секунд подписка, взятая в работу, скрывается от других воркеров
+REFRESH_CLAIM_LEASE = int(os.getenv('REFRESH_CLAIM_LEASE', '120'))
 
-async def notify_price_change(artikul: str, old_price: float, new_price: float, product_name: str):
-    """Отправляет запрос в API бота для уведомления об изменении цены"""
-    logger.info(f"Attempting to send price change notification to {BOT_API_URL}")
-    logger.info(f"Price change details: artikul={artikul}, old_price={old_price}, new_price={new_price}")
-    
-    try:
-        async with aiohttp.ClientSession() as client:
-            url = f"{BOT_API_URL}/api/v1/notify/price-change"
-            payload = {
-                "artikul": artikul,
-                "old_price": old_price,
-                "new_price": new_price,
-                "product_name": product_name
-            }
-            logger.info(f"Sending POST request to {url} with payload: {payload}")
-            
-            async with client.post(url, json=payload) as response:
-                response_text = await response.text()
-                logger.info(f"Received response: Status={response.status}, Body={response_text}")
-                
-                if response.status != 200:
-                    logger.error(f"Failed to send notification request: HTTP {response.status}")
-                    return False
-                
-                result = await response.json()
-                logger.info(f"Notification request sent successfully. Notifications sent: {result.get('notifications_sent', 0)}")
-                return True
-    except Exception as e:
-        logger.error(f"Error sending notification request: {str(e)}")
-        return False
+def lowest_price(product: Product, new_price: float) -> Optional[float]:
+    """Минимальная цена за все время с учетом новой цены (статистика загружена вместе с товаром)"""
+    stats = product.price_stats
+    if stats is None or stats.lowest_price is None:
+        return None
+    return min(stats.lowest_price, new_price)
 
-async def notify_quantity_change(artikul: str, old_quantity: int, new_quantity: int, product_name: str):
-    """Отправляет запрос в API бота для уведомления об изменении количества"""
-    logger.info(f"Attempting to send quantity change notification to {BOT_API_URL}")
-    logger.info(f"Quantity change details: artikul={artikul}, old_quantity={old_quantity}, new_quantity={new_quantity}")
-    
-    try:
-        async with aiohttp.ClientSession() as client:
-            url = f"{BOT_API_URL}/api/v1/notify/quantity-change"
-            payload = {
-                "artikul": artikul,
-                "old_quantity": old_quantity,
-                "new_quantity": new_quantity,
-                "product_name": product_name
-            }
-            logger.info(f"Sending POST request to {url} with payload: {payload}")
-            
-            async with client.post(url, json=payload) as response:
-                response_text = await response.text()
-                logger.info(f"Received response: Status={response.status}, Body={response_text}")
-                
-                if response.status != 200:
-                    logger.error(f"Failed to send quantity notification request: HTTP {response.status}")
-                    return False
-                
-                result = await response.json()
-                logger.info(f"Quantity notification request sent successfully. Notifications sent: {result.get('notifications_sent', 0)}")
-                return True
-    except Exception as e:
-        logger.error(f"Error sending quantity notification request: {str(e)}")
-        return False
+def can_notify(product: Product, old_value, new_value) -> bool:
+    """Уведомление без названия товара или с пустым старым/новым значением бот не примет"""
+    return bool(product.name) and old_value is not None and new_value is not None
 
-async def update_product_data(artikul: str, session) -> bool:
-    """Обновляет данные о товаре и создает запись в логе"""
-    logger.info(f"Starting update for product {artikul}")
+async def apply_product_data(writer: RefreshWriter, artikul: str, current_product, product_data: dict,
+                             checked_at: datetime) -> bool:
+    """Добавляет результат обновления и уведомления об изменениях товара в буфер записи"""
     try:
-        # Получаем текущие данные о товаре
-        current_product = await session.execute(
-            select(Product).where(Product.artikul == artikul)
-        )
-        current_product = current_product.scalar_one_or_none()
-        
-        if not current_product:
-            error_msg = f"Product {artikul} not found in database"
-            logger.error(error_msg)
-            await create_task_log(session, artikul, "error", error_msg)
+        if product_data.get("status") != "success":
+            error_msg = product_data.get("message", "Product not found")
+            logger.error(f"{error_msg} for artikul {artikul}")
+            writer.add_log(artikul, "error", error_msg)
             return False
-            
-        old_price = current_product.price
-        old_quantity = current_product.total_quantity
-        
-        async with aiohttp.ClientSession() as client:
-            url = f"https://card.wb.ru/cards/v1/detail?appType=1&curr=rub&dest=-1257786&spp=27&nm={artikul}"
-            logger.info(f"Sending request to: {url}")
-            async with client.get(url) as response:
-                if response.status != 200:
-                    error_msg = f"Failed to fetch data: HTTP {response.status}"
-                    logger.error(error_msg)
-                    await create_task_log(session, artikul, "error", error_msg)
-                    return False
 
-                data = await response.json()
-                products = data.get('data', {}).get('products', [])
-                
-                if not products:
-                    error_msg = "Product not found"
-                    logger.error(f"{error_msg} for artikul {artikul}")
-                    await create_task_log(session, artikul, "error", error_msg)
-                    return False
+        old_price = current_product.price if current_product else None
+        old_quantity = current_product.total_quantity if current_product else None
+        new_price = product_data["price"]
+        new_rating = product_data["rating"]
+        new_quantity = product_data["total_quantity"]
 
-                product_data = products[0]
-                new_price = product_data.get('salePriceU', 0) / 100
-                new_rating = product_data.get('rating', 0)
-                new_quantity = product_data.get('sizes', [{}])[0].get('stocks', [{}])[0].get('qty', 0)
-                
-                logger.info(f"Received data for {artikul}: price={new_price}, rating={new_rating}, quantity={new_quantity}")
-                
-                # Проверяем изменение цены
-                if old_price != new_price:
-                    logger.info(f"Price changed for {artikul}: {old_price} -> {new_price}")
-                    # Отправляем запрос в API бота для уведомления подписчиков
-                    await notify_price_change(
-                        artikul=artikul,
-                        old_price=old_price,
-                        new_price=new_price,
-                        product_name=current_product.name
-                    )
-                
-                # Проверяем изменение количества
-                if old_quantity != new_quantity:
-                    logger.info(f"Quantity changed for {artikul}: {old_quantity} -> {new_quantity}")
-                    # Отправляем запрос в API бота для уведомления подписчиков
-                    await notify_quantity_change(
-                        artikul=artikul,
-                        old_quantity=old_quantity,
-                        new_quantity=new_quantity,
-                        product_name=current_product.name
-                    )
-                
-                # Обновляем информацию о товаре
-                stmt = update(Product).where(Product.artikul == artikul).values(
-                    price=new_price,
-                    rating=new_rating,
-                    total_quantity=new_quantity,
-                    updated_at=datetime.utcnow()
-                )
-                await session.execute(stmt)
-                await session.commit()
-                
-                success_msg = f"Data updated successfully: price={new_price}, rating={new_rating}, quantity={new_quantity}"
-                logger.info(success_msg)
-                await create_task_log(session, artikul, "success", success_msg)
-                return True
+        # Проверяем изменение цены
+        if current_product and old_price != new_price:
+            logger.info(f"Price changed for {artikul}: {old_price} -> {new_price}")
+            if can_notify(current_product, old_price, new_price):
+                # Уведомление подписчиков доставит диспетчер outbox после записи результатов
+                writer.add_event("price_change", artikul, {
+                    "artikul": artikul,
+                    "old_price": old_price,
+                    "new_price": new_price,
+                    "product_name": current_product.name,
+                    "lowest_price": lowest_price(current_product, new_price)
+                })
+            else:
+                logger.warning(f"Price change of {artikul} is not notified: incomplete product data")
+
+        # Проверяем изменение количества
+        if current_product and old_quantity != new_quantity:
+            logger.info(f"Quantity changed for {artikul}: {old_quantity} -> {new_quantity}")
+            if can_notify(current_product, old_quantity, new_quantity):
+                writer.add_event("quantity_change", artikul, {
+                    "artikul": artikul,
+                    "old_quantity": old_quantity,
+                    "new_quantity": new_quantity,
+                    "product_name": current_product.name
+                })
+            else:
+                logger.warning(f"Quantity change of {artikul} is not notified: incomplete product data")
+
+        writer.add_product(product_data, old_price=old_price)
+        writer.mark_checked(artikul, checked_at)
+        writer.add_log(
+            artikul, "success",
+            f"Data updated successfully: price={new_price}, rating={new_rating}, quantity={new_quantity}"
+        )
+        return True
 
     except Exception as e:
         error_msg = f"Error updating product {artikul}: {str(e)}"
         logger.error(error_msg)
-        await create_task_log(session, artikul, "error", error_msg)
+        writer.add_log(artikul, "error", error_msg)
         return False
 
-async def create_task_log(session, artikul: str, status: str, message: str):
-    """Создает запись в логе задач"""
-    logger.info(f"Creating task log for {artikul}: {status} - {message}")
-    task_log = TaskLog(
-        artikul=artikul,
-        status=status,
-        message=message
+async def update_products_batch(artikuls: List[str], session, writer: RefreshWriter, now: datetime) -> int:
+    """
+    Обновляет товары пачки подписок: один запрос к Wildberries и один SELECT на всю пачку.
+    Результаты попадают в буфер writer. Возвращает количество успешно обновленных подписок
+    """
+    logger.info(f"Fetching batch of {len(artikuls)} artikuls")
+    results = await fetch_products_batch(artikuls)
+
+    current_products = await session.execute(
+        select(Product).where(Product.artikul.in_(artikuls))
     )
-    session.add(task_log)
-    try:
-        await session.commit()
-        logger.info(f"Task log created successfully for {artikul}")
-    except Exception as e:
-        logger.error(f"Error creating task log for {artikul}: {e}")
-        await session.rollback()
+    products_by_artikul = {product.artikul: product for product in current_products.scalars().all()}
+
+    updated = 0
+    for artikul in artikuls:
+        if await apply_product_data(writer, artikul, products_by_artikul.get(artikul), results[artikul], now):
+            updated += 1
+        else:
+            logger.error(f"Failed to update subscription for artikul {artikul}")
+    return updated
+
+async def update_product_data(artikul: str, session) -> bool:
+    """Обновляет данные об одном товаре и сразу записывает результат"""
+    writer = RefreshWriter()
+    success = await update_products_batch([artikul], session, writer, datetime.utcnow()) == 1
+    await writer.flush(session)
+    return success
+
+async def refresh_batch(artikuls: List[str], writer: RefreshWriter, now: datetime) -> int:
+    """Обновляет пачку подписок, читая текущие данные товаров в собственной сессии БД"""
+    async with AsyncSessionLocal() as session:
+        return await update_products_batch(artikuls, session, writer, now)
+
+async def run_batches(
+    batches: List[List[str]],
+    process_batch: Callable[[List[str]], Awaitable[int]],
+    concurrency: int = REFRESH_CONCURRENCY,
+    deadline: float = REFRESH_TICK_DEADLINE
+) -> Dict[str, float]:
+    """
+    Обрабатывает пачки параллельно, не более concurrency одновременно.
+    Пачки, не успевшие завершиться за deadline секунд, отменяются и будут обработаны на следующем тике.
+    """
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(batch: List[str]) -> int:
+        async with semaphore:
+            return await process_batch(batch)
+
+    tasks = [asyncio.create_task(worker(batch)) for batch in batches]
+    stats = {"batches": len(tasks), "completed": 0, "failed": 0, "timed_out": 0, "updated": 0}
+    if not tasks:
+        stats["elapsed"] = 0.0
+        return stats
+
+    done, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    for task in done:
+        if task.exception() is not None:
+            stats["failed"] += 1
+            logger.error(f"Batch refresh failed: {task.exception()}")
+        else:
+            stats["completed"] += 1
+            stats["updated"] += task.result()
+    stats["timed_out"] = len(pending)
+    stats["elapsed"] = round(time.monotonic() - started, 3)
+    return stats
+
+async def claim_due_subscriptions(session, now: datetime, limit: int = SUBSCRIPTION_PAGE_SIZE) -> List[str]:
+    """
+    Забирает в работу страницу подписок, которым пора обновиться (next_check_at <= now).
+    Строки выбираются через SELECT ... FOR UPDATE SKIP LOCKED, а их next_check_at сдвигается
+    на время аренды, поэтому параллельные воркеры не получают одни и те же артикулы.
+    Если воркер не успеет записать результат, подписка снова станет доступной после окончания аренды
+    """
+    due = (
+        select(Subscription.id)
+        .where(Subscription.is_active == True, Subscription.next_check_at <= now)
+        .order_by(Subscription.next_check_at, Subscription.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+    result = await session.execute(
+        update(Subscription)
+        .where(Subscription.id.in_(due))
+        .values(next_check_at=now + timedelta(seconds=REFRESH_CLAIM_LEASE))
+        .returning(Subscription.artikul)
+        .execution_options(synchronize_session=False)
+    )
+    artikuls = list(result.scalars().all())
+    await session.commit()
+    return artikuls
 
 async def check_subscriptions():
-    """Проверяет все активные подписки и обновляет данные при необходимости"""
+    """Обновляет данные по подпискам, у которых наступило время проверки"""
     logger.info("\n=== Starting subscription check ===")
-    async with AsyncSessionLocal() as session:
-        try:
-            # Получаем все активные подписки
-            now = datetime.utcnow()
-            query = select(Subscription).where(
-                Subscription.is_active == True
-            )
-            result = await session.execute(query)
-            all_subscriptions = result.scalars().all()
-            
-            logger.info(f"Total active subscriptions found: {len(all_subscriptions)}")
-            
-            # Фильтруем подписки, которые нужно обновить
-            subscriptions_to_update = []
-            for sub in all_subscriptions:
-                time_since_last_check = now - sub.last_checked_at
-                minutes_since_last_check = time_since_last_check.total_seconds() / 60
-                should_update = minutes_since_last_check >= sub.frequency_minutes
-                
-                logger.info(
-                    f"Subscription {sub.artikul}:"
-                    f"\n    - Last checked: {sub.last_checked_at}"
-                    f"\n    - Minutes since last check: {minutes_since_last_check:.1f}"
-                    f"\n    - Update frequency: {sub.frequency_minutes} minutes"
-                    f"\n    - Needs update: {should_update}"
-                )
-                
-                if should_update:
-                    subscriptions_to_update.append(sub)
-            
-            logger.info(f"\nFound {len(subscriptions_to_update)} subscriptions that need updating")
+    now = datetime.utcnow()
+    started = time.monotonic()
+    writer = RefreshWriter()
+    due = updated = timed_out = 0
 
-            for subscription in subscriptions_to_update:
-                logger.info(f"\nProcessing subscription for artikul {subscription.artikul}")
-                logger.info(f"Update frequency: {subscription.frequency_minutes} minutes")
-                logger.info(f"Last checked at: {subscription.last_checked_at}")
-                
-                # Обновляем данные о товаре
-                success = await update_product_data(subscription.artikul, session)
-                
-                if success:
-                    # Обновляем время последней проверки
-                    old_check_time = subscription.last_checked_at
-                    subscription.last_checked_at = now
-                    await session.commit()
-                    logger.info(
-                        f"Successfully updated subscription for artikul {subscription.artikul}"
-                        f"\n    - Previous check time: {old_check_time}"
-                        f"\n    - New check time: {now}"
-                    )
-                else:
-                    logger.error(f"Failed to update subscription for artikul {subscription.artikul}")
+    try:
+        while True:
+            remaining = REFRESH_TICK_DEADLINE - (time.monotonic() - started)
+            if remaining <= 0:
+                logger.warning("Tick deadline reached, remaining subscriptions will be processed on the next tick")
+                break
 
-            logger.info("\n=== Subscription check completed ===")
+            async with AsyncSessionLocal() as session:
+                artikuls = await claim_due_subscriptions(session, now)
+            if not artikuls:
+                break
+            due += len(artikuls)
 
+            # Группируем подписки в пачки (один запрос к Wildberries на пачку) и обновляем их параллельно
+            stats = await run_batches(
+                list(chunked(artikuls, WB_BATCH_SIZE)),
+                lambda batch: refresh_batch(batch, writer, now),
+                deadline=remaining
+            )
+            updated += stats["updated"]
+            timed_out += stats["timed_out"]
+
+            if len(artikuls) < SUBSCRIPTION_PAGE_SIZE:
+                break
+    except Exception as e:
+        logger.error(f"Error in check_subscriptions: {e}")
+
+    # Записываем результаты всего тика одной транзакцией
+    if len(writer):
+        try:
+            async with AsyncSessionLocal() as session:
+                await writer.flush(session)
         except Exception as e:
-            logger.error(f"Error in check_subscriptions: {e}")
-            await session.rollback()
+            logger.error(f"Failed to write refresh results: {e}")
+
+    logger.info(
+        f"Updated {updated} of {due} due subscriptions in {time.monotonic() - started:.1f}s "
+        f"({timed_out} batches timed out)"
+    )
+    logger.info("\n=== Subscription check completed ===")
 
 def start_scheduler():
-    """Запускает планировщик задач"""
+    """Запускает планировщик задач (только на экземпляре-лидере)"""
     try:
         logger.info("=== Initializing scheduler ===")
         scheduler = AsyncIOScheduler()
         
-        # Добавляем задачу проверки подписок каждую минуту
+        if RUN_SCHEDULER:
+            # Добавляем задачу проверки подписок каждую минуту
+            scheduler.add_job(
+                check_subscriptions,
+                trigger=IntervalTrigger(minutes=1),
+                id='check_subscriptions',
+                name='Check active subscriptions and update product data',
+                replace_existing=True,
+                misfire_grace_time=None  # Всегда выполнять пропущенные задачи
+            )
+        
+        # Доставка уведомлений из outbox в бот (уведомления пишут и API, и отдельные воркеры)
         scheduler.add_job(
-            check_subscriptions,
-            trigger=IntervalTrigger(minutes=1),
-            id='check_subscriptions',
-            name='Check active subscriptions and update product data',
+            dispatch_outbox,
+            trigger=IntervalTrigger(seconds=OUTBOX_DISPATCH_INTERVAL),
+            id='dispatch_outbox',
+            name='Deliver outbox notifications to the bot',
             replace_existing=True,
-            misfire_grace_time=None  # Всегда выполнять пропущенные задачи
+            max_instances=1,
+            coalesce=True
+        )
+        
+        # Очистка старых данных каждый день в 3 часа ночи
+        scheduler.add_job(
+            cleanup_old_data,
+            trigger=CronTrigger(hour=3),
+            id='cleanup_old_data',
+            name='Cleanup old task logs and price history',
+            replace_existing=True
+        )
+        
+        # Заблаговременное создание секций price_history и task_logs
+        scheduler.add_job(
+            maintain_partitions,
+            trigger=CronTrigger(hour=2),
+            id='maintain_partitions',
+            name='Create upcoming price_history and task_logs partitions',
+            replace_existing=True
+        )
+        
+        # Пересчет статистики цен товаров, которые давно не обновлялись (сдвиг окон 7/30/90 дней)
+        scheduler.add_job(
+            refresh_stale_price_stats,
+            trigger=CronTrigger(hour=4),
+            id='refresh_stale_price_stats',
+            name='Refresh price stats of stale products',
+            replace_existing=True
         )
         
         scheduler.start()
         logger.info("=== Scheduler started successfully! ===")
         logger.info("Scheduled jobs:")
         for job in scheduler.get_jobs():
-            logger.info(f"- {job.name}: runs every {job.trigger.interval.seconds} seconds")
+            logger.info(f"- {job.name}: {job.trigger}")
         
         return scheduler
     except Exception as e:
         logger.error(f"Failed to start scheduler: {e}")
-        raise 
\ No newline at end of file
+        raise
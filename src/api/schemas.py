@@ -1,8 +1,16 @@
 from pydantic import BaseModel, ConfigDict, Field, field_validator
-from typing import Optional, List
+from typing import Dict, Optional, List
 import re
+import os
 from datetime import datetime
 
+# Максимальное число артикулов в POST /api/v1/products/batch
+PRODUCT_BATCH_MAX_SIZE = int(os.getenv('PRODUCT_BATCH_MAX_SIZE', '500'))
+# Максимальное число артикулов в одном запросе подписчиков POST /api/v1/subscriptions/users:batch
+SUBSCRIBERS_BATCH_MAX_SIZE = int(os.getenv('SUBSCRIBERS_BATCH_MAX_SIZE', '1000'))
+# Максимальный размер страницы подписчиков (limit) в POST /api/v1/subscriptions/users:batch
+SUBSCRIBERS_PAGE_MAX_SIZE = int(os.getenv('SUBSCRIBERS_PAGE_MAX_SIZE', '50000'))
+
 class ProductCreate(BaseModel):
     artikul: str = Field(
         ...,
@@ -19,12 +27,40 @@ class ProductCreate(BaseModel):
             raise ValueError("Артикул должен содержать только цифры")
         return v
 
+class PriceStatsResponse(BaseModel):
+    lowest_price: Optional[float] = Field(None, description="Минимальная цена за все время наблюдения")
+    lowest_price_at: Optional[datetime] = Field(None, description="Когда была минимальная цена")
+    highest_price: Optional[float] = Field(None, description="Максимальная цена за все время наблюдения")
+    min_price_7d: Optional[float] = Field(None, description="Минимальная цена за 7 дней")
+    max_price_7d: Optional[float] = Field(None, description="Максимальная цена за 7 дней")
+    avg_price_7d: Optional[float] = Field(None, description="Средняя цена за 7 дней")
+    min_price_30d: Optional[float] = Field(None, description="Минимальная цена за 30 дней")
+    max_price_30d: Optional[float] = Field(None, description="Максимальная цена за 30 дней")
+    avg_price_30d: Optional[float] = Field(None, description="Средняя цена за 30 дней")
+    min_price_90d: Optional[float] = Field(None, description="Минимальная цена за 90 дней")
+    max_price_90d: Optional[float] = Field(None, description="Максимальная цена за 90 дней")
+    avg_price_90d: Optional[float] = Field(None, description="Средняя цена за 90 дней")
+    updated_at: Optional[datetime] = Field(None, description="Время пересчета статистики")
+
+    model_config = ConfigDict(from_attributes=True)
+
+    @field_validator(
+        'lowest_price', 'highest_price',
+        'min_price_7d', 'max_price_7d', 'avg_price_7d',
+        'min_price_30d', 'max_price_30d', 'avg_price_30d',
+        'min_price_90d', 'max_price_90d', 'avg_price_90d'
+    )
+    @classmethod
+    def validate_price(cls, v: Optional[float]) -> Optional[float]:
+        return round(v, 2) if v is not None else v  # Округляем до копеек
+
 class ProductResponse(BaseModel):
     name: str = Field(..., min_length=1, max_length=255, description="Название товара")
     artikul: str = Field(..., min_length=1, max_length=15, description="Артикул товара Wildberries (только цифры)")
     price: float = Field(..., ge=0, description="Цена товара в рублях")
     rating: float = Field(..., ge=0, le=5, description="Рейтинг товара от 0 до 5")
     total_quantity: int = Field(..., ge=0, description="Общее количество товара на складах")
+    price_stats: Optional[PriceStatsResponse] = Field(None, description="Статистика цен товара")
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -57,7 +93,7 @@ class SubscriptionResponse(BaseModel):
         le=1440,
         description="Частота обновления в минутах (от 1 до 1440)"
     )
-    last_checked_at: Optional[str] = Field(
+    last_checked_at: Optional[datetime] = Field(
         None,
         description="Время последней проверки в формате ISO 8601"
     )
@@ -108,9 +144,70 @@ class PriceHistoryResponse(BaseModel):
     def validate_price(cls, v: float) -> float:
         return round(v, 2)  # Округляем до копеек
 
+class PriceHistoryBucket(BaseModel):
+    bucket: datetime = Field(..., description="Начало интервала")
+    open: float = Field(..., description="Первая цена за интервал")
+    high: float = Field(..., description="Максимальная цена за интервал")
+    low: float = Field(..., description="Минимальная цена за интервал")
+    close: float = Field(..., description="Последняя цена за интервал")
+    total_quantity: Optional[int] = Field(None, description="Количество товара на момент последней записи интервала")
+    records: int = Field(..., description="Сколько записей истории попало в интервал")
+
+    model_config = ConfigDict(from_attributes=True)
+
+    @field_validator('open', 'high', 'low', 'close')
+    @classmethod
+    def validate_price(cls, v: float) -> float:
+        return round(v, 2)  # Округляем до копеек
+
 class ProductPriceHistory(BaseModel):
     artikul: str = Field(..., description="Артикул товара")
     name: str = Field(..., description="Название товара")
-    history: List[PriceHistoryResponse] = Field(..., description="История изменения цен")
+    history: List[PriceHistoryResponse] = Field(default_factory=list, description="История изменения цен")
+    interval: Optional[str] = Field(None, description="Интервал агрегации (hour или day), если запрошены buckets")
+    buckets: Optional[List[PriceHistoryBucket]] = Field(None, description="Цены, агрегированные по интервалам (OHLC)")
 
-    model_config = ConfigDict(from_attributes=True)
\ No newline at end of file
+    model_config = ConfigDict(from_attributes=True)
+
+class ProductBatchRequest(BaseModel):
+    artikuls: List[str] = Field(
+        ...,
+        min_length=1,
+        max_length=PRODUCT_BATCH_MAX_SIZE,
+        description=f"Артикулы товаров Wildberries (не более {PRODUCT_BATCH_MAX_SIZE})",
+        examples=[["303265098", "211695539"]]
+    )
+
+class ProductBatchItem(BaseModel):
+    artikul: str = Field(..., description="Артикул товара")
+    status: str = Field(..., description="ok, not_found, invalid или error")
+    source: Optional[str] = Field(None, description="cache - данные из базы, wildberries - получены из WB")
+    product: Optional[ProductResponse] = Field(None, description="Данные товара, если status = ok")
+    error: Optional[str] = Field(None, description="Описание ошибки")
+
+class ProductBatchResponse(BaseModel):
+    items: List[ProductBatchItem] = Field(..., description="Результаты в порядке артикулов запроса")
+    found: int = Field(..., description="Сколько товаров найдено")
+    from_cache: int = Field(..., description="Сколько товаров взято из базы без запроса к WB")
+    failed: int = Field(..., description="Сколько артикулов завершились ошибкой или не найдены")
+
+class SubscribersBatchRequest(BaseModel):
+    artikuls: List[str] = Field(
+        ...,
+        min_length=1,
+        max_length=SUBSCRIBERS_BATCH_MAX_SIZE,
+        description=f"Артикулы товаров (не более {SUBSCRIBERS_BATCH_MAX_SIZE})",
+        examples=[["303265098", "211695539"]]
+    )
+    limit: Optional[int] = Field(
+        None, ge=1, le=SUBSCRIBERS_PAGE_MAX_SIZE,
+        description=f"Максимальное число подписчиков в ответе (не более {SUBSCRIBERS_PAGE_MAX_SIZE}), без limit - все"
+    )
+    cursor: Optional[str] = Field(None, description="Курсор следующей страницы из next_cursor предыдущего ответа")
+
+class SubscribersBatchResponse(BaseModel):
+    subscribers: Dict[str, List[str]] = Field(
+        ...,
+        description="chat_id подписчиков по артикулам; артикулы без подписчиков не включаются"
+    )
+    next_cursor: Optional[str] = Field(None, description="Курсор следующей страницы, None - подписчиков больше нет")
@@ -0,0 +1,102 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Tuple
+
+
+class SingleFlight:
+    """
+    Объединение одновременных запросов по одному ключу (single-flight).
+
+    Первый вызывающий для ключа выполняет запрос, остальные ждут его результат
+    (или исключение) вместо повторного запроса. Ключ освобождается сразу после
+    завершения запроса, результат не кэшируется.
+
+    Помимо do() для одиночных вызовов есть claim()/resolve()/release() для пакетных
+    запросов: пакет забирает свободные ключи себе и ждет ключи, которые уже запрашиваются.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[str, asyncio.Future] = {}
+        self._counters = {"calls": 0, "executions": 0, "coalesced": 0}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Выполняет fn() для ключа или ждет результат уже выполняющегося запроса"""
+        while True:
+            future = self._flights.get(key)
+            if future is None:
+                break
+            self._counters["calls"] += 1
+            self._counters["coalesced"] += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Запрос владельца отменен - выполняем его сами; отмена самого ожидающего пробрасывается
+                if not future.cancelled():
+                    raise
+
+        owned, _ = self.claim([key])
+        try:
+            result = await fn()
+            self.resolve({key: result})
+            return result
+        except Exception as e:
+            self.reject(owned, e)
+            raise
+        finally:
+            self.release(owned)
+
+    def claim(self, keys: Iterable[str]) -> Tuple[List[str], Dict[str, asyncio.Future]]:
+        """
+        Забирает свободные ключи. Возвращает (ключи, которые запрашивает вызывающий,
+        {ключ: future} для ключей, которые уже запрашиваются другими).
+        Забранные ключи обязательно завершаются через resolve()/reject() и release()
+        """
+        owned, waiting = [], {}
+        loop = asyncio.get_running_loop()
+        for key in keys:
+            self._counters["calls"] += 1
+            future = self._flights.get(key)
+            if future is None:
+                self._flights[key] = loop.create_future()
+                self._counters["executions"] += 1
+                owned.append(key)
+            else:
+                self._counters["coalesced"] += 1
+                waiting[key] = future
+        return owned, waiting
+
+    def resolve(self, results: Dict[str, Any]):
+        """Передает результаты ожидающим и освобождает ключи"""
+        for key, result in results.items():
+            future = self._flights.pop(key, None)
+            if future is not None and not future.done():
+                future.set_result(result)
+
+    def reject(self, keys: Iterable[str], error: BaseException):
+        """Передает исключение ожидающим и освобождает ключи"""
+        for key in keys:
+            future = self._flights.pop(key, None)
+            if future is not None and not future.done():
+                future.set_exception(error)
+                # Исключение считается полученным, даже если ожидающих не было
+                future.exception()
+
+    def release(self, keys: Iterable[str]):
+        """Освобождает ключи без результата (например, при отмене): ожидающие повторят запрос сами"""
+        for key in keys:
+            future = self._flights.pop(key, None)
+            if future is not None and not future.done():
+                future.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        calls = self._counters["calls"]
+        return {
+            "name": self.name,
+            "in_flight": len(self._flights),
+            **self._counters,
+            "coalesced_ratio": round(self._counters["coalesced"] / calls, 3) if calls else 0.0
+        }
+
+
+# Запросы карточек товаров Wildberries по артикулу (API и планировщик)
+wb_flight = SingleFlight("wildberries")
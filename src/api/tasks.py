@@ -2,12 +2,18 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 import httpx
 import asyncio
 import logging
+import os
+import time
 from datetime import datetime, timedelta
-from sqlalchemy import select, delete, and_
+from typing import Dict, Iterator, List
+from sqlalchemy import select, delete, and_, func, table, column
 
 from schemas import ProductCreate
-from db import AsyncSessionLocal
-from models import Subscription, TaskLog, PriceHistory
+from db import AsyncSessionLocal, AsyncEngine
+from partitions import is_partitioned, drop_expired_partitions, ensure_partitions
+from http_client import wb_pool
+from singleflight import wb_flight
+from models import Product, Subscription, TaskLog, PriceHistory, OutboxEvent
 from exception import WildberriesAPIError, WildberriesResponseError, WildberriesTimeoutError, ProductNotFoundError
 
 # Настройка логгера
@@ -20,74 +26,252 @@ logging.basicConfig(
 
 scheduler = AsyncIOScheduler()
 
-async def cleanup_old_data():
-    """Очистка старых данных"""
+WB_DETAIL_URL = os.getenv('WB_DETAIL_URL', 'https://card.wb.ru/cards/v1/detail')
+WB_DETAIL_PARAMS = {"appType": 1, "curr": "rub", "dest": -1257786, "spp": 30}
+# Сколько артикулов передается в одном запросе (параметр nm через ';')
+WB_BATCH_SIZE = int(os.getenv('WB_BATCH_SIZE', '100'))
+
+# Политики хранения данных
+TASK_LOG_RETENTION_DAYS = int(os.getenv('TASK_LOG_RETENTION_DAYS', '30'))
+PRICE_HISTORY_RETENTION_DAYS = int(os.getenv('PRICE_HISTORY_RETENTION_DAYS', '0'))
+PRICE_HISTORY_KEEP_PER_PRODUCT = int(os.getenv('PRICE_HISTORY_KEEP_PER_PRODUCT', '100'))
+# Сколько дней хранить доставленные уведомления в notification_outbox
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+# Размер порций при удалении
+CLEANUP_BATCH_SIZE = int(os.getenv('CLEANUP_BATCH_SIZE', '10000'))
+CLEANUP_PRODUCTS_PER_BATCH = int(os.getenv('CLEANUP_PRODUCTS_PER_BATCH', '1000'))
+
+async def delete_in_batches(session, table, condition, batch_size: int = CLEANUP_BATCH_SIZE) -> int:
+    """Удаляет строки по условию порциями по batch_size, фиксируя транзакцию после каждой порции"""
+    deleted = 0
+    while True:
+        ids = select(table.c.id).where(condition).limit(batch_size).scalar_subquery()
+        result = await session.execute(delete(table).where(table.c.id.in_(ids)))
+        await session.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+
+async def trim_price_history(session, keep: int, products_per_batch: int = CLEANUP_PRODUCTS_PER_BATCH) -> int:
+    """
+    Оставляет для каждого товара только keep последних записей истории цен.
+    Номер записи считается оконной функцией row_number() по product_id,
+    товары обрабатываются диапазонами id по products_per_batch штук
+    """
+    deleted = 0
+    last_product_id = 0
+    while True:
+        product_ids = await session.execute(
+            select(Product.id)
+            .where(Product.id > last_product_id)
+            .order_by(Product.id)
+            .limit(products_per_batch)
+        )
+        product_ids = product_ids.scalars().all()
+        if not product_ids:
+            return deleted
+        upper_product_id = product_ids[-1]
+
+        ranked = (
+            select(
+                PriceHistory.id,
+                func.row_number().over(
+                    partition_by=PriceHistory.product_id,
+                    order_by=(PriceHistory.created_at.desc(), PriceHistory.id.desc())
+                ).label("rn")
+            )
+            .where(PriceHistory.product_id > last_product_id, PriceHistory.product_id <= upper_product_id)
+            .subquery()
+        )
+        result = await session.execute(
+            delete(PriceHistory).where(PriceHistory.id.in_(select(ranked.c.id).where(ranked.c.rn > keep)))
+        )
+        await session.commit()
+        deleted += result.rowcount
+        last_product_id = upper_product_id
+
+async def expire_rows(session, model, older_than: datetime, report: dict, key: str):
+    """
+    Удаляет строки старше older_than. Для секционированной таблицы удаляются целые секции,
+    все строки которых старше older_than (DROP вместо построчного DELETE), а из секции
+    по умолчанию, которую удалить нельзя, старые строки удаляются порциями
+    """
+    conn = await session.connection()
+    if await is_partitioned(conn, model.__tablename__):
+        report[f"{key}_partitions_dropped"] = await drop_expired_partitions(conn, model.__tablename__, older_than)
+        await session.commit()
+        default = table(f"{model.__tablename__}_default", column("id"), column("created_at"))
+        report[key] = await delete_in_batches(session, default, default.c.created_at < older_than)
+    else:
+        report[key] = await delete_in_batches(session, model.__table__, model.created_at < older_than)
+
+async def maintain_partitions():
+    """Создает секции price_history и task_logs на PARTITIONS_AHEAD периодов вперед"""
+    async with AsyncEngine.begin() as conn:
+        await ensure_partitions(conn)
+
+async def cleanup_old_data() -> dict:
+    """
+    Очистка старых данных:
+    - логи задач старше TASK_LOG_RETENTION_DAYS дней
+    - история цен старше PRICE_HISTORY_RETENTION_DAYS дней (0 - без ограничения по времени)
+      (в секционированных таблицах удаляются секции, целиком вышедшие за срок хранения)
+    - история цен сверх PRICE_HISTORY_KEEP_PER_PRODUCT последних записей на товар (0 - без ограничения)
+    - доставленные уведомления outbox старше OUTBOX_RETENTION_DAYS дней
+    """
+    started = time.monotonic()
+    report = {"task_logs": 0, "price_history_expired": 0, "price_history_trimmed": 0, "outbox_delivered": 0}
     async with AsyncSessionLocal() as session:
         try:
-            thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-            await session.execute(
-                delete(TaskLog).where(TaskLog.created_at < thirty_days_ago)
+            now = datetime.utcnow()
+            await expire_rows(
+                session, TaskLog, now - timedelta(days=TASK_LOG_RETENTION_DAYS), report, "task_logs"
             )
 
-            price_history = await session.execute(
-                select(PriceHistory.product_id, PriceHistory.id)
-                .order_by(PriceHistory.product_id, PriceHistory.created_at.desc())
+            if PRICE_HISTORY_RETENTION_DAYS > 0:
+                await expire_rows(
+                    session, PriceHistory, now - timedelta(days=PRICE_HISTORY_RETENTION_DAYS),
+                    report, "price_history_expired"
+                )
+
+            if PRICE_HISTORY_KEEP_PER_PRODUCT > 0:
+                report["price_history_trimmed"] = await trim_price_history(session, PRICE_HISTORY_KEEP_PER_PRODUCT)
+
+            report["outbox_delivered"] = await delete_in_batches(
+                session, OutboxEvent.__table__,
+                OutboxEvent.delivered_at < now - timedelta(days=OUTBOX_RETENTION_DAYS)
             )
-            
-            history_groups = {}
-            for product_id, history_id in price_history.fetchall():
-                if product_id not in history_groups:
-                    history_groups[product_id] = []
-                history_groups[product_id].append(history_id)
-
-            for product_id, history_ids in history_groups.items():
-                if len(history_ids) > 100:
-                    ids_to_delete = history_ids[100:]
-                    await session.execute(
-                        delete(PriceHistory).where(PriceHistory.id.in_(ids_to_delete))
-                    )
-
-            await session.commit()
-            logging.info("Cleanup task completed successfully")
+
+            report["elapsed"] = round(time.monotonic() - started, 3)
+            logging.info(f"Cleanup task completed successfully: {report}")
         except Exception as e:
             logging.error(f"Error during cleanup: {str(e)}")
             await session.rollback()
+            report["error"] = str(e)
+    return report
 
-async def fetch_product_data(artikul: str) -> dict:
-    timeout = httpx.Timeout(10.0, connect=5.0)
-    async with httpx.AsyncClient(timeout=timeout) as client:
+def chunked(items: list, size: int) -> Iterator[list]:
+    """Разбивает список на части не длиннее size"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def parse_product(artikul: str, product_data: dict) -> dict:
+    """Преобразует карточку товара из ответа Wildberries в словарь с данными товара"""
+    return {
+        "status": "success",
+        "name": product_data["name"],
+        "artikul": artikul,
+        "price": product_data["salePriceU"] / 100,
+        "rating": product_data.get("reviewRating", 0),
+        "total_quantity": product_data.get("totalQuantity", 0)
+    }
+
+async def fetch_products_chunk(client: httpx.AsyncClient, artikuls: List[str]) -> Dict[str, dict]:
+    """
+    Получает данные сразу по нескольким артикулам одним запросом.
+    Для артикулов, которых нет в ответе, возвращает {"status": "error", "message": "Product not found"}
+    """
+    try:
+        response = await client.get(
+            WB_DETAIL_URL,
+            params={**WB_DETAIL_PARAMS, "nm": ";".join(artikuls)}
+        )
+        if response.status_code != 200:
+            raise WildberriesResponseError(f"API returned status code {response.status_code}")
+
+        products = response.json().get("data", {}).get("products") or []
+        found = {str(product.get("id")): product for product in products}
+
+        results = {}
+        for artikul in artikuls:
+            product_data = found.get(artikul)
+            if product_data is None:
+                results[artikul] = {"status": "error", "message": "Product not found"}
+                continue
+            try:
+                results[artikul] = parse_product(artikul, product_data)
+            except (KeyError, TypeError) as e:
+                results[artikul] = {"status": "error", "message": f"Invalid response format: {str(e)}"}
+        return results
+
+    except httpx.TimeoutException:
+        raise WildberriesTimeoutError(f"Timeout while fetching data for {len(artikuls)} artikuls")
+    except httpx.RequestError as e:
+        raise WildberriesResponseError(f"Request failed: {str(e)}")
+    except ValueError as e:
+        raise WildberriesResponseError(f"Invalid response format: {str(e)}")
+
+async def fetch_products_batch(artikuls: List[str], batch_size: int = WB_BATCH_SIZE) -> Dict[str, dict]:
+    """
+    Получает данные по списку артикулов, отправляя один запрос на каждые batch_size артикулов.
+    Ошибка запроса помечает ошибкой все артикулы своей пачки, остальные пачки не затрагиваются.
+    Артикулы, которые уже запрашиваются (API или другой пачкой), не запрашиваются повторно:
+    результат берется из выполняющегося запроса (см. singleflight.py)
+    """
+    artikuls = list(dict.fromkeys(artikuls))
+    results: Dict[str, dict] = {}
+    for chunk in chunked(artikuls, batch_size):
+        owned, waiting = wb_flight.claim(chunk)
         try:
-            response = await client.get(
-                f"https://card.wb.ru/cards/v1/detail?appType=1&curr=rub&dest=-1257786&spp=30&nm={artikul}")
-            
-            if response.status_code == 404:
-                raise ProductNotFoundError(f"Product with artikul {artikul} not found")
-            elif response.status_code != 200:
-                raise WildberriesResponseError(f"API returned status code {response.status_code}")
-            
-            data = response.json()
-            
-            if not data.get("data", {}).get("products"):
-                raise ProductNotFoundError(f"Product with artikul {artikul} not found in response")
-            
-            product_data = data["data"]["products"][0]
-            return {
-                "status": "success",
-                "name": product_data["name"],
-                "artikul": artikul,
-                "price": product_data["salePriceU"] / 100,
-                "rating": product_data.get("reviewRating", 0),
-                "total_quantity": product_data.get("totalQuantity", 0)
-            }
-            
-        except httpx.TimeoutException:
-            raise WildberriesTimeoutError(f"Timeout while fetching data for artikul {artikul}")
-        except httpx.RequestError as e:
-            raise WildberriesResponseError(f"Request failed: {str(e)}")
-        except (KeyError, IndexError) as e:
-            raise WildberriesResponseError(f"Invalid response format: {str(e)}")
-        except Exception as e:
-            raise WildberriesResponseError(f"Unexpected error: {str(e)}")
+            if owned:
+                try:
+                    chunk_results = await fetch_products_chunk(wb_pool.client, owned)
+                except WildberriesAPIError as e:
+                    logging.error(f"Batch request failed for {len(owned)} artikuls: {str(e)}")
+                    chunk_results = {artikul: {"status": "error", "message": str(e)} for artikul in owned}
+                wb_flight.resolve(chunk_results)
+                results.update(chunk_results)
+        finally:
+            wb_flight.release(owned)
+
+        for artikul, future in waiting.items():
+            try:
+                results[artikul] = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                results[artikul] = {"status": "error", "message": "Request cancelled"}
+            except Exception as e:
+                results[artikul] = {"status": "error", "message": str(e)}
+    return results
+
+async def fetch_product_data(artikul: str) -> dict:
+    """
+    Получает данные одного товара. Одновременные вызовы для одного артикула
+    (в том числе из пачек планировщика) выполняют один запрос к Wildberries
+    """
+    result = await wb_flight.do(artikul, lambda: request_product_data(artikul))
+    if result.get("status") == "error":
+        # Результат пришел из пакетного запроса, ошибки которого не исключения
+        if result.get("message") == "Product not found":
+            raise ProductNotFoundError(f"Product with artikul {artikul} not found in response")
+        raise WildberriesResponseError(result.get("message", "Unknown error"))
+    return result
+
+async def request_product_data(artikul: str) -> dict:
+    try:
+        response = await wb_pool.client.get(WB_DETAIL_URL, params={**WB_DETAIL_PARAMS, "nm": artikul})
+        
+        if response.status_code == 404:
+            raise ProductNotFoundError(f"Product with artikul {artikul} not found")
+        elif response.status_code != 200:
+            raise WildberriesResponseError(f"API returned status code {response.status_code}")
+        
+        data = response.json()
+        
+        if not data.get("data", {}).get("products"):
+            raise ProductNotFoundError(f"Product with artikul {artikul} not found in response")
+        
+        return parse_product(artikul, data["data"]["products"][0])
+        
+    except httpx.TimeoutException:
+        raise WildberriesTimeoutError(f"Timeout while fetching data for artikul {artikul}")
+    except httpx.RequestError as e:
+        raise WildberriesResponseError(f"Request failed: {str(e)}")
+    except (KeyError, IndexError) as e:
+        raise WildberriesResponseError(f"Invalid response format: {str(e)}")
+    except Exception as e:
+        raise WildberriesResponseError(f"Unexpected error: {str(e)}")
 
 async def update_product_data(artikul: str):
     from crud import create_product, log_task
@@ -0,0 +1,57 @@
+"""
+Отдельный воркер обновления подписок.
+
+Запуск: python worker.py
+
+Несколько воркеров (процессов или узлов) могут работать одновременно: подписки
+разбираются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому один артикул
+не обновляется дважды.
+"""
+import asyncio
+import logging
+import os
+import signal
+import time
+
+from db import connect_with_retries, AsyncEngine
+from http_client import start_http_clients, close_http_clients
+from scheduler import check_subscriptions
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    force=True
+)
+logger = logging.getLogger(__name__)
+
+# Пауза между тиками воркера в секундах
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '15'))
+
+
+async def run_worker():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    logger.info("=== Starting refresh worker ===")
+    await connect_with_retries()
+    start_http_clients()
+
+    try:
+        while not stop.is_set():
+            started = time.monotonic()
+            await check_subscriptions()
+            delay = max(WORKER_POLL_INTERVAL - (time.monotonic() - started), 0)
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        logger.info("=== Stopping refresh worker ===")
+        await close_http_clients()
+        await AsyncEngine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())
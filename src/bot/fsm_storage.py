@@ -0,0 +1,135 @@
+import asyncio
+import json
+from typing import Any, Dict, Mapping, Optional
+
+import asyncpg
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import FSM_STORAGE_URL, FSM_STATE_TTL, FSM_STORAGE_POOL_SIZE, FSM_STORAGE_CLEANUP_INTERVAL, logger
+
+# Таблица bot_fsm_states создается API (модель BotFsmState, миграция 0009)
+
+# Просроченная строка при записи считается пустой: состояние и данные
+# брошенного диалога не возвращаются вместе с новой записью
+SET_STATE_SQL = """
+INSERT INTO bot_fsm_states AS s (key, state, expires_at)
+VALUES ($1, $2, now() + make_interval(secs => $3))
+ON CONFLICT (key) DO UPDATE SET
+    state = EXCLUDED.state,
+    data = CASE WHEN s.expires_at <= now() THEN '{}'::jsonb ELSE s.data END,
+    expires_at = EXCLUDED.expires_at
+"""
+
+SET_DATA_SQL = """
+INSERT INTO bot_fsm_states AS s (key, data, expires_at)
+VALUES ($1, $2::jsonb, now() + make_interval(secs => $3))
+ON CONFLICT (key) DO UPDATE SET
+    state = CASE WHEN s.expires_at <= now() THEN NULL ELSE s.state END,
+    data = EXCLUDED.data,
+    expires_at = EXCLUDED.expires_at
+"""
+
+# Слияние данных выполняется в базе одним запросом, поэтому обновления
+# с разных экземпляров бота не затирают друг друга
+UPDATE_DATA_SQL = """
+INSERT INTO bot_fsm_states AS s (key, data, expires_at)
+VALUES ($1, $2::jsonb, now() + make_interval(secs => $3))
+ON CONFLICT (key) DO UPDATE SET
+    state = CASE WHEN s.expires_at <= now() THEN NULL ELSE s.state END,
+    data = CASE WHEN s.expires_at <= now() THEN EXCLUDED.data ELSE s.data || EXCLUDED.data END,
+    expires_at = EXCLUDED.expires_at
+RETURNING data
+"""
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище состояний FSM в Postgres.
+
+    Состояние переживает перезапуск бота и доступно всем его экземплярам.
+    Каждая запись продлевает срок жизни строки на ttl секунд; состояние диалога,
+    брошенного дольше ttl, не возвращается и удаляется фоновой очисткой
+    """
+
+    def __init__(self, url: str, ttl: float = FSM_STATE_TTL, pool_size: int = FSM_STORAGE_POOL_SIZE,
+                 key_builder: Optional[KeyBuilder] = None):
+        self.url = url
+        self.ttl = ttl
+        self.pool_size = pool_size
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+
+    async def _get_pool(self):
+        """Пул соединений создается при первом обращении"""
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(self.url, min_size=1, max_size=self.pool_size)
+                    logger.info(f"FSM storage connected to Postgres (ttl={self.ttl}s)")
+        return self._pool
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        pool = await self._get_pool()
+        await pool.execute(
+            SET_STATE_SQL,
+            self.key_builder.build(key),
+            state.state if isinstance(state, State) else state,
+            self.ttl
+        )
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        pool = await self._get_pool()
+        return await pool.fetchval(
+            "SELECT state FROM bot_fsm_states WHERE key = $1 AND expires_at > now()",
+            self.key_builder.build(key)
+        )
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        pool = await self._get_pool()
+        await pool.execute(SET_DATA_SQL, self.key_builder.build(key), json.dumps(dict(data)), self.ttl)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        pool = await self._get_pool()
+        data = await pool.fetchval(
+            "SELECT data FROM bot_fsm_states WHERE key = $1 AND expires_at > now()",
+            self.key_builder.build(key)
+        )
+        return json.loads(data) if data is not None else {}
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        pool = await self._get_pool()
+        result = await pool.fetchval(UPDATE_DATA_SQL, self.key_builder.build(key), json.dumps(dict(data)), self.ttl)
+        return json.loads(result)
+
+    async def delete_expired(self) -> int:
+        """Удаляет просроченные состояния, возвращает число удаленных строк"""
+        pool = await self._get_pool()
+        status = await pool.execute("DELETE FROM bot_fsm_states WHERE expires_at <= now()")
+        return int(status.split()[-1])
+
+    async def cleanup_loop(self, interval: float = FSM_STORAGE_CLEANUP_INTERVAL):
+        """Периодически удаляет просроченные состояния; ошибки очистки не останавливают бота"""
+        while True:
+            try:
+                deleted = await self.delete_expired()
+                if deleted:
+                    logger.info(f"Deleted {deleted} expired FSM states")
+            except Exception as e:
+                logger.error(f"Failed to delete expired FSM states: {e}")
+            await asyncio.sleep(interval)
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+def create_storage() -> BaseStorage:
+    """PostgresStorage, если задан FSM_STORAGE_URL, иначе MemoryStorage (состояния теряются при перезапуске)"""
+    if FSM_STORAGE_URL:
+        return PostgresStorage(FSM_STORAGE_URL)
+    logger.warning("FSM_STORAGE_URL is not set, using in-memory FSM storage")
+    return MemoryStorage()
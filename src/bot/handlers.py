@@ -1,4 +1,3 @@
-import aiohttp
 from aiogram import types
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
@@ -6,7 +5,8 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardButton
 
-from config import API_URL, HEADERS, logger
+from config import API_URL, HEADERS, PRODUCTS_BATCH_SIZE, logger
+from http_client import api_session
 from keyboards import main_keyboard, frequency_keyboard, back_to_menu_keyboard
 
 class Form(StatesGroup):
@@ -15,6 +15,18 @@ class Form(StatesGroup):
     waiting_for_frequency = State()
     waiting_for_unsubscribe = State()
 
+def format_price_stats(stats: dict) -> str:
+    """Строки со статистикой цен товара из ответа API (пустая строка, если статистики нет)"""
+    if not stats or stats.get('lowest_price') is None:
+        return ""
+    lines = f"📉 Минимальная цена за все время: {stats['lowest_price']} ₽\n"
+    if stats.get('min_price_30d') is not None:
+        lines += (
+            f"📈 За 30 дней: от {stats['min_price_30d']} до {stats['max_price_30d']} ₽, "
+            f"в среднем {stats['avg_price_30d']} ₽\n"
+        )
+    return lines
+
 async def show_main_menu(message: types.Message, text: str = "Выберите действие:"):
     """Показывает главное меню с заданным текстом"""
     await message.answer(text, reply_markup=main_keyboard)
@@ -65,7 +77,7 @@ async def process_my_subscriptions(message: types.Message):
     chat_id = str(message.chat.id)
     logger.info(f"Запрос подписок для chat_id: {chat_id}")
     
-    async with aiohttp.ClientSession() as session:
+    async with api_session() as session:
         url = f"{API_URL}/subscriptions/user/{chat_id}"
         logger.info(f"Отправка GET запроса к: {url}")
         
@@ -87,35 +99,48 @@ async def process_my_subscriptions(message: types.Message):
                     await show_main_menu(message)
                     return
 
-                subscription_info = []
-                for sub in subscriptions:
-                    artikul = sub["artikul"]
+                # Данные всех товаров запрашиваются одним запросом (пачками по PRODUCTS_BATCH_SIZE)
+                artikuls = [sub["artikul"] for sub in subscriptions]
+                products = {}
+                for i in range(0, len(artikuls), PRODUCTS_BATCH_SIZE):
+                    chunk = artikuls[i:i + PRODUCTS_BATCH_SIZE]
                     try:
                         async with session.post(
-                            f"{API_URL}/products",
+                            f"{API_URL}/products/batch",
                             headers=HEADERS,
-                            json={"artikul": artikul}
-                        ) as product_response:
-                            if product_response.status == 200:
-                                product = await product_response.json()
-                                subscription_info.append(
-                                    f"📦 {product.get('name', 'Название недоступно')}\n"
-                                    f"📎 Артикул: {artikul}\n"
-                                    f"💰 Текущая цена: {product.get('price', 'Н/Д')} ₽\n"
-                                    f"📊 Количество: {product.get('total_quantity', 'Н/Д')} шт.\n"
-                                    f"🔗 https://www.wildberries.ru/catalog/{artikul}/detail.aspx\n"
-                                )
+                            json={"artikuls": chunk}
+                        ) as batch_response:
+                            if batch_response.status == 200:
+                                batch = await batch_response.json()
+                                products.update({item["artikul"]: item for item in batch["items"]})
                             else:
-                                subscription_info.append(
-                                    f"📦 Товар {artikul}\n"
-                                    f"❌ Не удалось получить информацию о товаре\n"
-                                )
+                                logger.error(f"Ошибка API при запросе товаров: {batch_response.status}")
                     except Exception as e:
-                        logger.error(f"Ошибка при запросе товара {artikul}: {e}")
+                        logger.error(f"Ошибка при запросе товаров {chunk}: {e}")
+
+                subscription_info = []
+                for artikul in artikuls:
+                    item = products.get(artikul)
+                    if item is None:
                         subscription_info.append(
                             f"📦 Товар {artikul}\n"
                             f"❌ Ошибка при получении информации\n"
                         )
+                    elif item["status"] == "ok":
+                        product = item["product"]
+                        subscription_info.append(
+                            f"📦 {product.get('name', 'Название недоступно')}\n"
+                            f"📎 Артикул: {artikul}\n"
+                            f"💰 Текущая цена: {product.get('price', 'Н/Д')} ₽\n"
+                            f"📊 Количество: {product.get('total_quantity', 'Н/Д')} шт.\n"
+                            f"{format_price_stats(product.get('price_stats'))}"
+                            f"🔗 https://www.wildberries.ru/catalog/{artikul}/detail.aspx\n"
+                        )
+                    else:
+                        subscription_info.append(
+                            f"📦 Товар {artikul}\n"
+                            f"❌ Не удалось получить информацию о товаре\n"
+                        )
 
                 if subscription_info:
                     message_text = "Ваши активные подписки:\n\n" + "\n".join(subscription_info)
@@ -147,7 +172,7 @@ async def process_artikul(message: types.Message, state: FSMContext):
     logger.info(f"Запрос информации о товаре: {artikul}")
     await message.answer(f"Запрашиваем данные для артикула: {artikul}")
 
-    async with aiohttp.ClientSession() as session:
+    async with api_session() as session:
         url = f"{API_URL}/products"
         logger.info(f"Отправка POST запроса к: {url}")
         
@@ -165,6 +190,7 @@ async def process_artikul(message: types.Message, state: FSMContext):
                         f"💰 Цена: {data.get('price')} ₽\n"
                         f"⭐️ Рейтинг: {data.get('rating')}\n"
                         f"📊 Количество: {data.get('total_quantity')} шт.\n"
+                        f"{format_price_stats(data.get('price_stats'))}"
                         f"🔗 Ссылка: https://www.wildberries.ru/catalog/{data.get('artikul')}/detail.aspx"
                     )
 
@@ -196,7 +222,7 @@ async def process_subscription_artikul(message: types.Message, state: FSMContext
     artikul = message.text
     await state.update_data(artikul=artikul)
     
-    async with aiohttp.ClientSession() as session:
+    async with api_session() as session:
         async with session.post(f"{API_URL}/products", headers=HEADERS, json={"artikul": artikul}) as response:
             if response.status == 404:
                 await message.answer("❌ Товар не найден. Проверьте артикул и попробуйте снова.")
@@ -243,7 +269,7 @@ async def process_frequency(message: types.Message, state: FSMContext):
     artikul = data.get("artikul")
     chat_id = str(message.chat.id)
 
-    async with aiohttp.ClientSession() as session:
+    async with api_session() as session:
         async with session.post(
             f"{API_URL}/subscriptions",
             headers=HEADERS,
@@ -271,7 +297,7 @@ async def process_frequency(message: types.Message, state: FSMContext):
 
 async def unsubscribe_command(message: types.Message, state: FSMContext):
     """Обработка команды отмены подписки"""
-    async with aiohttp.ClientSession() as session:
+    async with api_session() as session:
         chat_id = str(message.chat.id)
         async with session.get(f"{API_URL}/subscriptions/user/{chat_id}", headers=HEADERS) as response:
             if response.status != 200:
@@ -308,7 +334,7 @@ async def process_unsubscribe(message: types.Message, state: FSMContext):
     artikul = message.text.replace("Отписаться от ", "")
     chat_id = str(message.chat.id)
 
-    async with aiohttp.ClientSession() as session:
+    async with api_session() as session:
         async with session.delete(
             f"{API_URL}/subscriptions/{artikul}/users/{chat_id}",
             headers=HEADERS
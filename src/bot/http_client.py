@@ -0,0 +1,81 @@
+import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+import aiohttp
+
+from config import logger
+
+API_HTTP_MAX_CONNECTIONS = int(os.getenv('API_HTTP_MAX_CONNECTIONS', '20'))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '30'))
+
+_session: Optional[aiohttp.ClientSession] = None
+_counters = {"requests": 0, "connections_opened": 0, "connections_reused": 0}
+
+
+async def _on_request_start(session, context, params):
+    _counters["requests"] += 1
+
+
+async def _on_connection_create_end(session, context, params):
+    _counters["connections_opened"] += 1
+
+
+async def _on_connection_reuseconn(session, context, params):
+    _counters["connections_reused"] += 1
+
+
+def _create_session() -> aiohttp.ClientSession:
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+
+    connector = aiohttp.TCPConnector(
+        limit=API_HTTP_MAX_CONNECTIONS,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+    )
+    logger.info(f"API HTTP pool started (limit={API_HTTP_MAX_CONNECTIONS})")
+    return aiohttp.ClientSession(connector=connector, trace_configs=[trace_config])
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Возвращает общую сессию для запросов к API, создавая её при первом обращении"""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
+
+
+@asynccontextmanager
+async def api_session() -> AsyncIterator[aiohttp.ClientSession]:
+    """Выдает общую сессию для запросов к API. Сессия не закрывается при выходе из блока"""
+    yield get_session()
+
+
+async def close_session():
+    """Закрывает общую сессию (вызывается при остановке приложения)"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("API HTTP pool closed")
+    _session = None
+
+
+def get_pool_stats() -> Dict[str, object]:
+    """Статистика пула: открытые/простаивающие соединения и доля переиспользованных"""
+    idle = in_use = 0
+    if _session is not None and not _session.closed:
+        connector = _session.connector
+        idle = sum(len(conns) for conns in connector._conns.values())
+        in_use = len(connector._acquired)
+    requests = _counters["requests"]
+    return {
+        "name": "api",
+        "http2": False,
+        "max_connections": API_HTTP_MAX_CONNECTIONS,
+        "open_connections": idle + in_use,
+        "idle_connections": idle,
+        **_counters,
+        "reuse_ratio": round(_counters["connections_reused"] / requests, 3) if requests else 0.0
+    }
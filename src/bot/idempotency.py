@@ -0,0 +1,50 @@
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from config import NOTIFY_IDEMPOTENCY_TTL, NOTIFY_IDEMPOTENCY_MAX_SIZE, logger
+
+
+class IdempotencyRegistry:
+    """
+    Ключи уведомлений, которые уже обработаны или обрабатываются сейчас.
+
+    API доставляет уведомления из outbox с повторами, поэтому одно уведомление
+    может прийти несколько раз; по ключу Idempotency-Key повтор не рассылается заново.
+    """
+
+    def __init__(self, ttl: float = NOTIFY_IDEMPOTENCY_TTL, max_size: int = NOTIFY_IDEMPOTENCY_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._keys: "OrderedDict[str, float]" = OrderedDict()
+
+    def begin(self, key: str) -> bool:
+        """Запоминает ключ; False, если уведомление с таким ключом уже было"""
+        now = time.monotonic()
+        expires_at = self._keys.get(key)
+        if expires_at is not None and expires_at > now:
+            return False
+        self._keys[key] = now + self.ttl
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_size:
+            self._keys.popitem(last=False)
+        return True
+
+    def forget(self, key: str):
+        """Забывает ключ, если обработка не удалась: повтор должен выполниться"""
+        self._keys.pop(key, None)
+
+    async def run_once(self, key: Optional[str], handler: Callable[[], Awaitable[Any]]) -> Any:
+        if key is None:
+            return await handler()
+        if not self.begin(key):
+            logger.info(f"Duplicate notification {key} skipped")
+            return {"success": True, "duplicate": True, "notifications_sent": 0}
+        try:
+            return await handler()
+        except Exception:
+            self.forget(key)
+            raise
+
+
+notification_keys = IdempotencyRegistry()
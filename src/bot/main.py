@@ -1,6 +1,5 @@
 import asyncio
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.filters import Command
 from fastapi import FastAPI
 from hypercorn.asyncio import serve
@@ -13,10 +12,14 @@ from handlers import (
     unsubscribe_command, process_unsubscribe, return_to_menu, Form
 )
 from router import router, set_bot
+from http_client import get_session, close_session
+from fsm_storage import create_storage, PostgresStorage
 
 # Инициализация бота и FastAPI
 bot = Bot(token=BOT_API_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+# Состояния диалогов хранятся в Postgres, если задан FSM_STORAGE_URL
+storage = create_storage()
+dp = Dispatcher(storage=storage)
 app = FastAPI(
     title="Telegram Bot API",
     description="""
@@ -72,6 +75,7 @@ async def startup_event():
     try:
         bot_info = await bot.get_me()
         logger.info(f"Bot connected successfully: @{bot_info.username}")
+        get_session()
     except Exception as e:
         logger.error(f"Failed to initialize bot: {e}")
         raise
@@ -84,6 +88,7 @@ async def shutdown_event():
         session = await bot.get_session()
         await session.close()
         logger.info("Bot session closed successfully")
+        await close_session()
     except Exception as e:
         logger.error(f"Error during shutdown: {e}")
 
@@ -94,10 +99,10 @@ async def main():
     
     logger.info("Starting bot and FastAPI server...")
     try:
-        await asyncio.gather(
-            serve(app, config),
-            dp.start_polling(bot, skip_updates=True)
-        )
+        tasks = [serve(app, config), dp.start_polling(bot, skip_updates=True)]
+        if isinstance(storage, PostgresStorage):
+            tasks.append(storage.cleanup_loop())
+        await asyncio.gather(*tasks)
     except Exception as e:
         logger.error(f"Error during startup: {e}")
         raise
@@ -1,16 +1,21 @@
 import logging
-import aiohttp
 from fastapi import HTTPException
-from pydantic import BaseModel
-from typing import List
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from typing import Any, Dict, List, Literal, Optional
 
-from config import API_URL, HEADERS, logger
+from config import API_URL, HEADERS, NOTIFY_SUBSCRIBERS_BATCH_SIZE, logger
+from http_client import api_session
+from idempotency import notification_keys
+
+# Максимальная длина сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
 
 class PriceNotification(BaseModel):
     artikul: str
     old_price: float
     new_price: float
     product_name: str
+    lowest_price: Optional[float] = None
 
 class QuantityNotification(BaseModel):
     artikul: str
@@ -18,81 +23,221 @@ class QuantityNotification(BaseModel):
     new_quantity: int
     product_name: str
 
+class NotificationEvent(BaseModel):
+    event_type: Literal["price_change", "quantity_change"]
+    idempotency_key: Optional[str] = Field(None, description="Ключ события, повтор с тем же ключом не рассылается")
+    payload: dict
+    chat_ids: Optional[List[str]] = Field(
+        None, description="Подписчики, которым нужно отправить уведомление; если не переданы, запрашиваются у API"
+    )
+
+    @model_validator(mode="after")
+    def validate_payload(self):
+        model = PriceNotification if self.event_type == "price_change" else QuantityNotification
+        self.payload = model(**self.payload).model_dump()
+        return self
+
+class NotificationBatch(BaseModel):
+    # Уведомления проверяются по одному в notify_batch: ошибка в одном
+    # не должна приводить к отказу всей пачки
+    events: List[Dict[str, Any]] = Field(..., min_length=1)
+
+def lowest_price_line(notification: PriceNotification) -> str:
+    if notification.lowest_price is None:
+        return ""
+    if notification.new_price <= notification.lowest_price:
+        return "📉 Это самая низкая цена за все время!\n"
+    return f"📉 Минимальная цена за все время: {notification.lowest_price:,.2f} ₽\n"
+
+def price_change_text(notification: PriceNotification) -> str:
+    price_diff = notification.new_price - notification.old_price
+    price_change = "снизилась" if price_diff < 0 else "повысилась"
+    percent_change = abs(price_diff / notification.old_price * 100) if notification.old_price else 100
+    return (
+        f"💰 Изменение цены на {notification.product_name}!\n\n"
+        f"Артикул: {notification.artikul}\n"
+        f"Старая цена: {notification.old_price:,.2f} ₽\n"
+        f"Новая цена: {notification.new_price:,.2f} ₽\n"
+        f"Цена {price_change} на {abs(price_diff):,.2f} ₽ ({percent_change:.1f}%)\n"
+        f"{lowest_price_line(notification)}\n"
+        f"🔗 https://www.wildberries.ru/catalog/{notification.artikul}/detail.aspx"
+    )
+
+def quantity_change_text(notification: QuantityNotification) -> str:
+    quantity_diff = notification.new_quantity - notification.old_quantity
+    quantity_change = "увеличилось" if quantity_diff > 0 else "уменьшилось"
+    percent_change = abs(quantity_diff / notification.old_quantity * 100) if notification.old_quantity > 0 else 100
+    return (
+        f"📦 Изменение количества товара {notification.product_name}!\n\n"
+        f"Артикул: {notification.artikul}\n"
+        f"Старое количество: {notification.old_quantity:,} шт.\n"
+        f"Новое количество: {notification.new_quantity:,} шт.\n"
+        f"Количество {quantity_change} на {abs(quantity_diff):,} шт. ({percent_change:.1f}%)\n\n"
+        f"🔗 https://www.wildberries.ru/catalog/{notification.artikul}/detail.aspx"
+    )
+
+def event_text(event: NotificationEvent) -> str:
+    if event.event_type == "price_change":
+        return price_change_text(PriceNotification(**event.payload))
+    return quantity_change_text(QuantityNotification(**event.payload))
+
+def digest_messages(sections: List[str]) -> List[str]:
+    """
+    Объединяет уведомления для одного чата в сводку. Сводка делится на несколько
+    сообщений, если не помещается в лимит длины сообщения Telegram
+    """
+    if len(sections) == 1:
+        return sections
+    header = f"🔔 Изменения по вашим подпискам ({len(sections)}):\n\n"
+    separator = "\n\n➖➖➖\n\n"
+    messages, current = [], header
+    for section in sections:
+        candidate = current + (separator if current != header else "") + section
+        if len(candidate) > TELEGRAM_MESSAGE_LIMIT and current != header:
+            messages.append(current)
+            current = section
+        else:
+            current = candidate
+    messages.append(current)
+    return messages
+
+async def fetch_subscribers(session, artikuls: List[str]) -> Dict[str, List[str]]:
+    """chat_id подписчиков всех артикулов, по одному запросу к API на NOTIFY_SUBSCRIBERS_BATCH_SIZE артикулов"""
+    subscribers: Dict[str, List[str]] = {}
+    for start in range(0, len(artikuls), NOTIFY_SUBSCRIBERS_BATCH_SIZE):
+        chunk = artikuls[start:start + NOTIFY_SUBSCRIBERS_BATCH_SIZE]
+        async with session.post(
+            f"{API_URL}/subscriptions/users:batch",
+            headers=HEADERS,
+            json={"artikuls": chunk}
+        ) as response:
+            if response.status != 200:
+                logger.error(f"Failed to get subscribers: HTTP {response.status}")
+                raise HTTPException(status_code=500, detail="Failed to get subscribers")
+            subscribers.update((await response.json())["subscribers"])
+    return subscribers
+
+def validation_error_text(error: ValidationError) -> str:
+    return "; ".join(f"{'.'.join(map(str, item['loc']))}: {item['msg']}" for item in error.errors())
+
+async def notify_batch(batch: NotificationBatch, bot):
+    """
+    Рассылает пачку уведомлений, уведомления для одного чата объединяются в сводку.
+    Подписчики берутся из chat_ids уведомления; для уведомлений без chat_ids
+    они запрашиваются у API одним запросом на всю пачку.
+    Каждое уведомление проверяется отдельно: некорректные отклоняются (status "rejected"),
+    остальные рассылаются. Результат по каждому уведомлению возвращается в results
+    """
+    events, results = [], []
+    for raw in batch.events:
+        key = raw.get("idempotency_key")
+        try:
+            event = NotificationEvent.model_validate(raw)
+        except ValidationError as e:
+            logger.error(f"Rejected notification {key}: {validation_error_text(e)}")
+            results.append({"idempotency_key": key, "status": "rejected", "error": validation_error_text(e)})
+            continue
+        if event.idempotency_key is not None and not notification_keys.begin(event.idempotency_key):
+            logger.info(f"Duplicate notification {event.idempotency_key} skipped")
+            results.append({"idempotency_key": key, "status": "duplicate"})
+            continue
+        events.append(event)
+        results.append({"idempotency_key": key, "status": "accepted"})
+
+    try:
+        sections: Dict[str, List[str]] = {}
+        subscribers: Dict[str, List[str]] = {}
+        lookup = list(dict.fromkeys(event.payload["artikul"] for event in events if event.chat_ids is None))
+        if lookup:
+            async with api_session() as session:
+                subscribers = await fetch_subscribers(session, lookup)
+        for event in events:
+            text = event_text(event)
+            chat_ids = event.chat_ids if event.chat_ids is not None else subscribers.get(event.payload["artikul"], [])
+            for chat_id in chat_ids:
+                sections.setdefault(chat_id, []).append(text)
+    except Exception:
+        # Пачку повторит API, ключи нужно освободить
+        for event in events:
+            if event.idempotency_key is not None:
+                notification_keys.forget(event.idempotency_key)
+        raise
+
+    notifications_sent = 0
+    for chat_id, chat_sections in sections.items():
+        for message in digest_messages(chat_sections):
+            try:
+                await bot.send_message(chat_id=chat_id, text=message)
+                notifications_sent += 1
+            except Exception as e:
+                logger.error(f"Failed to send notification to {chat_id}: {e}")
+
+    rejected = sum(1 for result in results if result["status"] == "rejected")
+    logger.info(
+        f"Batch of {len(batch.events)} notifications processed: {len(events)} new, {rejected} rejected, "
+        f"{notifications_sent} messages to {len(sections)} chats"
+    )
+    return {
+        "success": True,
+        "events": len(events),
+        "duplicates": len(batch.events) - len(events) - rejected,
+        "rejected": rejected,
+        "chats": len(sections),
+        "notifications_sent": notifications_sent,
+        "results": results
+    }
+
 async def notify_price_change(notification: PriceNotification, bot):
     """Отправляет уведомления об изменении цены подписчикам"""
     logger.info(f"Received price change notification for artikul {notification.artikul}")
-    
-    async with aiohttp.ClientSession() as session:
+
+    async with api_session() as session:
         url = f"{API_URL}/subscriptions/{notification.artikul}/users"
         logger.info(f"Fetching subscribers from: {url}")
-        
+
         async with session.get(url, headers=HEADERS) as response:
             if response.status != 200:
                 logger.error(f"Failed to get subscribers: HTTP {response.status}")
                 raise HTTPException(status_code=500, detail="Failed to get subscribers")
-            
+
             subscribers = await response.json()
             logger.info(f"Found {len(subscribers)} subscribers")
-            
+
+            message = price_change_text(notification)
             notifications_sent = 0
             for subscriber in subscribers:
                 try:
                     chat_id = subscriber['chat_id']
-                    price_diff = notification.new_price - notification.old_price
-                    price_change = "снизилась" if price_diff < 0 else "повысилась"
-                    percent_change = abs(price_diff / notification.old_price * 100)
-                    
-                    message = (
-                        f"💰 Изменение цены на {notification.product_name}!\n\n"
-                        f"Артикул: {notification.artikul}\n"
-                        f"Старая цена: {notification.old_price:,.2f} ₽\n"
-                        f"Новая цена: {notification.new_price:,.2f} ₽\n"
-                        f"Цена {price_change} на {abs(price_diff):,.2f} ₽ ({percent_change:.1f}%)\n\n"
-                        f"🔗 https://www.wildberries.ru/catalog/{notification.artikul}/detail.aspx"
-                    )
-                    
                     logger.info(f"Sending notification to chat_id: {chat_id}")
                     await bot.send_message(chat_id=chat_id, text=message)
                     notifications_sent += 1
                     logger.info(f"Successfully sent notification to chat_id: {chat_id}")
                 except Exception as e:
                     logger.error(f"Failed to send notification to {chat_id}: {str(e)}")
-            
+
             logger.info(f"Successfully sent {notifications_sent} notifications")
             return {"success": True, "notifications_sent": notifications_sent}
 
 async def notify_quantity_change(notification: QuantityNotification, bot):
     """Отправляет уведомления об изменении количества подписчикам"""
-    async with aiohttp.ClientSession() as session:
+    async with api_session() as session:
         url = f"{API_URL}/subscriptions/{notification.artikul}/users"
         async with session.get(url, headers=HEADERS) as response:
             if response.status != 200:
                 logger.error(f"Failed to get subscribers: HTTP {response.status}")
                 raise HTTPException(status_code=500, detail="Failed to get subscribers")
-            
+
             subscribers = await response.json()
-            
+
+            message = quantity_change_text(notification)
             notifications_sent = 0
             for subscriber in subscribers:
                 try:
                     chat_id = subscriber['chat_id']
-                    quantity_diff = notification.new_quantity - notification.old_quantity
-                    quantity_change = "увеличилось" if quantity_diff > 0 else "уменьшилось"
-                    percent_change = abs(quantity_diff / notification.old_quantity * 100) if notification.old_quantity > 0 else 100
-                    
-                    message = (
-                        f"📦 Изменение количества товара {notification.product_name}!\n\n"
-                        f"Артикул: {notification.artikul}\n"
-                        f"Старое количество: {notification.old_quantity:,} шт.\n"
-                        f"Новое количество: {notification.new_quantity:,} шт.\n"
-                        f"Количество {quantity_change} на {abs(quantity_diff):,} шт. ({percent_change:.1f}%)\n\n"
-                        f"🔗 https://www.wildberries.ru/catalog/{notification.artikul}/detail.aspx"
-                    )
-                    
                     await bot.send_message(chat_id=chat_id, text=message)
                     notifications_sent += 1
                     logger.info(f"Quantity change notification sent to {chat_id}")
                 except Exception as e:
                     logger.error(f"Failed to send notification to {chat_id}: {e}")
-            
-            return {"success": True, "notifications_sent": notifications_sent} 
\ No newline at end of file
+
+            return {"success": True, "notifications_sent": notifications_sent}
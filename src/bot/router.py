@@ -1,7 +1,12 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Header
 from aiogram import Bot
-from notifications import notify_price_change, notify_quantity_change, PriceNotification, QuantityNotification
-from typing import Annotated
+from notifications import (
+    notify_price_change, notify_quantity_change, notify_batch,
+    PriceNotification, QuantityNotification, NotificationBatch
+)
+from typing import Annotated, Optional
+from http_client import get_pool_stats
+from idempotency import notification_keys
 
 router = APIRouter(
     prefix="/api/v1",
@@ -31,7 +36,8 @@ async def get_bot() -> Bot:
 @router.post(
     "/notify/price-change", 
     summary="Отправить уведомление об изменении цены",
-    description="Отправляет уведомления всем подписчикам об изменении цены товара",
+    description="Отправляет уведомления всем подписчикам об изменении цены товара. "
+                "Повторный запрос с тем же заголовком Idempotency-Key не рассылается заново",
     response_description="Результат отправки уведомлений",
     responses={
         200: {"description": "Уведомления успешно отправлены"},
@@ -40,15 +46,17 @@ async def get_bot() -> Bot:
 )
 async def price_change_notification(
     notification: PriceNotification,
-    bot: Annotated[Bot, Depends(get_bot)]
+    bot: Annotated[Bot, Depends(get_bot)],
+    idempotency_key: Optional[str] = Header(None)
 ):
     """Отправляет уведомления об изменении цены подписчикам"""
-    return await notify_price_change(notification, bot)
+    return await notification_keys.run_once(idempotency_key, lambda: notify_price_change(notification, bot))
 
 @router.post(
     "/notify/quantity-change",
     summary="Отправить уведомление об изменении количества",
-    description="Отправляет уведомления всем подписчикам об изменении количества товара",
+    description="Отправляет уведомления всем подписчикам об изменении количества товара. "
+                "Повторный запрос с тем же заголовком Idempotency-Key не рассылается заново",
     response_description="Результат отправки уведомлений",
     responses={
         200: {"description": "Уведомления успешно отправлены"},
@@ -57,7 +65,40 @@ async def price_change_notification(
 )
 async def quantity_change_notification(
     notification: QuantityNotification,
-    bot: Annotated[Bot, Depends(get_bot)]
+    bot: Annotated[Bot, Depends(get_bot)],
+    idempotency_key: Optional[str] = Header(None)
 ):
     """Отправляет уведомления об изменении количества подписчикам"""
-    return await notify_quantity_change(notification, bot)
+    return await notification_keys.run_once(idempotency_key, lambda: notify_quantity_change(notification, bot))
+
+@router.post(
+    "/notify/batch",
+    summary="Отправить пачку уведомлений",
+    description="Принимает уведомления об изменении цены и количества нескольких товаров. "
+                "Подписчики всех товаров запрашиваются у API одним запросом, несколько изменений "
+                "для одного чата объединяются в одно сообщение-сводку. "
+                "Уведомления с уже обработанным idempotency_key пропускаются. "
+                "Каждое уведомление проверяется отдельно: некорректное не мешает рассылке остальных "
+                "и возвращается в results со статусом rejected",
+    response_description="Результат отправки уведомлений",
+    responses={
+        200: {"description": "Уведомления обработаны"},
+        500: {"description": "Не удалось получить подписчиков, пачку нужно повторить"}
+    }
+)
+async def batch_notification(
+    batch: NotificationBatch,
+    bot: Annotated[Bot, Depends(get_bot)]
+):
+    """Отправляет пачку уведомлений подписчикам"""
+    return await notify_batch(batch, bot)
+
+@router.get(
+    "/stats/http-pool",
+    summary="Статистика HTTP пула",
+    description="Возвращает состояние общего пула соединений бота к основному API",
+    response_description="Открытые/простаивающие соединения и доля переиспользованных"
+)
+async def http_pool_stats():
+    """Возвращает статистику пула соединений к API"""
+    return get_pool_stats()